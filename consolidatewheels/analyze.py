@@ -0,0 +1,167 @@
+from __future__ import annotations
+
+import json
+import os
+import subprocess
+import sys
+import zipfile
+
+from . import elf
+from .consolidate_linux import demangle_libname
+from .wheelsfunc import DIST_INFO_RE
+from .workspace import make_workdir
+
+# Imports the packages given as arguments and reports how long that took
+# and the memory mappings of the process, to the standard output.
+PROBE = """
+import importlib, json, sys, time
+error = None
+started = time.perf_counter()
+for name in sys.argv[1:]:
+    try:
+        importlib.import_module(name)
+    except Exception as err:
+        error = f"{name}: {type(err).__name__}: {err}"
+seconds = time.perf_counter() - started
+with open("/proc/self/maps") as maps_f:
+    maps = maps_f.read()
+json.dump({"seconds": seconds, "error": error, "maps": maps}, sys.stdout)
+"""
+
+
+def analyze_wheels(wheels: list[str], workdir: str | None = None) -> dict:
+    """Measure what importing the packages of a set of wheels costs at runtime.
+
+    The wheels are installed, without any network access and
+    without their dependencies, in a virtual environment created
+    in a temporary directory inside ``workdir``.
+
+    Each top level package is imported in a fresh interpreter,
+    and all of them are then imported together in the same one,
+    which is where libraries embedded by multiple wheels are loaded
+    multiple times. See ``probe`` for what is measured.
+
+    Returns the measures of each package, and of ``all`` of them.
+    Raises ``RuntimeError`` when the wheels can't be installed.
+    """
+    if not os.path.exists("/proc/self/maps"):
+        raise RuntimeError("Wheels can only be analyzed on Linux")
+
+    packages = sorted({name for wheel in wheels for name in top_level_packages(wheel)})
+    with make_workdir(workdir, prefix="analyze-") as tmpdir:
+        envdir = os.path.join(tmpdir, "env")
+        python = create_env(envdir, wheels)
+        results = {name: probe(python, envdir, [name]) for name in packages}
+        return {"packages": results, "all": probe(python, envdir, packages)}
+
+
+def create_env(envdir: str, wheels: list[str]) -> str:
+    """Create a virtual environment with the wheels installed.
+
+    Returns the path of its interpreter.
+    """
+    python = os.path.join(envdir, "bin", "python")
+    commands = [
+        [sys.executable, "-m", "venv", envdir],
+        [
+            python,
+            "-m",
+            "pip",
+            "install",
+            "--no-index",
+            "--no-deps",
+            "--no-cache-dir",
+            "--disable-pip-version-check",
+            "--quiet",
+            *wheels,
+        ],
+    ]
+    for command in commands:
+        try:
+            subprocess.run(command, check=True, capture_output=True)
+        except subprocess.CalledProcessError as err:
+            stderr = (err.stderr or b"").decode("utf-8", "replace").strip()
+            raise RuntimeError(f"Unable to install the wheels: {stderr}") from err
+    return python
+
+
+def probe(python: str, envdir: str, packages: list[str]) -> dict:
+    """Import packages in a fresh interpreter and measure what got loaded.
+
+    Only the shared objects installed in ``envdir`` are accounted for:
+    how many bytes of them were mapped in memory, and how many copies
+    of each library embedded by auditwheel were loaded, by demangled name.
+    ``seconds`` is how long importing the packages took, and ``error``
+    why one of them couldn't be imported, if that's the case.
+    """
+    try:
+        result = subprocess.run(
+            [python, "-I", "-c", PROBE, *packages],
+            check=True,
+            capture_output=True,
+            cwd=envdir,
+        )
+    except subprocess.CalledProcessError as err:
+        # Libraries that can't be loaded together might crash the interpreter.
+        raise RuntimeError(
+            f"Interpreter failed importing {', '.join(packages)}: "
+            f"exit code {err.returncode}"
+        ) from err
+    report = json.loads(result.stdout)
+    return {
+        "seconds": report["seconds"],
+        "error": report["error"],
+        **summarize_maps(report["maps"], envdir),
+    }
+
+
+def summarize_maps(maps: str, envdir: str) -> dict:
+    """Summarize the shared objects of ``envdir`` mapped in ``/proc/PID/maps``."""
+    envdir = os.path.realpath(envdir)
+    mapped = 0
+    copies = {}  # type: dict[str, set[str]]
+    for line in maps.splitlines():
+        fields = line.split(maxsplit=5)
+        if len(fields) < 6:
+            # Anonymous mappings
+            continue
+        path = fields[5]
+        filename = os.path.basename(path)
+        if not path.startswith(envdir + os.sep) or not elf.is_shared_object(filename):
+            continue
+        start, end = fields[0].split("-")
+        mapped += int(end, 16) - int(start, 16)
+        if os.path.dirname(path).endswith(".libs"):
+            copies.setdefault(demangle_libname(filename), set()).add(path)
+    return {
+        "mapped_bytes": mapped,
+        "libraries": {libname: len(paths) for libname, paths in sorted(copies.items())},
+    }
+
+
+def top_level_packages(wheel: str) -> list[str]:
+    """The names that can be imported once the wheel is installed.
+
+    They are read from the ``top_level.txt`` metadata when the wheel
+    has it, otherwise from the packages and modules at its root.
+    """
+    with zipfile.ZipFile(wheel) as wf:
+        names = wf.namelist()
+        for name in names:
+            dirname, _, filename = name.partition("/")
+            if DIST_INFO_RE.match(dirname) and filename == "top_level.txt":
+                return sorted(
+                    line.strip()
+                    for line in wf.read(name).decode("utf-8").splitlines()
+                    if line.strip()
+                )
+
+    packages = set()
+    for name in names:
+        root, separator, filename = name.partition("/")
+        if separator:
+            if filename == "__init__.py":
+                packages.add(root)
+        elif root.endswith(".py") or elf.is_shared_object(root):
+            packages.add(root.split(".", 1)[0])
+    return sorted(packages)
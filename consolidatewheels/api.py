@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import argparse
+import dataclasses
+from typing import Iterable
+
+from . import cache, main
+
+
+@dataclasses.dataclass
+class ConsolidationResult:
+    """The outcome of ``consolidate`` for all the groups of wheels.
+
+    ``mangling_map`` is the mangling applied to each group of wheels
+    and ``failures`` the error that prevented the consolidation of a group.
+    ``removed`` are the duplicated libraries that were deleted
+    and ``patched_files`` the libraries that were patched, both
+    relative to the unpacked wheels, ``stripped`` the bytes of debug
+    sections removed and ``timings`` how long each phase took in seconds.
+    """
+
+    outputs: list[str] = dataclasses.field(default_factory=list)
+    mangling_map: dict[str, dict[str, str]] = dataclasses.field(default_factory=dict)
+    providers: dict[str, dict[str, str]] = dataclasses.field(default_factory=dict)
+    removed: list[str] = dataclasses.field(default_factory=list)
+    patched: int = 0
+    patched_files: list[str] = dataclasses.field(default_factory=list)
+    skipped: int = 0
+    bytes_saved: int = 0
+    stripped: int = 0
+    timings: dict[str, float] = dataclasses.field(default_factory=dict)
+    failures: dict[str, Exception] = dataclasses.field(default_factory=dict)
+
+
+def consolidate(
+    wheels: Iterable[str],
+    dest: str | None = None,
+    *,
+    against: str | None = None,
+    workdir: str | None = None,
+    target: str = "auto",
+    codesign: list[str] | None = None,
+    libs_wheel: str | None = None,
+    reproducible: bool = False,
+    strip_debug: bool = False,
+    jobs: int | None = None,
+    verify_inputs: bool = False,
+    cache_dir: str | None = None,
+    cache_max_size: int = cache.DEFAULT_MAX_SIZE,
+) -> ConsolidationResult:
+    """Consolidate wheels without going through the command line tool.
+
+    Options are the same of the command line tool, ``wheels`` can be
+    wheel files, directories containing them or glob patterns,
+    ``target`` chooses the platform backend and ``codesign``
+    is the signing command as a list of arguments.
+    ``cache_max_size`` is in bytes.
+
+    Progress is logged to the ``consolidatewheels`` logger,
+    nothing is printed.
+
+    Raises ``RuntimeError`` or ``ValueError`` when the wheels
+    can't be consolidated at all, while groups of wheels that
+    fail are reported in ``ConsolidationResult.failures``.
+    """
+    if target not in ("auto",) + main.TARGETS:
+        raise ValueError(f"Unsupported target {target}")
+    if libs_wheel is not None and against is not None:
+        raise ValueError("libs_wheel can't be used together with against")
+    opts = main.normalize_options(
+        argparse.Namespace(
+            wheels=list(wheels),
+            dest=dest,
+            against=against,
+            workdir=workdir,
+            target=target,
+            codesign=codesign,
+            libs_wheel=libs_wheel,
+            reproducible=reproducible,
+            strip_debug=strip_debug,
+            jobs=jobs,
+            verify_inputs=verify_inputs,
+            cache_dir=cache_dir,
+            cache_max_size=cache_max_size,
+        )
+    )
+    report = main.consolidate_wheels(opts)
+
+    result = ConsolidationResult(
+        outputs=list(report["passed"]),
+        failures=report["failures"],
+        timings=report["timings"],
+    )
+    for group, group_result in report["results"].items():
+        result.outputs.extend(group_result["outputs"])
+        result.mangling_map[group] = group_result.get("mangling_map", {})
+        result.providers[group] = group_result["providers"]
+        result.removed.extend(group_result.get("removed", []))
+        result.patched += group_result.get("patched", 0)
+        result.patched_files.extend(group_result.get("patched_files", []))
+        result.skipped += group_result.get("skipped", 0)
+        result.bytes_saved += group_result.get("bytes_saved", 0)
+        result.stripped += group_result.get("stripped", 0)
+    return result
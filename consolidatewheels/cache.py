@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import os
+import shutil
+from typing import Callable
+
+from .workspace import file_sha256, link_tree, make_workdir
+
+# Size the cache is reduced to at the end of each run, unless told otherwise.
+DEFAULT_MAX_SIZE = 5 * 1024**3
+
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+
+def default_cache_dir() -> str:
+    """Where unpacked wheels are cached when no directory is provided."""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "consolidatewheels")
+
+
+def parse_size(size: str) -> int:
+    """Parse a size in bytes like ``500M`` or ``5G``, units are powers of 1024."""
+    value = size.strip().upper().rstrip("B")
+    unit = value[-1:] if value[-1:] in SIZE_UNITS else ""
+    try:
+        return int(float(value[: len(value) - len(unit)]) * SIZE_UNITS[unit])
+    except ValueError:
+        raise ValueError(f"Invalid size {size}") from None
+
+
+def unpack_cached(
+    wheel: str, workdir: str, cachedir: str, unpack: Callable[[str, str], str]
+) -> str:
+    """Unpack a wheel in ``workdir`` reusing its content from the cache.
+
+    The wheel is unpacked in the cache by ``cached_tree`` and its
+    directory is then linked from there with ``link_tree``,
+    so its files have to be detached before patching them.
+
+    Returns the path of the unpacked wheel, like ``unpack`` does.
+    """
+    cached_wheeldir = cached_tree(wheel, cachedir, unpack)
+    wheeldir = os.path.join(workdir, os.path.basename(cached_wheeldir))
+    link_tree(cached_wheeldir, wheeldir)
+    return wheeldir
+
+
+def cached_tree(wheel: str, cachedir: str, unpack: Callable[[str, str], str]) -> str:
+    """The directory where a wheel is unpacked in the cache.
+
+    Unpacked wheels are cached in ``cachedir`` by the SHA-256 of the wheel,
+    and ``unpack(wheel, directory)`` is only invoked when the wheel is not
+    there yet. Using a cached wheel makes it the most recently used one.
+    """
+    treesdir = os.path.join(cachedir, "trees")
+    tree = os.path.join(treesdir, file_sha256(wheel))
+    if not os.path.isdir(tree):
+        os.makedirs(treesdir, exist_ok=True)
+        with make_workdir(cachedir, prefix="pending-") as tmpdir:
+            unpack(wheel, tmpdir)
+            try:
+                os.rename(tmpdir, tree)
+                # The workdir must still exist when its context exits.
+                os.mkdir(tmpdir)
+            except OSError:
+                if not os.path.isdir(tree):
+                    raise
+                # Another process cached the same wheel in the meantime.
+    os.utime(tree)
+
+    (namever,) = os.listdir(tree)
+    return os.path.join(tree, namever)
+
+
+def prune(cachedir: str, max_size: int = DEFAULT_MAX_SIZE) -> tuple[int, int]:
+    """Evict the least recently used wheels until the cache fits in ``max_size``.
+
+    Returns how many unpacked wheels were evicted and the bytes freed.
+    """
+    treesdir = os.path.join(cachedir, "trees")
+    try:
+        digests = os.listdir(treesdir)
+    except FileNotFoundError:
+        return 0, 0
+
+    trees = []
+    for digest in digests:
+        tree = os.path.join(treesdir, digest)
+        trees.append((os.stat(tree).st_mtime, _tree_size(tree), tree))
+    total_size = sum(size for _, size, _ in trees)
+
+    evicted = freed = 0
+    for _, size, tree in sorted(trees):
+        if total_size - freed <= max_size:
+            break
+        shutil.rmtree(tree)
+        evicted += 1
+        freed += size
+    return evicted, freed
+
+
+def _tree_size(tree: str) -> int:
+    return sum(
+        os.lstat(os.path.join(root, filename)).st_size
+        for root, _, filenames in os.walk(tree)
+        for filename in filenames
+    )
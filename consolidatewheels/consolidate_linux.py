@@ -1,14 +1,35 @@
 from __future__ import annotations
 
+import collections
+import filecmp
+import functools
+import logging
 import os
 import pathlib
-import subprocess
-import tempfile
+from typing import Iterator
 
-from .wheelsfunc import packwheels, unpackwheels
+from . import dedupe, elf
+from .manifest import find_providers, write_markers
+from .runner import ToolError, run_tools
+from .wheelsfunc import find_libs_wheeldir, patch_and_pack, unpack_and_scan
+from .workspace import detach_file, make_workdir
 
+logger = logging.getLogger(__name__)
 
-def consolidate(wheels: list[str], destdir: str) -> None:
+# Files that patchelf has to lay out again to rename their dependencies
+RELAYOUT = "relayout"
+
+
+def consolidate(
+    wheels: list[str],
+    destdir: str,
+    against: dict | None = None,
+    workdir: str | None = None,
+    libs_wheel: str | None = None,
+    reproducible: bool = False,
+    cachedir: str | None = None,
+    strip: bool = False,
+) -> dict:
     """Consolidate shared objects references within multiple wheels.
 
     Given a list of wheels, makes sure that they all share the
@@ -16,18 +37,152 @@ def consolidate(wheels: list[str], destdir: str) -> None:
     already included in the wheel itself.
 
     The resulting new wheels are written into ``destdir``.
+
+    When ``against`` is provided, it is the manifest of a previous
+    consolidation and the wheels are patched to match its mangling.
+
+    Wheels are unpacked and staged in a temporary directory inside
+    ``workdir``, which defaults to ``destdir`` so that the resulting
+    wheels can be moved to their destination without copying them.
+    ``reproducible`` is passed to ``packwheels``, ``cachedir``
+    to ``unpack_and_scan`` and ``strip`` to ``patch_wheeldirs``.
+
+    ``libs_wheel`` is the prefix of the wheel providing the libraries
+    when they were moved into one by ``dedupe``.
+
+    Libraries embedded by more than one wheel are preserved only in
+    one of them, chosen by ``dedupe.delete_duplicate_libs``, and the
+    other wheels are patched to use that copy. Libraries are named
+    by ``demangle_libname`` and copies that are not ``compatible_copies``
+    of each other are reported as an error.
+
+    The dependencies of each wheel are read as soon as it's unpacked
+    and each wheel is packed as soon as it's patched, only computing
+    the mangling waits for all the wheels to be unpacked.
+
+    Returns the details that have to be recorded in the manifest.
     """
     wheels = [os.path.abspath(w) for w in wheels]
-    with tempfile.TemporaryDirectory() as tmpcd:
-        print(f"Consolidate, Working inside {tmpcd}")
-        wheeldirs = unpackwheels(wheels, workdir=tmpcd)
+    with make_workdir(workdir or destdir) as tmpcd:
+        logger.info(f"Consolidate, Working inside {tmpcd}")
+        unpacked = unpack_and_scan(
+            wheels, tmpcd, scan=_scan_wheeldir, cachedir=cachedir
+        )
+        wheeldirs = [wheeldir for wheeldir, _ in unpacked]
+        dependencies = {}  # type: dict[str, list[str]]
+        dependency_tree = {}  # type: dict[str, list[str]]
+        for wheeldir, scanned in unpacked:
+            wheel_dependencies, requirements = scanned or ({}, [])
+            dependencies.update(wheel_dependencies)
+            distname = os.path.basename(wheeldir).split("-", 1)[0]
+            dependency_tree[distname] = requirements
+        deleted = {"removed": [], "bytes_saved": 0}  # type: dict
+        if find_duplicates(wheeldirs):
+            deleted = dedupe.delete_duplicate_libs(
+                wheeldirs,
+                mangled=True,
+                dependencies=dependency_tree,
+                compatible=compatible_copies,
+                demangle=demangle_libname,
+            )
         mangling_map = buildlibmap(wheeldirs)
-        print(f"Applying consistent mangling: {mangling_map}")
-        patch_wheeldirs(wheeldirs, mangling_map)
-        packwheels(wheeldirs, destdir)
+        patch_map = {}
+        if against is not None:
+            locked_map = against.get("mangling_map", {})
+            patch_map = lock_mangling(wheeldirs, locked_map)
+            mangling_map.update(locked_map)
+        logger.info(f"Applying consistent mangling: {mangling_map}")
+        libs_wheeldir = None
+        if libs_wheel is not None:
+            libs_wheeldir = find_libs_wheeldir(wheeldirs, libs_wheel)
+        providers = find_providers(wheeldirs)
+        write_markers(wheeldirs, {"mangling_map": mangling_map})
+        packed = patch_and_pack(
+            wheeldirs,
+            destdir,
+            patch=functools.partial(
+                _patch_wheeldir,
+                mangling_map={**mangling_map, **patch_map},
+                libs_wheeldir=libs_wheeldir,
+                dependencies=dependencies,
+                strip=strip,
+            ),
+            workdir=tmpcd,
+            reproducible=reproducible,
+        )
+        patched = collections.Counter()  # type: collections.Counter[str]
+        patched_files = []
+        for _, wheel_patched in packed:
+            patched_files.extend(wheel_patched.pop("patched_files"))  # type: ignore
+            patched.update(wheel_patched)
+    return {
+        "mangling_map": mangling_map,
+        "providers": providers,
+        "outputs": [wheel for wheel, _ in packed],
+        "patched": patched["patched"],
+        "patched_files": sorted(patched_files),
+        "skipped": patched["skipped"],
+        "stripped": patched["stripped"],
+        "removed": deleted["removed"],
+        "bytes_saved": deleted["bytes_saved"],
+    }
+
+
+def read_dependencies(wheeldir: str) -> dict[str, list[str]]:
+    """The libraries each shared object of a wheel directory depends on.
+
+    Files that are not ELF files have no dependencies.
+    """
+    dependencies = {}
+    for libpath in _shared_objects(wheeldir):
+        try:
+            dependencies[str(libpath)] = elf.needed_libraries(libpath)
+        except elf.ELFError:
+            dependencies[str(libpath)] = []
+    return dependencies
 
 
-def patch_wheeldirs(wheeldirs: list[str], mangling_map: dict[str, str]):
+def lock_mangling(wheeldirs: list[str], locked_map: dict[str, str]) -> dict[str, str]:
+    """Rename embedded libraries to the mangling recorded in a manifest.
+
+    Libraries that were rebuilt usually get a new mangling hash,
+    but wheels that were previously consolidated refer to the old one.
+    This renames the libraries back to their locked name and
+    returns the mapping that has to be applied to wheels depending on them.
+    """
+    renames = {}
+    renamed_libs = []
+    for wheeldir in wheeldirs:
+        for libpath in _shared_objects(wheeldir, "*.libs/"):
+            locked_name = locked_map.get(demangle_libname(libpath.name))
+            if locked_name is None or locked_name == libpath.name:
+                continue
+            logger.info(f"Renaming {libpath} to {locked_name} to match the manifest")
+            renamed_lib = libpath.with_name(locked_name)
+            libpath.rename(renamed_lib)
+            detach_file(renamed_lib)
+            renames[libpath.name] = locked_name
+            renamed_libs.append(renamed_lib)
+
+    try:
+        run_tools(
+            ["patchelf", "--set-soname", renamed_lib.name, renamed_lib]
+            for renamed_lib in renamed_libs
+        )
+    except ToolError as err:
+        raise RuntimeError(
+            f"Unable to set soname of {renamed_libs[err.index]}"
+        ) from err
+    return renames
+
+
+def patch_wheeldirs(
+    wheeldirs: list[str],
+    mangling_map: dict[str, str],
+    libs_wheeldir: str | None = None,
+    dependencies: dict[str, list[str]] | None = None,
+    strip: bool = False,
+) -> dict:
     """Provided a mapping of mangled library names, apply the manglign to all wheels.
 
     This traverses the content of all provided wheel directories
@@ -35,40 +190,164 @@ def patch_wheeldirs(wheeldirs: list[str], mangling_map: dict[str, str]):
     so that they look for the mangled version of the library instead of
     the unmangled one.
 
-    This will do nothing on files that already use the mangled version,
-    or that don't depend on the library. For that, we rely on patchelf
-    ignoring missing entries as we just invoke patchelf on everything.
+    The dependencies of each file are read first, unless they were
+    already read by ``read_dependencies`` and provided as ``dependencies``,
+    and only the files that depend on libraries of the mangling map
+    are patched, only for those libraries. Files that already use the mangled version,
+    that don't depend on any of the libraries or that are not ELF
+    files at all are skipped.
+
+    Dependencies are looked up in the mangling map both by their name and
+    by their demangled name, so that references to a copy of the library
+    that was removed by dedupe point to the one that was preserved.
+
+    ``libs_wheeldir`` is the wheel the libraries were moved to by
+    ``dedupe.make_libs_wheel``, files of the other wheels that
+    depend on its libraries get their RPATH extended to point to it.
+
+    Dependencies are renamed in process by ``elf.replace_needed`` when
+    the new names fit in the string table of the file, which preserves
+    its layout. Otherwise, or when the RPATH has to be changed too,
+    the file is relaid out by patchelf: all the replacements for a file
+    are applied by a single patchelf invocation and those files
+    are patched concurrently. The strategy used for each file is reported.
+
+    When ``strip`` is set, the debug sections of all the ELF files
+    are removed by ``elf.strip_debug``, while they are patched in process
+    or before they are relaid out, and the bytes saved are reported for each wheel.
+
+    Returns how many files were patched, which ones relative to
+    the unpacked wheels, how many were skipped and the bytes saved
+    by stripping them.
     """
+    libs_wheel_dirs = {}  # type: dict[str, pathlib.Path]
+    if libs_wheeldir is not None:
+        for libpath in _shared_objects(libs_wheeldir, "*.libs/"):
+            libs_wheel_dirs[
+                demangle_libname(libpath.name)
+            ] = libpath.parent.relative_to(libs_wheeldir)
+
+    libs_to_patch = []
+    patched_files = []
+    replacements = []
+    rpaths = []
+    skipped = 0
+    total_stripped = 0
+    strategies = {elf.IN_PLACE: 0, elf.REUSED_SPACE: 0, RELAYOUT: 0}
     for wheeldir in wheeldirs:
-        for lib_to_patch_path in pathlib.Path(wheeldir).rglob("*.so"):
+        stripped = 0
+        for lib_to_patch_path in _shared_objects(wheeldir):
             lib_to_patch = str(lib_to_patch_path)
-            print(f"Patching {lib_to_patch}")
-            for lib_to_mangle, lib_mangled_name in mangling_map.items():
-                print(f"  {lib_to_mangle} -> {lib_mangled_name}")
-                if _invoke_patchelf(
-                    lib_to_mangle,
-                    lib_mangled_name,
-                    lib_to_patch,
-                ):
-                    raise RuntimeError(
-                        f"Unable to apply mangling to {lib_to_patch}, "
-                        f"{lib_to_mangle}->{lib_mangled_name}"
+            needed = (dependencies or {}).get(lib_to_patch)
+            if needed is None:
+                try:
+                    needed = elf.needed_libraries(lib_to_patch)
+                except elf.ELFError:
+                    needed = []
+            lib_replacements = {}
+            for lib_to_mangle in needed:
+                lib_mangled_name = mangling_map.get(
+                    lib_to_mangle, mangling_map.get(demangle_libname(lib_to_mangle))
+                )
+                if lib_mangled_name is not None and lib_mangled_name != lib_to_mangle:
+                    lib_replacements[lib_to_mangle] = lib_mangled_name
+            lib_rpaths = []
+            if wheeldir != libs_wheeldir:
+                origin = lib_to_patch_path.parent.relative_to(wheeldir)
+                lib_rpaths = sorted(
+                    {
+                        "$ORIGIN/" + os.path.relpath(libdir, origin)
+                        for libdir in (
+                            libs_wheel_dirs.get(demangle_libname(lib)) for lib in needed
+                        )
+                        if libdir is not None
+                    }
+                )
+            if not lib_replacements and not lib_rpaths:
+                skipped += 1
+                if strip:
+                    detach_file(lib_to_patch)
+                    stripped += _strip_debug(lib_to_patch)
+                continue
+            detach_file(lib_to_patch)
+            size = os.path.getsize(lib_to_patch)
+            strategy = RELAYOUT
+            if not lib_rpaths:
+                try:
+                    strategy = elf.replace_needed(
+                        lib_to_patch, lib_replacements, strip=strip
                     )
+                except elf.ELFError:
+                    pass
+            if strip and strategy == RELAYOUT:
+                _strip_debug(lib_to_patch)
+            stripped += size - os.path.getsize(lib_to_patch)
+            logger.info(f"Patching {lib_to_patch} ({strategy})")
+            for lib_to_mangle, lib_mangled_name in lib_replacements.items():
+                logger.info(f"  {lib_to_mangle} -> {lib_mangled_name}")
+            for rpath in lib_rpaths:
+                logger.info(f"  RPATH += {rpath}")
+            strategies[strategy] += 1
+            patched_files.append(
+                os.path.relpath(lib_to_patch, os.path.dirname(wheeldir))
+            )
+            if strategy == RELAYOUT:
+                libs_to_patch.append(lib_to_patch)
+                replacements.append(lib_replacements)
+                rpaths.append(lib_rpaths)
+        if strip:
+            logger.info(
+                f"Stripped debug sections of {wheeldir}, {stripped} bytes saved"
+            )
+        total_stripped += stripped
 
-
-def _invoke_patchelf(
-    lib_to_mangle: str, lib_mangled_name: str, lib_to_patch: str
-) -> int:
-    """Just a simple wrapper to subprocess.call to ease testing."""
-    return subprocess.call(
-        [
-            "patchelf",
-            "--replace-needed",
-            lib_to_mangle,
-            lib_mangled_name,
-            lib_to_patch,
-        ]
+    patched = sum(strategies.values())
+    logger.info(
+        f"Patched {patched} libraries "
+        f"({', '.join(f'{count} {name}' for name, count in strategies.items())}), "
+        f"skipped {skipped}"
     )
+    try:
+        run_tools(
+            [
+                "patchelf",
+                *(
+                    arg
+                    for lib_to_mangle, lib_mangled_name in lib_replacements.items()
+                    for arg in ("--replace-needed", lib_to_mangle, lib_mangled_name)
+                ),
+                *(arg for rpath in lib_rpaths for arg in ("--add-rpath", rpath)),
+                lib_to_patch,
+            ]
+            for lib_to_patch, lib_replacements, lib_rpaths in zip(
+                libs_to_patch, replacements, rpaths
+            )
+        )
+    except ToolError as err:
+        applied_mangling = ", ".join(
+            f"{k}->{v}" for k, v in replacements[err.index].items()
+        )
+        raise RuntimeError(
+            f"Unable to apply mangling to {libs_to_patch[err.index]}, "
+            f"{applied_mangling}"
+        ) from err
+    return {
+        "patched": patched,
+        "patched_files": sorted(patched_files),
+        "skipped": skipped,
+        "stripped": total_stripped,
+    }
+
+
+def _strip_debug(libpath: str) -> int:
+    try:
+        return elf.strip_debug(libpath)
+    except elf.ELFError:
+        return 0
+
+
+def _patch_wheeldir(wheeldir: str, **kwargs) -> dict:
+    return patch_wheeldirs([wheeldir], **kwargs)
 
 
 def buildlibmap(wheeldirs: list[str]) -> dict[str, str]:
@@ -79,13 +358,14 @@ def buildlibmap(wheeldirs: list[str]) -> dict[str, str]:
     build a mapping of how they should be mangled.
 
     Report an error if the same directory has multiple possible mangling,
-    this will usually signal that --exclude was forgotten for one or
+    ``consolidate`` removes the compatible duplicates before, so this
+    signals that --exclude was forgotten for one or
     more libraries when invoking auditwheel.
     """
     seen_shared_objects = {}  # type: dict[str, str]
     all_shared_objects = {}  # type: dict[str, str]
     for wheeldir in wheeldirs:
-        for libpath in pathlib.Path(wheeldir).rglob("*.libs/*.so"):
+        for libpath in _shared_objects(wheeldir, "*.libs/"):
             demangled_lib = demangle_libname(libpath.name)
             if demangled_lib in all_shared_objects:
                 seen_shared_object = seen_shared_objects[demangled_lib]
@@ -99,7 +379,70 @@ def buildlibmap(wheeldirs: list[str]) -> dict[str, str]:
     return all_shared_objects
 
 
+def find_duplicates(wheeldirs: list[str]) -> dict[str, list[str]]:
+    """Libraries embedded by auditwheel in more than one of the wheels.
+
+    Returns the directories of the wheels embedding each of them,
+    by demangled name.
+    """
+    embedded_by = {}  # type: dict[str, list[str]]
+    for wheeldir in wheeldirs:
+        for libname in {
+            demangle_libname(libpath.name)
+            for libpath in _shared_objects(wheeldir, "*.libs/")
+        }:
+            embedded_by.setdefault(libname, []).append(wheeldir)
+    duplicates = {
+        libname: libwheeldirs
+        for libname, libwheeldirs in embedded_by.items()
+        if len(libwheeldirs) > 1
+    }
+    for libname, libwheeldirs in sorted(duplicates.items()):
+        logger.info(f"Library {libname} is embedded by {', '.join(libwheeldirs)}")
+    return duplicates
+
+
 def demangle_libname(libfilename):
-    mangled_libname, extension = os.path.splitext(libfilename)
+    mangled_libname, extension, version = libfilename.partition(".so")
     demangled_libname = mangled_libname.rsplit("-", 1)[0]
-    return f"{demangled_libname}{extension}"
+    return f"{demangled_libname}{extension}{version}"
+
+
+def compatible_copies(lib: pathlib.Path, other: pathlib.Path) -> bool:
+    """Whether a copy of a library embedded by auditwheel can replace another one.
+
+    That is the case when they are identical, or when they have
+    the same SONAME once demangled, as the SONAME changes
+    with every incompatible version of a library, and ``lib``
+    defines all the symbol versions that ``other`` defines,
+    as builds of the same version of a library made with different
+    toolchains can provide different symbols.
+    """
+    if filecmp.cmp(lib, other, shallow=False):
+        return True
+    try:
+        sonames = [elf.soname(lib), elf.soname(other)]
+        versions = [elf.version_definitions(lib), elf.version_definitions(other)]
+    except elf.ELFError:
+        return False
+    if None in sonames:
+        return False
+    return (
+        demangle_libname(sonames[0]) == demangle_libname(sonames[1])
+        and versions[0] >= versions[1]
+    )
+
+
+def _scan_wheeldir(wheeldir: str) -> tuple[dict[str, list[str]], list[str]]:
+    """The dependencies of the shared objects and the requirements of a wheel."""
+    return read_dependencies(wheeldir), dedupe.read_requirements(wheeldir)
+
+
+def _shared_objects(directory: str, pattern: str = "") -> Iterator[pathlib.Path]:
+    """Shared objects in ``directory``, versioned ones included.
+
+    ``pattern`` restricts the directories they are searched in.
+    """
+    for libpath in pathlib.Path(directory).rglob(f"{pattern}*.so*"):
+        if elf.is_shared_object(libpath.name):
+            yield libpath
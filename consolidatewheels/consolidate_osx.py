@@ -1,12 +1,22 @@
 from __future__ import annotations
 
+import functools
+import hashlib
+import logging
 import os
 import pathlib
+import posixpath
 import secrets
-import subprocess
-import tempfile
+import shutil
+from typing import Iterable, Sequence
 
-from .wheelsfunc import packwheels, unpackwheels
+from . import macho
+from .manifest import file_sha256, find_providers, locked_providers, write_markers
+from .runner import run_tools
+from .wheelsfunc import find_libs_wheeldir, patch_and_pack, unpack_and_scan
+from .workspace import detach_file, make_workdir
+
+logger = logging.getLogger(__name__)
 
 # macOS install_name_tool rewrites dependency/load-id strings in-place.
 # To reduce overflow errors we keep this replacement path very short,
@@ -14,8 +24,21 @@ from .wheelsfunc import packwheels, unpackwheels
 CONSOLIDATED_LIB_PREFIX = "/!"
 CONSOLIDATED_ID_BYTES = 8
 
+# Command used to sign again libraries after they were patched,
+# the path of the library is appended to it.
+DEFAULT_CODESIGN = ("codesign", "--force", "-s", "-")
+
 
-def consolidate(wheels: list[str], destdir: str) -> None:
+def consolidate(
+    wheels: list[str],
+    destdir: str,
+    against: dict | None = None,
+    workdir: str | None = None,
+    codesign: Sequence[str] = DEFAULT_CODESIGN,
+    libs_wheel: str | None = None,
+    reproducible: bool = False,
+    cachedir: str | None = None,
+) -> dict:
     """Consolidate shared objects references within multiple wheels.
 
     Given a list of wheels, makes sure that they all share the
@@ -23,23 +46,112 @@ def consolidate(wheels: list[str], destdir: str) -> None:
     already included in the wheel itself.
 
     The resulting new wheels are written into ``destdir``.
+
+    When ``against`` is provided, it is the manifest of a previous
+    consolidation and the wheels reuse its identifier and refer
+    to the libraries provided by the wheels recorded there.
+
+    Wheels are unpacked and staged in a temporary directory inside
+    ``workdir``, which defaults to ``destdir`` so that the resulting
+    wheels can be moved to their destination without copying them.
+    ``cachedir`` is passed to ``unpack_and_scan``.
+
+    When ``reproducible`` is set, the identifier is derived from the
+    content of the wheels instead of being random, and the wheels
+    are packed reproducibly, see ``packwheels``.
+
+    ``codesign`` is the command used to sign the patched libraries,
+    no signing happens when it's empty.
+
+    ``libs_wheel`` is the prefix of the wheel providing the libraries
+    when they were moved into one by ``dedupe``.
+
+    The dependencies of each wheel are read as soon as it's unpacked
+    and each wheel is packed as soon as its libraries are patched,
+    only planning the changes waits for all the wheels to be unpacked.
+
+    Returns the details that have to be recorded in the manifest.
     """
     wheels = [os.path.abspath(w) for w in wheels]
-    with tempfile.TemporaryDirectory() as tmpcd:
-        print(f"Consolidate, Working inside {tmpcd}")
-        wheeldirs = unpackwheels(wheels, workdir=tmpcd)
-        consolidated_id = secrets.token_hex(CONSOLIDATED_ID_BYTES)
-        print(f"Applying consistent references: {consolidated_id}")
-        patch_wheeldirs(wheeldirs, consolidated_id)
-        packwheels(wheeldirs, destdir)
+    with make_workdir(workdir or destdir) as tmpcd:
+        logger.info(f"Consolidate, Working inside {tmpcd}")
+        unpacked = unpack_and_scan(
+            wheels, tmpcd, scan=read_dependencies, cachedir=cachedir
+        )
+        wheeldirs = [wheeldir for wheeldir, _ in unpacked]
+        dependencies = {
+            libpath: libdependencies
+            for _, wheel_dependencies in unpacked
+            for libpath, libdependencies in (wheel_dependencies or {}).items()
+        }
+        if against is not None:
+            consolidated_id = against["consolidated_id"]
+        elif reproducible:
+            consolidated_id = content_id(wheels)
+        else:
+            consolidated_id = secrets.token_hex(CONSOLIDATED_ID_BYTES)
+        logger.info(f"Applying consistent references: {consolidated_id}")
+        libs_wheeldir = None
+        if libs_wheel is not None:
+            libs_wheeldir = find_libs_wheeldir(wheeldirs, libs_wheel)
+        changes, skipped = plan_changes(
+            wheeldirs,
+            consolidated_id,
+            provided=locked_providers(against, wheels),
+            libs_wheeldir=libs_wheeldir,
+            dependencies=dependencies,
+        )
+        providers = find_providers(wheeldirs)
+        write_markers(wheeldirs, {"consolidated_id": consolidated_id})
+        packed = patch_and_pack(
+            wheeldirs,
+            destdir,
+            patch=functools.partial(
+                _apply_wheeldir_changes, changes=changes, codesign=codesign
+            ),
+            workdir=tmpcd,
+            reproducible=reproducible,
+        )
+        patched_files = sorted(os.path.relpath(libpath, tmpcd) for libpath in changes)
+    logger.info(f"Patched {len(changes)} libraries, skipped {skipped}")
+    return {
+        "consolidated_id": consolidated_id,
+        "providers": providers,
+        "outputs": [wheel for wheel, _ in packed],
+        "patched": len(changes),
+        "patched_files": patched_files,
+        "skipped": skipped,
+    }
 
 
-def patch_wheeldirs(wheeldirs: list[str], consolidated_id: str) -> None:
-    """Apply same identifier and path to all libraries in wheel directories.
+def content_id(wheels: list[str]) -> str:
+    """Identifier derived from the content of a set of wheels.
+
+    The order of the wheels doesn't matter, the identifier
+    has the same length of the random ones.
+    """
+    digests = sorted(file_sha256(wheel) for wheel in wheels)
+    digest = hashlib.sha256("".join(digests).encode("ascii")).hexdigest()
+    return digest[: CONSOLIDATED_ID_BYTES * 2]
 
-    Given multiple directiories of unpacked wheels, ensure that all shared
-    objects in those directories do have the same identifier and path
-    so that they can be shared across the wheels.
+
+def read_dependencies(wheeldir: str) -> dict[pathlib.Path, dict[str, str]]:
+    """The dependencies of each library of a wheel directory.
+
+    See ``get_library_dependencies``.
+    """
+    libpaths = list(pathlib.Path(wheeldir).rglob("*.so"))
+    return dict(zip(libpaths, get_library_dependencies(libpaths)))
+
+
+def plan_changes(
+    wheeldirs: list[str],
+    consolidated_id: str,
+    provided: Iterable[str] = (),
+    libs_wheeldir: str | None = None,
+    dependencies: dict[pathlib.Path, dict[str, str]] | None = None,
+) -> tuple[dict[pathlib.Path, dict], int]:
+    """Compute the identifier and dependencies to change in each library.
 
     ``consolidate_id`` is the unique prefix that has to be applied to
     library identifiers to distinguish them other versions of the same
@@ -47,10 +159,46 @@ def patch_wheeldirs(wheeldirs: list[str], consolidated_id: str) -> None:
 
     It takes for granted that each shared object appears only once,
     so dedupe must have been applied before.
+
+    ``provided`` are the names of libraries that other, already
+    consolidated, wheels provide. Those will be referenced by identifier.
+
+    ``libs_wheeldir`` is the wheel the libraries were moved to by
+    ``dedupe.make_libs_wheel``, its libraries are referenced by their
+    path relative to the loader instead.
+
+    The dependencies of the libraries are inspected, unless they were
+    already read by ``read_dependencies`` and provided as ``dependencies``.
+
+    Returns the changes for each library that has to be patched
+    and how many libraries need no change and can be skipped.
     """
-    patched_identifier = {}
-    seen_dependencies = set()
-    for wheeldir in wheeldirs:
+    libs_to_patch = [
+        list(pathlib.Path(wheeldir).rglob("*.so")) for wheeldir in wheeldirs
+    ]
+    dependencies = dict(dependencies or {})
+    missing = [
+        libpath
+        for wheellibs in libs_to_patch
+        for libpath in wheellibs
+        if libpath not in dependencies
+    ]
+    if missing:
+        dependencies.update(zip(missing, get_library_dependencies(missing)))
+
+    patched_identifier = {
+        libname: os.path.join(f"{CONSOLIDATED_LIB_PREFIX}{consolidated_id}", libname)
+        for libname in provided
+    }
+    libs_wheel_paths = {}  # type: dict[str, str]
+    if libs_wheeldir is not None:
+        libs_wheel_paths = {
+            libpath.name: libpath.relative_to(libs_wheeldir).as_posix()
+            for libpath in pathlib.Path(libs_wheeldir).rglob(".dylibs/*")
+        }
+    seen_dependencies = set(provided)
+    changes = {}  # type: dict[pathlib.Path, dict]
+    for wheeldir, wheellibs in zip(wheeldirs, libs_to_patch):
         for lib_to_patch_path in pathlib.Path(wheeldir).rglob(".dylibs/*"):
             libname = lib_to_patch_path.name
             if libname not in patched_identifier:
@@ -61,59 +209,142 @@ def patch_wheeldirs(wheeldirs: list[str], consolidated_id: str) -> None:
                     f"{CONSOLIDATED_LIB_PREFIX}{consolidated_id}",
                     libname,
                 )
-                update_library_id(lib_to_patch_path, libid)
-                resign_library(lib_to_patch_path)
+                _lib_changes(changes, lib_to_patch_path)["id"] = libid
 
         seen_in_wheel = set()
-        for lib_to_patch_path in pathlib.Path(wheeldir).rglob("*.so"):
-            dependencies = get_library_dependencies(lib_to_patch_path)
-            for dependency, dependency_path in dependencies.items():
+        for lib_to_patch_path in wheellibs:
+            for dependency, dependency_path in dependencies[lib_to_patch_path].items():
                 seen_in_wheel.add(dependency)
+                if dependency in libs_wheel_paths:
+                    loader_path = _loader_path(
+                        lib_to_patch_path.relative_to(wheeldir),
+                        libs_wheel_paths[dependency],
+                    )
+                    if loader_path != dependency_path:
+                        _lib_changes(changes, lib_to_patch_path)["changes"][
+                            dependency_path
+                        ] = loader_path
+                    continue
                 if dependency not in seen_dependencies:
                     # This library is seen for the first time,
                     # so we don't want to patch it, so it can load from its path.
                     continue
-                update_dependency_path(
-                    lib_to_patch_path, dependency_path, patched_identifier[dependency]
-                )
-            resign_library(lib_to_patch_path)
+                _lib_changes(changes, lib_to_patch_path)["changes"][
+                    dependency_path
+                ] = patched_identifier[dependency]
         seen_dependencies |= seen_in_wheel
 
+    inspected = {libpath for wheellibs in libs_to_patch for libpath in wheellibs}
+    inspected.update(
+        libpath
+        for wheeldir in wheeldirs
+        for libpath in pathlib.Path(wheeldir).rglob(".dylibs/*")
+    )
+    return changes, len(inspected - set(changes))
+
 
-def update_library_id(libpath: str | pathlib.Path, libid: str) -> int:
-    """Run install_name_tool to set the identifier of a library"""
-    return subprocess.call(["install_name_tool", libpath, "-id", libid])
+def apply_changes(
+    changes: dict[pathlib.Path, dict], codesign: Sequence[str] = DEFAULT_CODESIGN
+) -> None:
+    """Apply the changes computed by ``plan_changes`` to the libraries.
 
+    All the changes to a library are applied by a single
+    ``install_name_tool`` invocation, and then the library is signed again
+    with the ``codesign`` command, no signing happens when it's empty.
+    Libraries are patched concurrently. When the Apple tools are not
+    available, like on Linux, libraries are patched in process.
+    """
+    libs_to_update = list(changes)
+    for libpath in libs_to_update:
+        detach_file(libpath)
+    if _apple_tools_available():
+        run_tools(
+            ["install_name_tool", *_install_name_tool_args(changes[libpath]), libpath]
+            for libpath in libs_to_update
+        )
+    else:
+        for libpath in libs_to_update:
+            try:
+                macho.change_install_names(
+                    libpath, changes[libpath]["id"], changes[libpath]["changes"]
+                )
+            except macho.MachOError as err:
+                raise RuntimeError(f"Unable to patch {libpath}: {err}") from err
 
-def update_dependency_path(
-    libpath: str | pathlib.Path,
-    deppath: str | pathlib.Path,
-    newdeppath: str | pathlib.Path,
-) -> int:
-    """Replace the path of a dependency of a library with a new one."""
-    return subprocess.call(
-        ["install_name_tool", libpath, "-change", deppath, newdeppath]
+    if codesign:
+        # Signing again the libraries is required for them to be loadable
+        # after their identifier or dependencies changed.
+        run_tools([*codesign, libpath] for libpath in libs_to_update)
+
+
+def get_library_dependencies(
+    libpaths: list[pathlib.Path],
+) -> list[dict[str, str]]:
+    """Return the dependencies of each one of the target libraries"""
+    if not _apple_tools_available():
+        return [
+            _delocated_dependencies(macho.get_dependencies(libpath))
+            for libpath in libpaths
+        ]
+
+    results = run_tools(
+        (["otool", "-X", "-L", libpath] for libpath in libpaths), check=False
     )
+    return [_parse_otool_output(result.stdout) for result in results]
 
 
-def resign_library(libpath: str | pathlib.Path) -> int:
-    """Sign again the library for it to be loadable.
+def _apply_wheeldir_changes(
+    wheeldir: str, changes: dict[pathlib.Path, dict], codesign: Sequence[str]
+) -> None:
+    """Apply the changes of the libraries that are part of ``wheeldir``."""
+    wheelpath = pathlib.Path(wheeldir)
+    apply_changes(
+        {
+            libpath: lib_changes
+            for libpath, lib_changes in changes.items()
+            if wheelpath in libpath.parents
+        },
+        codesign,
+    )
 
-    This is required after ``update_library_id`` or ``update_dependency_path``
-    """
-    return subprocess.call(["codesign", "--force", "-s", "-", libpath])
+
+def _apple_tools_available() -> bool:
+    return bool(shutil.which("install_name_tool") and shutil.which("otool"))
+
+
+def _lib_changes(changes: dict[pathlib.Path, dict], libpath: pathlib.Path) -> dict:
+    return changes.setdefault(libpath, {"id": None, "changes": {}})
+
+
+def _loader_path(libpath: pathlib.Path, dependency: str) -> str:
+    """Reference to ``dependency`` relative to ``libpath``, both in the same tree."""
+    relpath = posixpath.relpath(dependency, libpath.parent.as_posix())
+    return f"@loader_path/{relpath}"
+
+
+def _install_name_tool_args(lib_changes: dict) -> list[str]:
+    args = []
+    if lib_changes["id"] is not None:
+        args.extend(["-id", lib_changes["id"]])
+    for old_name, new_name in lib_changes["changes"].items():
+        args.extend(["-change", old_name, new_name])
+    return args
+
+
+def _parse_otool_output(output: bytes) -> dict[str, str]:
+    return _delocated_dependencies(
+        line.split(maxsplit=1)[0]
+        for line in output.decode("utf-8").splitlines()
+        if line.strip()
+    )
 
 
-def get_library_dependencies(libpath: str | pathlib.Path) -> dict[str, str]:
-    """Return the list of dependencies of a target library"""
-    out = subprocess.run(["otool", "-X", "-L", libpath], capture_output=True)
+def _delocated_dependencies(dependencies: Iterable[str]) -> dict[str, str]:
     libpaths = {}
-    for line in out.stdout.decode("utf-8").splitlines():
-        line = line.strip()
-        if not line.startswith("@loader_path"):
+    for dependency in dependencies:
+        if not dependency.startswith("@loader_path"):
             # Libs included by delocate will all be relative to the loader
             continue
-        dependency, _ = line.split(maxsplit=1)
         libname = os.path.basename(dependency)
         libpaths[libname] = dependency
     return libpaths
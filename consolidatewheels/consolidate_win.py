@@ -1,15 +1,28 @@
 from __future__ import annotations
 
+import collections
+import functools
+import logging
 import os
 import pathlib
-import tempfile
 
 import pefile
 
-from .wheelsfunc import packwheels, unpackwheels
+from .manifest import find_providers, write_markers
+from .wheelsfunc import patch_and_pack, unpack_and_scan
+from .workspace import detach_file, make_workdir, write_atomic
 
+logger = logging.getLogger(__name__)
 
-def consolidate(wheels: list[str], destdir: str) -> None:
+
+def consolidate(
+    wheels: list[str],
+    destdir: str,
+    against: dict | None = None,
+    workdir: str | None = None,
+    reproducible: bool = False,
+    cachedir: str | None = None,
+) -> dict:
     """Consolidate shared objects references within multiple wheels.
 
     Given a list of wheels, makes sure that they all share the
@@ -17,18 +30,104 @@ def consolidate(wheels: list[str], destdir: str) -> None:
     already included in the wheel itself.
 
     The resulting new wheels are written into ``destdir``.
+
+    When ``against`` is provided, it is the manifest of a previous
+    consolidation and the wheels are patched to match its mangling.
+
+    Wheels are unpacked and staged in a temporary directory inside
+    ``workdir``, which defaults to ``destdir`` so that the resulting
+    wheels can be moved to their destination without copying them.
+    ``reproducible`` is passed to ``packwheels`` and ``cachedir``
+    to ``unpack_and_scan``.
+
+    The imports of each wheel are read as soon as it's unpacked
+    and each wheel is packed as soon as it's patched, only computing
+    the mangling waits for all the wheels to be unpacked.
+
+    Returns the details that have to be recorded in the manifest.
     """
     wheels = [os.path.abspath(w) for w in wheels]
-    with tempfile.TemporaryDirectory() as tmpcd:
-        print(f"Consolidate, Working inside {tmpcd}")
-        wheeldirs = unpackwheels(wheels, workdir=tmpcd)
+    with make_workdir(workdir or destdir) as tmpcd:
+        logger.info(f"Consolidate, Working inside {tmpcd}")
+        unpacked = unpack_and_scan(wheels, tmpcd, scan=read_imports, cachedir=cachedir)
+        wheeldirs = [wheeldir for wheeldir, _ in unpacked]
+        imports = {
+            libpath: dll_imports
+            for _, wheel_imports in unpacked
+            for libpath, dll_imports in (wheel_imports or {}).items()
+        }
+        if against is not None:
+            lock_mangling(wheeldirs, against.get("mangling_map", {}))
         mangling_map = buildlibmap(wheeldirs)
-        print(f"Applying consistent mangling: {mangling_map}")
-        patch_wheeldirs(wheeldirs, mangling_map)
-        packwheels(wheeldirs, destdir)
+        if against is not None:
+            mangling_map = {**against.get("mangling_map", {}), **mangling_map}
+        logger.info(f"Applying consistent mangling: {mangling_map}")
+        providers = find_providers(wheeldirs)
+        write_markers(wheeldirs, {"mangling_map": mangling_map})
+        packed = patch_and_pack(
+            wheeldirs,
+            destdir,
+            patch=functools.partial(
+                _patch_wheeldir, mangling_map=mangling_map, imports=imports
+            ),
+            workdir=tmpcd,
+            reproducible=reproducible,
+        )
+        patched = collections.Counter()  # type: collections.Counter[str]
+        patched_files = []
+        for _, wheel_patched in packed:
+            patched_files.extend(wheel_patched.pop("patched_files"))  # type: ignore
+            patched.update(wheel_patched)
+    return {
+        "mangling_map": mangling_map,
+        "providers": providers,
+        "outputs": [wheel for wheel, _ in packed],
+        "patched": patched["patched"],
+        "patched_files": sorted(patched_files),
+        "skipped": patched["skipped"],
+    }
+
+
+def read_imports(wheeldir: str) -> dict[str, list[str]]:
+    """The DLLs each library of a wheel directory imports."""
+    return {
+        str(libpath): _get_dll_imports(str(libpath))
+        for libpath in pathlib.Path(wheeldir).rglob("*.dll")
+    }
+
+
+def lock_mangling(wheeldirs: list[str], locked_map: dict[str, str]) -> None:
+    """Rename embedded DLLs to the mangling recorded in a manifest.
+
+    Libraries that were rebuilt usually get a new mangling hash,
+    but wheels that were previously consolidated refer to the old one.
+    The load-order files generated by delvewheel are updated accordingly.
+    """
+    for wheeldir in wheeldirs:
+        for libpath in pathlib.Path(wheeldir).rglob("*.libs/*.dll"):
+            locked_name = locked_map.get(demangle_libname(libpath.name))
+            if locked_name is None or locked_name == libpath.name:
+                continue
+            logger.info(f"Renaming {libpath} to {locked_name} to match the manifest")
+            libpath.rename(libpath.with_name(locked_name))
+            for load_order in libpath.parent.glob(".load-order-*"):
+                with open(load_order, newline="") as load_order_f:
+                    embedded_libs = load_order_f.readlines()
+                content = "".join(
+                    embedded_lib.replace(libpath.name, locked_name)
+                    if embedded_lib.strip() == libpath.name
+                    else embedded_lib
+                    for embedded_lib in embedded_libs
+                )
+                # Replaced as a whole, which also detaches it from the cache.
+                write_atomic(str(load_order), content.encode("utf-8"))
 
 
-def patch_wheeldirs(wheeldirs: list[str], mangling_map: dict[str, str]):
+def patch_wheeldirs(
+    wheeldirs: list[str],
+    mangling_map: dict[str, str],
+    imports: dict[str, list[str]] | None = None,
+) -> dict:
     """Provided a mapping of mangled library names, apply the manglign to all wheels.
 
     This traverses the content of all provided wheel directories
@@ -36,21 +135,40 @@ def patch_wheeldirs(wheeldirs: list[str], mangling_map: dict[str, str]):
     so that they look for the mangled version of the library instead of
     the unmangled one.
 
+    The imports of each library are read first, unless they were
+    already read by ``read_imports`` and provided as ``imports``,
+    and libraries that don't import any library of the mangling map,
+    or that already import the mangled names, are skipped.
+
     Not that this takes for granted that all libraries were mangled by
     delvewheel and deduped by the dedupe step.
+
+    Returns how many files were patched, which ones relative to
+    the unpacked wheels, and how many were skipped.
     """
+    patched = skipped = 0
+    patched_files = []
     for wheeldir in wheeldirs:
         for lib_to_patch_path in pathlib.Path(wheeldir).rglob("*.dll"):
             lib_to_patch = str(lib_to_patch_path)
-            print(f"Patching {lib_to_patch}")
-            imports = _get_dll_imports(lib_to_patch)
-            for lib_to_replace in imports:
+            lib_replacements = {}
+            dll_imports = (imports or {}).get(lib_to_patch)
+            if dll_imports is None:
+                dll_imports = _get_dll_imports(lib_to_patch)
+            for lib_to_replace in dll_imports:
                 demangled_libname = demangle_libname(lib_to_replace)
                 updated_libname = mangling_map.get(demangled_libname)
-                if updated_libname is None:
-                    # Library wasn't embedded into the wheel
+                if updated_libname is None or updated_libname == lib_to_replace:
+                    # Library wasn't embedded into the wheel or is already mangled
                     continue
-                print(f"  {lib_to_replace} -> {updated_libname}")
+                lib_replacements[lib_to_replace] = updated_libname
+            if not lib_replacements:
+                skipped += 1
+                continue
+
+            logger.info(f"Patching {lib_to_patch}")
+            for lib_to_replace, updated_libname in lib_replacements.items():
+                logger.info(f"  {lib_to_replace} -> {updated_libname}")
                 if not _patch_dll(
                     lib_to_replace,
                     updated_libname,
@@ -60,34 +178,74 @@ def patch_wheeldirs(wheeldirs: list[str], mangling_map: dict[str, str]):
                         f"Unable to apply mangling to {lib_to_patch}, "
                         f"{lib_to_replace}->{updated_libname}"
                     )
+            patched += 1
+            patched_files.append(
+                os.path.relpath(lib_to_patch, os.path.dirname(wheeldir))
+            )
+
+    logger.info(f"Patched {patched} libraries, skipped {skipped}")
+    return {
+        "patched": patched,
+        "patched_files": sorted(patched_files),
+        "skipped": skipped,
+    }
+
+
+def _patch_wheeldir(wheeldir: str, **kwargs) -> dict:
+    return patch_wheeldirs([wheeldir], **kwargs)
 
 
 def _get_dll_imports(lib_to_patch: str) -> list[str]:
     """Provide all DLLs used by a library"""
     imports = []
-    with pefile.PE(lib_to_patch) as dlllib:
-        for entry in dlllib.DIRECTORY_ENTRY_IMPORT:
+    with _load_dll_imports(lib_to_patch) as dlllib:
+        for entry in getattr(dlllib, "DIRECTORY_ENTRY_IMPORT", []):
             imports.append(entry.dll.decode("utf-8"))
     return imports
 
 
 def _patch_dll(lib_to_replace: str, lib_replacement: str, lib_to_patch: str) -> bool:
-    """Patch lib_to_patch replacing the name of a dependency."""
-    dlllib = pefile.PE(lib_to_patch)
-    for entry in dlllib.DIRECTORY_ENTRY_IMPORT:
-        if entry.dll.decode("utf-8") == lib_to_replace:
-            if not dlllib.set_bytes_at_rva(
-                entry.struct.Name, lib_replacement.encode("ascii") + b"\0"
-            ):
-                return False
-    dlllib.merge_modified_section_data()
-    # Unclear how well PE behaves when closing it before writing it back
-    # but if we don't close it, we get an error that the file is already in use.
-    dlllib.close()
-    dlllib.write(lib_to_patch)
+    """Patch lib_to_patch replacing the name of a dependency.
+
+    The name is replaced in place, so the replacement must not be
+    longer than the original name. That is the case for the names mangled
+    by delvewheel, as they only differ by the hash. Only the name itself
+    is written back, the library is never loaded in memory as a whole.
+    """
+    replacement = lib_replacement.encode("ascii") + b"\0"
+    if len(replacement) > len(lib_to_replace.encode("ascii")) + 1:
+        return False
+
+    offsets = []
+    with _load_dll_imports(lib_to_patch) as dlllib:
+        for entry in getattr(dlllib, "DIRECTORY_ENTRY_IMPORT", []):
+            if entry.dll.decode("utf-8") == lib_to_replace:
+                try:
+                    offsets.append(dlllib.get_offset_from_rva(entry.struct.Name))
+                except pefile.PEFormatError:
+                    return False
+
+    detach_file(lib_to_patch)
+    with open(lib_to_patch, "r+b") as dllfile:
+        for offset in offsets:
+            dllfile.seek(offset)
+            dllfile.write(replacement)
     return True
 
 
+def _load_dll_imports(lib_to_patch: str) -> pefile.PE:
+    """Parse only the imports directory of a library.
+
+    pefile maps the file in memory instead of reading it,
+    and parsing only the imports avoids scanning the whole library.
+    """
+    dlllib = pefile.PE(lib_to_patch, fast_load=True)
+    dlllib.parse_data_directories(
+        directories=[pefile.DIRECTORY_ENTRY["IMAGE_DIRECTORY_ENTRY_IMPORT"]]
+    )
+    return dlllib
+
+
 def buildlibmap(wheeldirs: list[str]) -> dict[str, str]:
     """Compute how libraries embedded by delvewheel should be mangled.
 
@@ -1,34 +1,86 @@
 from __future__ import annotations
 
-import itertools
+import collections
+import email.parser
+import functools
+import logging
 import os
 import pathlib
-import tempfile
+from typing import Callable, Iterable
 
-import pkginfo
-from packaging.requirements import Requirement
+from . import elf, wheelsfunc, workspace
 
-from . import wheelsfunc
+logger = logging.getLogger(__name__)
 
 
-def dedupe(wheels: list[str], destdir: str, mangled: bool = False) -> list[str]:
+def dedupe(
+    wheels: list[str],
+    destdir: str,
+    mangled: bool = False,
+    provided: Iterable[str] = (),
+    workdir: str | None = None,
+    libs_wheel: str | None = None,
+    reproducible: bool = False,
+    compatible: Callable[[pathlib.Path, pathlib.Path], bool] | None = None,
+    cachedir: str | None = None,
+    demangle: Callable[[str], str] | None = None,
+) -> dict:
     """Given a list of wheels remove duplicated libraries
 
     This searches .dylibs embedded by delocate for libraries
     that have been included multiple times across the wheels
     and will preserve only one of the copies.
+
+    ``provided`` are names of libraries that are already provided
+    by other wheels, all copies of those will be removed.
+
+    The copy that is preserved is chosen according to how the
+    wheels depend on each other, see ``delete_duplicate_libs``.
+
+    When ``libs_wheel`` is provided, all the embedded libraries that
+    remain are moved into a new wheel named after it, see ``make_libs_wheel``,
+    which is the first of the output wheels.
+
+    Wheels are unpacked in a temporary directory inside ``workdir``,
+    which defaults to ``destdir``. ``reproducible`` is passed to ``packwheels``
+    and ``cachedir`` to ``unpack_and_scan``.
+    The requirements of each wheel are read as soon as it's unpacked.
+
+    ``compatible`` checks that the removed copies of a library can be
+    replaced by the preserved one and ``demangle`` tells the name of
+    a library from its file name, see ``delete_duplicate_libs``.
+
+    Returns the paths of the output wheels, along with
+    what ``delete_duplicate_libs`` removed.
     """
     wheels = [os.path.abspath(w) for w in wheels]
-    distributions, dependency_tree = build_dependencies_tree(wheels)
-    sorted_distributions = sort_dependencies(dependency_tree)
-    wheels = [distributions[distname] for distname in sorted_distributions]
-    print(wheels)
-    with tempfile.TemporaryDirectory() as tmpcd:
-        print(f"Dedupe, Working inside {tmpcd}")
-        wheeldirs = wheelsfunc.unpackwheels(wheels, workdir=tmpcd)
-        delete_duplicate_libs(wheeldirs, mangled)
-        wheels = wheelsfunc.packwheels(wheeldirs, destdir)
-    return wheels
+    with workspace.make_workdir(workdir or destdir) as tmpcd:
+        logger.info(f"Dedupe, Working inside {tmpcd}")
+        unpacked = wheelsfunc.unpack_and_scan(
+            wheels, tmpcd, scan=read_requirements, cachedir=cachedir
+        )
+        distributions = {}
+        dependency_tree = {}  # type: dict[str, list[str]]
+        for wheel, (wheeldir, requirements) in zip(wheels, unpacked):
+            distname = os.path.basename(wheel).split("-", 1)[0]
+            distributions[distname] = wheeldir
+            dependency_tree[distname] = requirements or []
+        sorted_distributions = sort_dependencies(dependency_tree)
+        logger.info(f"Dedupe, Dependencies order: {', '.join(sorted_distributions)}")
+        wheeldirs = [distributions[distname] for distname in sorted_distributions]
+        deleted = delete_duplicate_libs(
+            wheeldirs, mangled, provided, dependency_tree, compatible, demangle
+        )
+        if libs_wheel is not None:
+            libs_wheeldir = make_libs_wheel(
+                wheeldirs, libs_wheel, mangled, tmpcd, compatible, demangle
+            )
+            if libs_wheeldir is not None:
+                wheeldirs.insert(0, libs_wheeldir)
+        wheels = wheelsfunc.packwheels(
+            wheeldirs, destdir, workdir=tmpcd, reproducible=reproducible
+        )
+    return {"outputs": wheels, **deleted}
 
 
 def build_dependencies_tree(
@@ -40,6 +92,8 @@ def build_dependencies_tree(
     containing the mapping of each wheel distribution to the wheel name.
     The second entry is a mapping of each wheel to its own dependencies.
     """
+    import pkginfo
+
     deptree = {}  # type: dict[str, list[str]]
     name2file = {}
 
@@ -49,57 +103,90 @@ def build_dependencies_tree(
         dependencies = deptree[distribution_name] = []
 
         metadata = pkginfo.get_metadata(wheel_fname)
-        print("METADATA", wheel_fname, metadata, metadata.requires_dist)
-        deps = metadata.requires_dist
-        for req_str in deps:
-            req = Requirement(req_str)
-            if req.marker is None:
-                # unconditional dependency, track it.
-                dependencies.append(req.name)
-                continue
+        logger.info(f"METADATA {wheel_fname} {metadata} {metadata.requires_dist}")
+        dependencies.extend(_unconditional_requirements(metadata.requires_dist))
 
     return name2file, deptree
 
 
+def read_requirements(wheeldir: str) -> list[str]:
+    """Names of the distributions an unpacked wheel always depends on.
+
+    This is the equivalent of ``build_dependencies_tree``
+    for a single wheel, once it was unpacked.
+    """
+    metadata_path = os.path.join(
+        wheeldir, wheelsfunc.find_dist_info(wheeldir), "METADATA"
+    )
+    with open(metadata_path, encoding="utf-8") as metadata_f:
+        metadata = email.parser.Parser().parse(metadata_f, headersonly=True)
+    return _unconditional_requirements(metadata.get_all("Requires-Dist", []))
+
+
+def _unconditional_requirements(requires_dist: Iterable[str]) -> list[str]:
+    from packaging.requirements import Requirement
+
+    dependencies = []
+    for req_str in requires_dist:
+        req = Requirement(req_str)
+        if req.marker is None:
+            # unconditional dependency, track it.
+            dependencies.append(req.name)
+    return dependencies
+
+
 def sort_dependencies(deptree: dict[str, list[str]]) -> list[str]:
     """Given a wheels dependency tree, sort wheels based on their dependencies.
 
     This sorts the output of ``build_dependencies_tree`` so that wheels
     that have no dependencies on other wheels are first, and then
     dependants come subsequently
-    """
-    result = []
-    tracked_deps = set(deptree.keys())
-    while deptree:
-        for dname, dreqs in list(deptree.items()):
-            if not dreqs:
-                # No dependencies at all, order won't matter.
-                result.append(dname)
-                deptree.pop(dname)
-                continue
 
-            dreqs_set = set(dreqs)
-            if not dreqs_set & tracked_deps:
-                # There are no dependencies that we have to consolidate
-                # the order won't matter
-                result.append(dname)
-                deptree.pop(dname)
-                continue
+    It takes linear time in the number of wheels and dependencies.
+    Wheels that depend on each other in a cycle are placed last,
+    in the order they were provided.
+    """
+    tracked_deps = set(deptree)
+    missing = {}  # type: dict[str, int]
+    dependants = {}  # type: dict[str, list[str]]
+    for dname, dreqs in deptree.items():
+        # Dependencies that we don't have to consolidate don't matter.
+        dreqs_set = set(dreqs) & tracked_deps
+        missing[dname] = len(dreqs_set)
+        for dreq in dreqs_set:
+            dependants.setdefault(dreq, []).append(dname)
 
-            if dreqs_set & set(result) == dreqs_set:
+    ready = collections.deque(dname for dname, count in missing.items() if not count)
+    result = []
+    while ready:
+        dname = ready.popleft()
+        result.append(dname)
+        for dependant in dependants.get(dname, []):
+            missing[dependant] -= 1
+            if not missing[dependant]:
                 # All dependencies were already added to the list
                 # we can now insert this node
-                result.append(dname)
-                deptree.pop(dname)
-                continue
+                ready.append(dependant)
+
+    if len(result) < len(deptree):
+        cyclic = [dname for dname in deptree if missing[dname]]
+        logger.info(f"Wheels depending on each other in a cycle: {', '.join(cyclic)}")
+        result.extend(cyclic)
     return result
 
 
-def delete_duplicate_libs(wheeldirs: list[str], mangled: bool) -> None:
+def delete_duplicate_libs(
+    wheeldirs: list[str],
+    mangled: bool,
+    provided: Iterable[str] = (),
+    dependencies: dict[str, list[str]] | None = None,
+    compatible: Callable[[pathlib.Path, pathlib.Path], bool] | None = None,
+    demangle: Callable[[str], str] | None = None,
+) -> dict:
     """Given directories of unpacked wheels, preserve one copy of embedded libs.
 
     Deletes embedded libraries if they are provided by multiple wheels,
-    only the first encountered lib is preserved.
+    only one copy of each library is preserved.
 
     mangled=True tries to make this work for mangled lib names.
     This takes for granted that libraries have been mangled with
@@ -110,34 +197,373 @@ def delete_duplicate_libs(wheeldirs: list[str], mangled: bool) -> None:
     and thus this works correctly. Auditwheel currently seems to work
     because it retains the same marshaling hash across libraries,
     but usage of ``--exclude`` should be preferred over deduping the libs.
+    ``demangle`` replaces that naming convention when it's provided,
+    like ``consolidate_linux.demangle_libname`` does for auditwheel,
+    which keeps the SONAME version after the hash.
+
+    Copies are only looked for among libraries embedded the same way,
+    in ``.dylibs`` by delocate or by auditwheel and delvewheel, and
+    libraries embedded by the same wheel are never copies of each other,
+    see ``_library_keys``.
+
+    Libraries in ``provided`` are considered as already seen.
+
+    ``dependencies`` is the dependency tree of the wheels, as returned
+    by ``build_dependencies_tree``. The copy of a library that is
+    preserved is the one in the lowest common dependency of all the
+    wheels embedding it, so that whatever subset of the wheels is
+    installed the library is available. When no wheel is a dependency
+    of all the others, the one saving the most bytes is chosen, see
+    ``_choose_provider``, and the wheels that don't depend on it are
+    reported as they only work when installed along with it.
+    Without dependencies, the first encountered copy is preserved.
+
+    ``compatible(preserved, copy)`` tells if a copy of a library can be
+    replaced by the preserved one. When it can't, a ``ValueError``
+    is raised, as the wheels need different versions of the library.
+    By default all copies are assumed to be the same library.
+
+    Each wheel directory is walked only once, and the load-order files
+    generated by delvewheel are rewritten once per wheel with all the
+    libraries that were removed from it.
+
+    Returns where each duplicated library was placed, the removed
+    copies, relative to the directory containing the wheel directories,
+    and how many bytes were saved removing them.
     """
-    already_seen = set()
+    libname_of = demangle or functools.partial(_libname, mangled=mangled)
+    already_provided = {libname_of(lib) for lib in provided}
+    closure = _transitive_dependencies(dependencies or {})
 
+    embedded = []  # type: list[tuple[str, pathlib.Path]]
+    relpaths = {}  # type: dict[pathlib.Path, str]
+    load_orders = []
     for wheeldir in wheeldirs:
-        print("Processing", wheeldir)
-        for lib in itertools.chain(
-            pathlib.Path(wheeldir).rglob(".dylibs/*"),
-            pathlib.Path(wheeldir).rglob("*.libs/*.so"),
-            pathlib.Path(wheeldir).rglob("*.dll"),
-        ):
-            if mangled:
-                libname = lib.name.split("-", 1)[0]
-            else:
-                libname = lib.name
-            if libname in already_seen:
-                print(
-                    f"Removing {lib.name} in {wheeldir} "
-                    "as already provided by another wheel."
+        logger.info(f"Processing {wheeldir}")
+        libs, wheel_load_orders = _index_wheeldir(wheeldir)
+        load_orders.extend(wheel_load_orders)
+        distname = os.path.basename(wheeldir).split("-", 1)[0]
+        for lib in libs:
+            embedded.append((distname, lib))
+            relpaths[lib] = os.path.relpath(lib, os.path.dirname(wheeldir))
+
+    copies = {}  # type: dict[tuple[bool, str], list[tuple[str, pathlib.Path]]]
+    keys = _library_keys([lib for _, lib in embedded], libname_of)
+    for key, (distname, lib) in zip(keys, embedded):
+        copies.setdefault(key, []).append((distname, lib))
+
+    placement = {}
+    bytes_saved = 0
+    removed = {}  # type: dict[str, set[str]]
+    removed_paths = []
+    for (_, libname), libcopies in copies.items():
+        sizes = {}  # type: dict[str, int]
+        for distname, lib in libcopies:
+            sizes.setdefault(distname, lib.stat().st_size)
+        if libname in already_provided:
+            provider = None
+        elif len(sizes) == 1:
+            continue
+        else:
+            provider, unreachable = _choose_provider(sizes, closure)
+            placement[libname] = provider
+            if unreachable:
+                logger.warning(
+                    f"Warning: {', '.join(unreachable)} don't depend on "
+                    f"{provider}, they need it installed to load {libname}"
                 )
-                lib.unlink()
-
-                # On Windows we also have to remove the entry from
-                # load-order generated by delvewheel
-                for load_order in pathlib.Path(lib.parent).rglob(".load-order-*"):
-                    with load_order.open() as load_order_f:
-                        embedded_libs = load_order_f.readlines()
-                    with load_order.open("w") as load_order_f:
-                        for embedded_lib in embedded_libs:
-                            if embedded_lib.strip() != lib.name:
-                                load_order_f.write(embedded_lib)
-            already_seen.add(libname)
+
+        preserved = next(
+            (lib for distname, lib in libcopies if distname == provider), None
+        )
+        for distname, lib in libcopies:
+            if preserved is not None and distname == provider:
+                continue
+            if preserved is not None:
+                _check_compatible(libname, preserved, lib, compatible)
+            logger.info(
+                f"Removing {lib.name} in {lib.parent} "
+                "as already provided by another wheel."
+            )
+            bytes_saved += lib.stat().st_size
+            lib.unlink()
+            removed.setdefault(str(lib.parent), set()).add(lib.name)
+            removed_paths.append(relpaths[lib])
+
+    _update_load_orders(load_orders, removed)
+    for libname, provider in placement.items():
+        logger.info(f"Placed {libname} in {provider}")
+    logger.info(f"Removed duplicated libraries, saved {bytes_saved} bytes")
+    return {
+        "placement": placement,
+        "removed": sorted(removed_paths),
+        "bytes_saved": bytes_saved,
+    }
+
+
+def make_libs_wheel(
+    wheeldirs: list[str],
+    prefix: str,
+    mangled: bool,
+    workdir: str,
+    compatible: Callable[[pathlib.Path, pathlib.Path], bool] | None = None,
+    demangle: Callable[[str], str] | None = None,
+) -> str | None:
+    """Move all the libraries embedded in ``wheeldirs`` into a new wheel.
+
+    The new wheel is unpacked in ``workdir`` and it's named ``{prefix}_libs``,
+    its version is the highest one of the wheels it provides libraries for.
+    Libraries are placed in ``{prefix}_libs.libs`` or ``{prefix}_libs/.dylibs``,
+    following the layout of the tool that embedded them, only one
+    copy of each library is preserved and the others have to be
+    ``compatible`` with it, libraries are named by ``demangle``
+    like for ``delete_duplicate_libs``.
+
+    The wheels the libraries were moved from are made to depend on the
+    new wheel. Pointing their binaries to the new location is left to the
+    platform ``consolidate`` functions, with the exception of Windows,
+    where the new wheel adds its directory to the DLLs search path.
+
+    Returns the directory of the new wheel,
+    or ``None`` if there were no libraries to move.
+    """
+    from packaging.version import Version
+
+    libname_of = demangle or functools.partial(_libname, mangled=mangled)
+    distname = wheelsfunc.libs_wheel_distname(prefix)
+    moved = {}  # type: dict[tuple[bool, str], pathlib.Path]
+    moved_libs = []
+    consumers = []
+    removed = {}  # type: dict[str, set[str]]
+    load_orders = []
+    embedded = []  # type: list[pathlib.Path]
+    for wheeldir in wheeldirs:
+        libs, wheel_load_orders = _index_wheeldir(wheeldir)
+        load_orders.extend(wheel_load_orders)
+        if libs:
+            consumers.append(wheeldir)
+        embedded.extend(libs)
+    for key, lib in zip(_library_keys(embedded, libname_of), embedded):
+        if key in moved:
+            _check_compatible(key[1], moved[key], lib, compatible)
+            logger.info(
+                f"Removing {lib.name} in {lib.parent} as provided by {distname}"
+            )
+            lib.unlink()
+        else:
+            moved[key] = lib
+            moved_libs.append(lib)
+        removed.setdefault(str(lib.parent), set()).add(lib.name)
+    if not consumers:
+        logger.info(f"No embedded libraries to move into {distname}")
+        return None
+
+    versions = []
+    platforms = set()  # type: set[str]
+    for wheeldir in consumers:
+        dist_info = wheelsfunc.find_dist_info(wheeldir)
+        dist_info_match = wheelsfunc.DIST_INFO_RE.match(dist_info)
+        versions.append(dist_info_match.group("ver"))  # type: ignore
+        with open(os.path.join(wheeldir, dist_info, "WHEEL")) as wheel_f:
+            wheel_info = email.parser.Parser().parse(wheel_f)
+        platforms.update(tag.split("-")[2] for tag in wheel_info.get_all("Tag", []))
+    version = max(versions, key=Version)
+    tags = sorted(f"py3-none-{platform}" for platform in platforms - {"any"})
+
+    libs_wheeldir = os.path.join(workdir, f"{distname}-{version}")
+    for lib in moved_libs:
+        if lib.parent.name == ".dylibs":
+            libdir = os.path.join(libs_wheeldir, distname, ".dylibs")
+        else:
+            libdir = os.path.join(libs_wheeldir, f"{distname}.libs")
+        os.makedirs(libdir, exist_ok=True)
+        logger.info(f"Moving {lib.name} from {lib.parent} to {distname}")
+        workspace.move_file(str(lib), os.path.join(libdir, lib.name))
+    for libdir in removed:
+        if not os.listdir(libdir):
+            os.rmdir(libdir)
+    _update_load_orders(load_orders, removed)
+
+    if any(lib.suffix == ".dll" for lib in moved_libs):
+        # DLLs are looked up by name only, so the directory
+        # has to be in the search path when the interpreter starts.
+        with open(os.path.join(libs_wheeldir, f"{distname}.pth"), "w") as pth_f:
+            pth_f.write(
+                "import os; hasattr(os, 'add_dll_directory') and "
+                f"os.add_dll_directory(os.path.join(sitedir, '{distname}.libs'))\n"
+            )
+
+    dist_info_dir = os.path.join(libs_wheeldir, f"{distname}-{version}.dist-info")
+    os.makedirs(dist_info_dir)
+    with open(os.path.join(dist_info_dir, "METADATA"), "w") as metadata_f:
+        metadata_f.write(
+            "Metadata-Version: 2.1\n"
+            f"Name: {distname}\n"
+            f"Version: {version}\n"
+            "Summary: Shared libraries of "
+            + ", ".join(os.path.basename(c).split("-", 1)[0] for c in consumers)
+            + "\n"
+        )
+    with open(os.path.join(dist_info_dir, "WHEEL"), "w") as wheel_f:
+        wheel_f.write(
+            "Wheel-Version: 1.0\n"
+            "Generator: consolidatewheels\n"
+            "Root-Is-Purelib: false\n" + "".join(f"Tag: {tag}\n" for tag in tags)
+        )
+
+    for wheeldir in consumers:
+        _add_requirement(wheeldir, f"{distname}=={version}")
+    return libs_wheeldir
+
+
+def _add_requirement(wheeldir: str, requirement: str) -> None:
+    """Add a Requires-Dist entry to the metadata of an unpacked wheel."""
+    metadata = os.path.join(wheeldir, wheelsfunc.find_dist_info(wheeldir), "METADATA")
+    with open(metadata, newline="") as metadata_f:
+        content = metadata_f.read()
+    headers, separator, body = content.partition("\n\n")
+    if headers and not headers.endswith("\n"):
+        headers += "\n"
+    content = f"{headers}Requires-Dist: {requirement}\n{separator[1:]}{body}"
+    workspace.write_atomic(metadata, content.encode("utf-8"))
+
+
+def _check_compatible(
+    libname: str,
+    preserved: pathlib.Path,
+    lib: pathlib.Path,
+    compatible: Callable[[pathlib.Path, pathlib.Path], bool] | None,
+) -> None:
+    if compatible is not None and not compatible(preserved, lib):
+        raise ValueError(
+            f"Library {libname} appears multiple times with incompatible copies: "
+            f"{preserved}, {lib}. Did you forget --exclude?"
+        )
+
+
+def _choose_provider(
+    sizes: dict[str, int], closure: dict[str, set[str]]
+) -> tuple[str, list[str]]:
+    """Pick the wheel that should provide a library embedded by multiple wheels.
+
+    ``sizes`` are the wheels embedding the library and the size of their copy.
+    Only the copies of the wheels depending on the provider can be removed
+    without breaking them when they are installed on their own, so the provider
+    is the wheel that saves the most bytes to users installing them: the lowest
+    common dependency of all the wheels, when there is one. Ties are resolved
+    in favour of the smallest copy, then of the first wheel.
+
+    Returns the provider and the wheels that don't depend on it.
+    """
+
+    def dependants(candidate: str) -> list[str]:
+        return [
+            consumer
+            for consumer in sizes
+            if consumer != candidate and candidate in closure.get(consumer, ())
+        ]
+
+    def saved(candidate: str) -> tuple[int, int]:
+        replaced = sum(sizes[consumer] for consumer in dependants(candidate))
+        return replaced, -sizes[candidate]
+
+    provider = max(sizes, key=saved)
+    reachable = {provider, *dependants(provider)}
+    return provider, [consumer for consumer in sizes if consumer not in reachable]
+
+
+def _transitive_dependencies(deptree: dict[str, list[str]]) -> dict[str, set[str]]:
+    """All the direct and indirect dependencies of each wheel in ``deptree``."""
+    closure = {}  # type: dict[str, set[str]]
+    for distname in deptree:
+        seen = set()  # type: set[str]
+        pending = list(deptree[distname])
+        while pending:
+            dependency = pending.pop()
+            if dependency in seen:
+                continue
+            seen.add(dependency)
+            pending.extend(deptree.get(dependency, ()))
+        closure[distname] = seen
+    return closure
+
+
+def _index_wheeldir(wheeldir: str) -> tuple[list[pathlib.Path], list[str]]:
+    """Walk a wheel directory once, finding embedded libraries and load-order files.
+
+    Embedded libraries are the ones in ``.dylibs`` directories (delocate),
+    the shared objects in ``.libs`` directories (auditwheel) and all DLLs.
+    """
+    libs = []
+    load_orders = []
+    for root, dirnames, filenames in os.walk(wheeldir):
+        dirnames.sort()
+        dirname = os.path.basename(root)
+        for filename in sorted(filenames):
+            if filename.startswith(".load-order-"):
+                load_orders.append(os.path.join(root, filename))
+            elif (
+                dirname == ".dylibs"
+                or (dirname.endswith(".libs") and elf.is_shared_object(filename))
+                or filename.endswith(".dll")
+            ):
+                libs.append(pathlib.Path(root, filename))
+    return libs, load_orders
+
+
+def _update_load_orders(load_orders: list[str], removed: dict[str, set[str]]) -> None:
+    """Remove the entries of removed libraries from delvewheel load-order files.
+
+    ``removed`` are the names of the removed libraries for each directory.
+    """
+    for load_order in load_orders:
+        # Libraries removed from any of the directories containing the file.
+        removed_libs = set()  # type: set[str]
+        libdir, parent = load_order, os.path.dirname(load_order)
+        while parent != libdir:
+            libdir, parent = parent, os.path.dirname(parent)
+            removed_libs |= removed.get(libdir, set())
+        if removed_libs:
+            _remove_load_order_entries(load_order, removed_libs)
+
+
+def _remove_load_order_entries(load_order: str, libnames: set[str]) -> None:
+    """Rewrite a delvewheel load-order file without the removed libraries."""
+    with open(load_order, newline="") as load_order_f:
+        embedded_libs = load_order_f.readlines()
+    content = "".join(
+        embedded_lib
+        for embedded_lib in embedded_libs
+        if embedded_lib.strip() not in libnames
+    )
+    workspace.write_atomic(load_order, content.encode("utf-8"))
+
+
+def _library_keys(
+    libs: list[pathlib.Path], libname_of: Callable[[str], str]
+) -> list[tuple[bool, str]]:
+    """How each embedded library is identified when looking for its copies.
+
+    That is whether it was embedded in ``.dylibs`` by delocate, as only
+    libraries embedded the same way can be copies of each other, and its name.
+
+    Libraries with the same name in the same directory are different
+    libraries that the naming convention confused, like ``libxcb``
+    and ``libxcb-render``, so all the libraries with that name
+    are identified by their file name instead.
+    """
+    names = [libname_of(lib.name) for lib in libs]
+    filenames = {}  # type: dict[tuple[pathlib.Path, str], set[str]]
+    for name, lib in zip(names, libs):
+        filenames.setdefault((lib.parent, name), set()).add(lib.name)
+    confused = {name for (_, name), files in filenames.items() if len(files) > 1}
+    return [
+        (lib.parent.name == ".dylibs", lib.name if name in confused else name)
+        for name, lib in zip(names, libs)
+    ]
+
+
+def _libname(filename: str, mangled: bool) -> str:
+    if mangled:
+        return filename.split("-", 1)[0]
+    return filename
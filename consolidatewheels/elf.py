@@ -0,0 +1,532 @@
+from __future__ import annotations
+
+import contextlib
+import os
+import re
+import struct
+
+ELF_MAGIC = b"\x7fELF"
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+
+PT_LOAD = 1
+PT_DYNAMIC = 2
+
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_SYMTAB = 6
+DT_STRSZ = 10
+DT_SONAME = 14
+DT_RPATH = 15
+DT_RUNPATH = 29
+DT_CONFIG = 0x6FFFFEFA
+DT_DEPAUDIT = 0x6FFFFEFB
+DT_AUDIT = 0x6FFFFEFC
+DT_VERDEF = 0x6FFFFFFC
+DT_VERDEFNUM = 0x6FFFFFFD
+DT_VERNEED = 0x6FFFFFFE
+DT_VERNEEDNUM = 0x6FFFFFFF
+DT_AUXILIARY = 0x7FFFFFFD
+DT_FILTER = 0x7FFFFFFF
+# Entries of the dynamic section whose value is a string
+STRING_TAGS = {
+    DT_NEEDED,
+    DT_SONAME,
+    DT_RPATH,
+    DT_RUNPATH,
+    DT_CONFIG,
+    DT_DEPAUDIT,
+    DT_AUDIT,
+    DT_AUXILIARY,
+    DT_FILTER,
+}
+
+# The version definition naming the file itself rather than a version
+VER_FLG_BASE = 0x1
+
+SHT_NOBITS = 8
+SHT_DYNSYM = 11
+SHF_ALLOC = 0x2
+
+SECTION_HEADER_FIELDS = (
+    "name",
+    "type",
+    "flags",
+    "addr",
+    "offset",
+    "size",
+    "link",
+    "info",
+    "addralign",
+    "entsize",
+)
+# Sections only needed by debuggers, and their relocations
+DEBUG_SECTION_PREFIXES = (".debug", ".zdebug", ".rel.debug", ".rela.debug")
+
+# libfoo.so or libfoo.so.1.2
+SHARED_OBJECT_RE = re.compile(r"\.so(\.\d+)*$")
+
+# How replace_needed changed the string table
+IN_PLACE = "in place"
+REUSED_SPACE = "reused space"
+
+
+class ELFError(ValueError):
+    """The file is not an ELF file or it is malformed."""
+
+
+def needed_libraries(path: str | os.PathLike) -> list[str]:
+    """Return the DT_NEEDED entries of an ELF file.
+
+    Only the ELF headers and the dynamic section are read,
+    like the dynamic loader would do. Raises ``ELFError``
+    if the file is not a dynamically linked ELF file.
+    """
+    with open(path, "rb") as f:
+        dynamic = _read_dynamic(f)
+        return [
+            _read_string(f, dynamic["strtab"] + value)
+            for tag, value in dynamic["entries"]
+            if tag == DT_NEEDED
+        ]
+
+
+def soname(path: str | os.PathLike) -> str | None:
+    """Return the DT_SONAME of an ELF file, if it has one."""
+    with open(path, "rb") as f:
+        dynamic = _read_dynamic(f)
+        for tag, value in dynamic["entries"]:
+            if tag == DT_SONAME:
+                return _read_string(f, dynamic["strtab"] + value)
+    return None
+
+
+def version_definitions(path: str | os.PathLike) -> set[str]:
+    """Return the symbol versions an ELF file defines, like ``GOMP_4.0``.
+
+    Libraries that use symbol versioning keep defining the versions
+    of their older releases, so a library can replace another one
+    with the same SONAME only if it defines all of its versions.
+    """
+    versions = set()  # type: set[str]
+    with open(path, "rb") as f:
+        dynamic = _read_dynamic(f)
+        entries = dict(dynamic["entries"])
+        if DT_VERDEF not in entries:
+            return versions
+        endian = dynamic["header"]["endian"]
+        position = _address_to_offset(dynamic["program_headers"], entries[DT_VERDEF])
+        for _ in range(entries.get(DT_VERDEFNUM, 0)):
+            f.seek(position)
+            _, flags, _, count, _, vd_aux, vd_next = struct.unpack(
+                endian + "HHHHIII", f.read(20)
+            )
+            if count and not flags & VER_FLG_BASE:
+                f.seek(position + vd_aux)
+                (vda_name,) = struct.unpack(endian + "I", f.read(4))
+                versions.add(_read_string(f, dynamic["strtab"] + vda_name))
+            position += vd_next
+    return versions
+
+
+def is_shared_object(filename: str) -> bool:
+    """Whether a file name is the one of a shared object, versioned or not."""
+    return SHARED_OBJECT_RE.search(filename) is not None
+
+
+def replace_needed(
+    path: str | os.PathLike, changes: dict[str, str], strip: bool = False
+) -> str:
+    """Rename DT_NEEDED entries of an ELF file without changing its layout.
+
+    This is the equivalent of ``patchelf --replace-needed old new``,
+    but the dynamic string table is never moved or grown. New names
+    are written over the old ones when they fit, otherwise in unused
+    space of the table: the padding at its end and strings nothing
+    refers to anymore. Version requirements of the renamed libraries
+    are updated too, and strings that are shared with other entries
+    or symbols are never overwritten.
+
+    Returns ``IN_PLACE`` when all names were written over the old ones
+    and ``REUSED_SPACE`` when some had to be moved. When the table
+    doesn't have enough space an ``ELFError`` is raised
+    and the file is left untouched.
+
+    When ``strip`` is set, debug sections are removed too,
+    see ``strip_debug``, while the file is open.
+    """
+    with open(path, "r+b") as f:
+        strategy = _replace_needed(f, path, changes)
+        if strip:
+            with contextlib.suppress(ELFError):
+                _strip_debug(f)
+    return strategy
+
+
+def strip_debug(path: str | os.PathLike) -> int:
+    """Remove the content of the debug sections of an ELF file.
+
+    Like ``strip --strip-debug`` the DWARF sections are dropped,
+    but their headers are preserved with no content, so that the
+    indexes of the sections don't change and nothing referring to
+    them has to be updated. The other sections that are not loaded
+    in memory, like the symbols, are moved to fill the space.
+
+    Files are left untouched when their debug sections are not
+    after everything that is loaded in memory, as stripping them
+    would require laying out the file again.
+
+    Returns how many bytes the file shrank.
+    """
+    with open(path, "r+b") as f:
+        return _strip_debug(f)
+
+
+def _replace_needed(f, path: str | os.PathLike, changes: dict[str, str]) -> str:
+    dynamic = _read_dynamic(f)
+    strsz = dict(dynamic["entries"]).get(DT_STRSZ)
+    if strsz is None:
+        raise ELFError("Dynamic section has no string table size")
+    f.seek(dynamic["strtab"])
+    table = bytearray(f.read(strsz))
+
+    movable = {}  # type: dict[int, list[tuple[int, str]]]
+    used = bytearray(len(table))
+    used[0:1] = b"\1"
+    for position, value_format, value, renamable in _string_references(f, dynamic):
+        name = _table_string(table, value)
+        if renamable and name in changes:
+            movable.setdefault(value, []).append((position, value_format))
+        else:
+            _mark_used(used, value, len(name) + 1)
+
+    # Names are read before any of them is written, and the ones
+    # that were not moved yet keep their space reserved, so that
+    # a longer name never overwrites the following ones.
+    names = {value: _table_string(table, value) for value in movable}
+    strategy = IN_PLACE
+    placed = {}  # type: dict[int, int]
+    for value in sorted(movable):
+        reserved = bytearray(used)
+        for pending in movable.keys() - placed.keys() - {value}:
+            _mark_used(reserved, pending, len(names[pending]) + 1)
+        encoded = changes[names[value]].encode("utf-8") + b"\0"
+        new_value = _find_space(reserved, len(encoded), preferred=value)
+        if new_value is None:
+            raise ELFError(f"Not enough space in the string table of {path}")
+        if new_value != value:
+            strategy = REUSED_SPACE
+        _mark_used(used, new_value, len(encoded))
+        end = new_value + len(encoded)
+        table[new_value:end] = encoded
+        placed[value] = new_value
+
+    f.seek(dynamic["strtab"])
+    f.write(table)
+    for value, references in movable.items():
+        for position, value_format in references:
+            f.seek(position)
+            f.write(struct.pack(value_format, placed[value]))
+    return strategy
+
+
+def _strip_debug(f) -> int:
+    header = _read_header(f)
+    sections = _read_section_headers(f, header)
+    if not sections or header["shstrndx"] >= len(sections):
+        return 0
+    shstrtab = sections[header["shstrndx"]]
+    f.seek(shstrtab["offset"])
+    names = bytearray(f.read(shstrtab["size"]))
+    debug = {
+        idx
+        for idx, section in enumerate(sections)
+        if _table_string(names, section["name"]).startswith(DEBUG_SECTION_PREFIXES)
+        and not section["flags"] & SHF_ALLOC
+        and section["type"] != SHT_NOBITS
+        and section["size"]
+    }
+    if not debug:
+        return 0
+
+    # Everything up to the end of the last segment is loaded in memory
+    # and must not move, only what follows it can be laid out again.
+    headers_size = 64 if header["is64"] else 52
+    loaded_end = max(
+        [headers_size, header["phoff"] + header["phnum"] * header["phentsize"]]
+        + [ph["offset"] + ph["filesz"] for ph in _read_program_headers(f, header)]
+    )
+    tail = sorted(
+        (
+            idx
+            for idx, section in enumerate(sections)
+            if section["type"] != SHT_NOBITS
+            and section["size"]
+            and section["offset"] + section["size"] > loaded_end
+        ),
+        key=lambda idx: sections[idx]["offset"],
+    )
+    if any(
+        sections[idx]["offset"] < loaded_end or sections[idx]["flags"] & SHF_ALLOC
+        for idx in tail
+    ) or not debug <= set(tail):
+        return 0
+
+    f.seek(0, os.SEEK_END)
+    original_size = f.tell()
+    position = loaded_end
+    for idx in tail:
+        section = sections[idx]
+        if idx in debug:
+            section.update(offset=position, size=0)
+            continue
+        # Sections are only moved backward, so they never overwrite
+        # the content of the following ones before it's read.
+        position = min(
+            position + -position % max(section["addralign"], 1), section["offset"]
+        )
+        f.seek(section["offset"])
+        data = f.read(section["size"])
+        f.seek(position)
+        f.write(data)
+        section["offset"] = position
+        position += len(data)
+    for section in sections:
+        # Empty sections must not point past the end of the file.
+        section["offset"] = min(section["offset"], position)
+
+    word_size = 8 if header["is64"] else 4
+    shoff = position + -position % word_size
+    f.seek(shoff)
+    for section in sections:
+        f.write(_pack_section_header(header, section))
+    f.truncate()
+    stripped_size = f.tell()
+    # e_shoff follows the identification, type, machine, version,
+    # entry point and program headers offset.
+    f.seek(16 + 8 + 2 * word_size)
+    f.write(struct.pack(header["endian"] + ("Q" if header["is64"] else "I"), shoff))
+    return original_size - stripped_size
+
+
+def _string_references(f, dynamic: dict) -> list[tuple[int, str, int, bool]]:
+    """Everything that refers to the dynamic string table.
+
+    For each reference, this is where its value is stored in the file,
+    how it is encoded, its value and whether it is the name
+    of a needed library and so can be renamed.
+    """
+    header = dynamic["header"]
+    endian = header["endian"]
+    value_format = endian + ("Q" if header["is64"] else "I")
+    entry_size = 16 if header["is64"] else 8
+    references = []
+    for idx, (tag, value) in enumerate(dynamic["entries"]):
+        if tag in STRING_TAGS:
+            position = dynamic["offset"] + idx * entry_size + entry_size // 2
+            references.append((position, value_format, value, tag == DT_NEEDED))
+
+    entries = dict(dynamic["entries"])
+    word_format = endian + "I"
+    if DT_VERNEED in entries:
+        position = _address_to_offset(dynamic["program_headers"], entries[DT_VERNEED])
+        for _ in range(entries.get(DT_VERNEEDNUM, 0)):
+            f.seek(position)
+            _, count, vn_file, vn_aux, vn_next = struct.unpack(
+                endian + "HHIII", f.read(16)
+            )
+            references.append((position + 4, word_format, vn_file, True))
+            aux_position = position + vn_aux
+            for _ in range(count):
+                f.seek(aux_position)
+                _, _, _, vna_name, vna_next = struct.unpack(
+                    endian + "IHHII", f.read(16)
+                )
+                references.append((aux_position + 8, word_format, vna_name, False))
+                aux_position += vna_next
+            position += vn_next
+    if DT_VERDEF in entries:
+        position = _address_to_offset(dynamic["program_headers"], entries[DT_VERDEF])
+        for _ in range(entries.get(DT_VERDEFNUM, 0)):
+            f.seek(position)
+            _, _, _, count, _, vd_aux, vd_next = struct.unpack(
+                endian + "HHHHIII", f.read(20)
+            )
+            aux_position = position + vd_aux
+            for _ in range(count):
+                f.seek(aux_position)
+                vda_name, vda_next = struct.unpack(endian + "II", f.read(8))
+                references.append((aux_position, word_format, vda_name, False))
+                aux_position += vda_next
+            position += vd_next
+    if DT_SYMTAB in entries:
+        # The number of symbols is only known from the section headers.
+        symbols = _read_dynsym(f, header)
+        if symbols is None:
+            raise ELFError("Dynamic symbols can't be located without section headers")
+        offset, size, entsize = symbols
+        f.seek(offset)
+        data = f.read(size)
+        for position in range(0, len(data) - entsize + 1, entsize):
+            (st_name,) = struct.unpack_from(word_format, data, position)
+            references.append((offset + position, word_format, st_name, False))
+    return references
+
+
+def _read_dynsym(f, header: dict) -> tuple[int, int, int] | None:
+    """Offset, size and entry size of the dynamic symbols section."""
+    for section in _read_section_headers(f, header):
+        if section["type"] == SHT_DYNSYM and section["entsize"]:
+            return section["offset"], section["size"], section["entsize"]
+    return None
+
+
+def _read_section_headers(f, header: dict) -> list[dict]:
+    section_format = _section_header_format(header)
+    sections = []
+    for idx in range(header["shnum"] if header["shoff"] else 0):
+        f.seek(header["shoff"] + idx * header["shentsize"])
+        fields = struct.unpack(section_format, f.read(struct.calcsize(section_format)))
+        sections.append(dict(zip(SECTION_HEADER_FIELDS, fields)))
+    return sections
+
+
+def _pack_section_header(header: dict, section: dict) -> bytes:
+    packed = struct.pack(
+        _section_header_format(header),
+        *(section[field] for field in SECTION_HEADER_FIELDS),
+    )
+    return packed.ljust(header["shentsize"], b"\0")
+
+
+def _section_header_format(header: dict) -> str:
+    if header["is64"]:
+        return header["endian"] + "IIQQQQIIQQ"
+    return header["endian"] + "IIIIIIIIII"
+
+
+def _table_string(table: bytearray, offset: int) -> str:
+    if offset >= len(table):
+        raise ELFError(f"String offset {offset:#x} is outside of the string table")
+    end = table.find(b"\0", offset)
+    if end == -1:
+        end = len(table)
+    return table[offset:end].decode("utf-8")
+
+
+def _mark_used(used: bytearray, offset: int, size: int) -> None:
+    end = offset + size
+    used[offset:end] = b"\1" * len(used[offset:end])
+
+
+def _find_space(used: bytearray, size: int, preferred: int) -> int | None:
+    """Offset of ``size`` unused bytes, ``preferred`` if it is available."""
+    end = preferred + size
+    if not any(used[preferred:end]) and end <= len(used):
+        return preferred
+    free = used.find(b"\0" * size)
+    return free if free != -1 else None
+
+
+def _read_header(f) -> dict:
+    f.seek(0)
+    ident = f.read(16)
+    if len(ident) < 16 or ident[:4] != ELF_MAGIC:
+        raise ELFError("Not an ELF file")
+    if ident[4] not in (ELFCLASS32, ELFCLASS64) or ident[5] not in (
+        ELFDATA2LSB,
+        ELFDATA2MSB,
+    ):
+        raise ELFError("Unsupported ELF class or data encoding")
+
+    is64 = ident[4] == ELFCLASS64
+    endian = "<" if ident[5] == ELFDATA2LSB else ">"
+    if is64:
+        fields = struct.unpack(endian + "HHIQQQIHHHHHH", f.read(48))
+    else:
+        fields = struct.unpack(endian + "HHIIIIIHHHHHH", f.read(36))
+    return {
+        "is64": is64,
+        "endian": endian,
+        "phoff": fields[4],
+        "shoff": fields[5],
+        "phentsize": fields[8],
+        "phnum": fields[9],
+        "shentsize": fields[10],
+        "shnum": fields[11],
+        "shstrndx": fields[12],
+    }
+
+
+def _read_program_headers(f, header: dict) -> list[dict]:
+    endian = header["endian"]
+    program_headers = []
+    for idx in range(header["phnum"]):
+        f.seek(header["phoff"] + idx * header["phentsize"])
+        if header["is64"]:
+            ptype, _, offset, vaddr, _, filesz, _, _ = struct.unpack(
+                endian + "IIQQQQQQ", f.read(56)
+            )
+        else:
+            ptype, offset, vaddr, _, filesz, _, _, _ = struct.unpack(
+                endian + "IIIIIIII", f.read(32)
+            )
+        program_headers.append(
+            {"type": ptype, "offset": offset, "vaddr": vaddr, "filesz": filesz}
+        )
+    return program_headers
+
+
+def _read_dynamic(f) -> dict:
+    """Read the entries of the dynamic section and locate its string table."""
+    header = _read_header(f)
+    program_headers = _read_program_headers(f, header)
+    dynamic_segments = [ph for ph in program_headers if ph["type"] == PT_DYNAMIC]
+    if not dynamic_segments:
+        raise ELFError("Not a dynamically linked ELF file")
+
+    entry_format = header["endian"] + ("qQ" if header["is64"] else "iI")
+    entry_size = struct.calcsize(entry_format)
+    f.seek(dynamic_segments[0]["offset"])
+    data = f.read(dynamic_segments[0]["filesz"])
+    entries = []
+    for position in range(0, len(data) - entry_size + 1, entry_size):
+        tag, value = struct.unpack_from(entry_format, data, position)
+        if tag == DT_NULL:
+            break
+        entries.append((tag, value))
+
+    strtab_address = dict(entries).get(DT_STRTAB)
+    if strtab_address is None:
+        raise ELFError("Dynamic section has no string table")
+    return {
+        "header": header,
+        "program_headers": program_headers,
+        "offset": dynamic_segments[0]["offset"],
+        "entries": entries,
+        "strtab": _address_to_offset(program_headers, strtab_address),
+    }
+
+
+def _address_to_offset(program_headers: list[dict], address: int) -> int:
+    for ph in program_headers:
+        if ph["type"] == PT_LOAD and (
+            ph["vaddr"] <= address < ph["vaddr"] + ph["filesz"]
+        ):
+            return address - ph["vaddr"] + ph["offset"]
+    raise ELFError(f"Address {address:#x} is not mapped from the file")
+
+
+def _read_string(f, offset: int) -> str:
+    f.seek(offset)
+    value = b""
+    while True:
+        chunk = f.read(256)
+        end = chunk.find(b"\0")
+        if end != -1 or not chunk:
+            value += chunk if end == -1 else chunk[:end]
+            return value.decode("utf-8")
+        value += chunk
@@ -0,0 +1,218 @@
+from __future__ import annotations
+
+import os
+import struct
+
+MH_MAGIC = 0xFEEDFACE
+MH_MAGIC_64 = 0xFEEDFACF
+FAT_MAGIC = 0xCAFEBABE
+FAT_MAGIC_64 = 0xCAFEBABF
+
+LC_SEGMENT = 0x1
+LC_SEGMENT_64 = 0x19
+LC_ID_DYLIB = 0xD
+LC_LOAD_DYLIB = 0xC
+LC_LOAD_WEAK_DYLIB = 0x80000018
+LC_REEXPORT_DYLIB = 0x8000001F
+LC_LAZY_LOAD_DYLIB = 0x20
+LC_LOAD_UPWARD_DYLIB = 0x80000023
+DEPENDENCY_COMMANDS = {
+    LC_LOAD_DYLIB,
+    LC_LOAD_WEAK_DYLIB,
+    LC_REEXPORT_DYLIB,
+    LC_LAZY_LOAD_DYLIB,
+    LC_LOAD_UPWARD_DYLIB,
+}
+
+# cmd, cmdsize, name offset, timestamp, current and compatibility versions
+DYLIB_COMMAND_SIZE = 24
+
+
+class MachOError(ValueError):
+    """The file is not a Mach-O file or can't be patched."""
+
+
+def get_dependencies(path: str | os.PathLike) -> list[str]:
+    """Return the install names of the libraries a Mach-O file depends on.
+
+    For universal binaries, the dependencies of all architectures are
+    returned without duplicates. Files that are not Mach-O have no dependencies.
+    """
+    dependencies = []  # type: list[str]
+    with open(path, "rb") as f:
+        try:
+            slices = _read_slices(f)
+        except MachOError:
+            return dependencies
+        for offset in slices:
+            header = _read_header(f, offset)
+            for cmd, _, data in _iter_commands(header):
+                if cmd in DEPENDENCY_COMMANDS:
+                    name = _dylib_name(data, header["endian"])
+                    if name not in dependencies:
+                        dependencies.append(name)
+    return dependencies
+
+
+def change_install_names(
+    path: str | os.PathLike,
+    libid: str | None = None,
+    changes: dict[str, str] | None = None,
+) -> None:
+    """Change identifier and dependencies of a Mach-O file in place.
+
+    This is the equivalent of ``install_name_tool -id libid -change old new``.
+    When names get longer, the following load commands are moved into
+    the padding after the headers, and if there isn't enough padding
+    a ``MachOError`` is raised, like install_name_tool would do.
+
+    Only the headers are read and written back, the rest of the file
+    is left untouched. The code signature becomes invalid, so the file
+    has to be signed again.
+    """
+    changes = changes or {}
+    with open(path, "r+b") as f:
+        for offset in _read_slices(f):
+            header = _read_header(f, offset)
+            commands = []
+            for cmd, _, data in _iter_commands(header):
+                if cmd == LC_ID_DYLIB and libid is not None:
+                    data = _dylib_command(data, libid, header)
+                elif cmd in DEPENDENCY_COMMANDS:
+                    name = _dylib_name(data, header["endian"])
+                    if name in changes:
+                        data = _dylib_command(data, changes[name], header)
+                commands.append(data)
+
+            new_commands = b"".join(commands)
+            if header["size"] + len(new_commands) > header["available"]:
+                raise MachOError(
+                    f"Not enough space in {path} headers to change install names, "
+                    "it should be linked with -headerpad_max_install_names"
+                )
+            padding = b"\0" * max(0, len(header["commands"]) - len(new_commands))
+            f.seek(offset + 20)
+            f.write(struct.pack(header["endian"] + "I", len(new_commands)))
+            f.seek(offset + header["size"])
+            f.write(new_commands + padding)
+
+
+def _read_slices(f) -> list[int]:
+    """Offsets of the Mach-O files, multiple ones for universal binaries."""
+    f.seek(0)
+    magic_bytes = f.read(8)
+    if len(magic_bytes) < 8:
+        raise MachOError("Not a Mach-O file")
+    (magic,) = struct.unpack(">I", magic_bytes[:4])
+    if magic in (FAT_MAGIC, FAT_MAGIC_64):
+        (nfat_arch,) = struct.unpack(">I", magic_bytes[4:])
+        if magic == FAT_MAGIC:
+            arch_format, arch_size = ">iiIII", 20
+        else:
+            arch_format, arch_size = ">iiQQII", 32
+        slices = []
+        for _ in range(nfat_arch):
+            arch = struct.unpack(arch_format, f.read(arch_size))
+            slices.append(arch[2])
+        return slices
+
+    (magic,) = struct.unpack("<I", magic_bytes[:4])
+    if magic in (MH_MAGIC, MH_MAGIC_64) or _swap32(magic) in (MH_MAGIC, MH_MAGIC_64):
+        return [0]
+    raise MachOError("Not a Mach-O file")
+
+
+def _read_header(f, offset: int) -> dict:
+    f.seek(offset)
+    (magic,) = struct.unpack("<I", f.read(4))
+    endian = "<"
+    if _swap32(magic) in (MH_MAGIC, MH_MAGIC_64):
+        endian, magic = ">", _swap32(magic)
+    if magic not in (MH_MAGIC, MH_MAGIC_64):
+        raise MachOError("Not a Mach-O file")
+    is64 = magic == MH_MAGIC_64
+    header_size = 32 if is64 else 28
+
+    _, _, _, ncmds, sizeofcmds, _ = struct.unpack(endian + "iiIIII", f.read(24))
+    f.seek(offset + header_size)
+    commands = f.read(sizeofcmds)
+    header = {
+        "endian": endian,
+        "is64": is64,
+        "size": header_size,
+        "ncmds": ncmds,
+        "commands": commands,
+    }
+    header["available"] = _first_section_offset(header)
+    return header
+
+
+def _iter_commands(header: dict):
+    commands = header["commands"]
+    position = 0
+    for _ in range(header["ncmds"]):
+        cmd, cmdsize = struct.unpack_from(header["endian"] + "II", commands, position)
+        if cmdsize < 8 or position + cmdsize > len(commands):
+            raise MachOError("Corrupted load commands")
+        end = position + cmdsize
+        yield cmd, cmdsize, commands[position:end]
+        position = end
+
+
+def _first_section_offset(header: dict) -> int:
+    """The space available for header and load commands.
+
+    Load commands can grow up to where the content of the first section starts.
+    """
+    endian = header["endian"]
+    first_offset = None
+    for cmd, _, data in _iter_commands(header):
+        if cmd == LC_SEGMENT_64:
+            segment_size, section_size, section_format = 72, 80, "16s16sQQI"
+        elif cmd == LC_SEGMENT:
+            segment_size, section_size, section_format = 56, 68, "16s16sIII"
+        else:
+            continue
+        (nsects,) = struct.unpack_from(endian + "I", data, segment_size - 8)
+        for idx in range(nsects):
+            section = struct.unpack_from(
+                endian + section_format, data, segment_size + idx * section_size
+            )
+            section_offset = section[-1]
+            if section_offset and (
+                first_offset is None or section_offset < first_offset
+            ):
+                first_offset = section_offset
+    if first_offset is None:
+        return header["size"] + len(header["commands"])
+    return first_offset
+
+
+def _dylib_name(data: bytes, endian: str) -> str:
+    (name_offset,) = struct.unpack_from(endian + "I", data, 8)
+    return data[name_offset:].split(b"\0", 1)[0].decode("utf-8")
+
+
+def _dylib_command(data: bytes, name: str, header: dict) -> bytes:
+    """Build a new dylib command with the same versions but a different name."""
+    endian = header["endian"]
+    cmd, _, _, timestamp, current, compatibility = struct.unpack_from(
+        endian + "IIIIII", data
+    )
+    alignment = 8 if header["is64"] else 4
+    encoded_name = name.encode("utf-8") + b"\0"
+    cmdsize = DYLIB_COMMAND_SIZE + len(encoded_name)
+    cmdsize += -cmdsize % alignment
+    return struct.pack(
+        endian + "IIIIII",
+        cmd,
+        cmdsize,
+        DYLIB_COMMAND_SIZE,
+        timestamp,
+        current,
+        compatibility,
+    ) + encoded_name.ljust(cmdsize - DYLIB_COMMAND_SIZE, b"\0")
+
+
+def _swap32(value: int) -> int:
+    return struct.unpack("<I", struct.pack(">I", value))[0]
@@ -1,13 +1,33 @@
 from __future__ import annotations
 
 import argparse
+import concurrent.futures
+import contextlib
+import glob
+import logging
 import os
 import platform
+import shlex
 import shutil
 import subprocess
+import sys
 import tempfile
+import time
+from typing import Iterable, Iterator
 
-from . import consolidate_linux, consolidate_osx, consolidate_win, dedupe
+from . import cache, manifest, workspace
+from .wheelsfunc import (
+    cache_wheel,
+    group_wheels,
+    verify_wheels,
+    wheel_platform,
+    wheels_size,
+)
+
+TARGETS = ("linux", "windows", "macos")
+HOST_TARGETS = {"linux": "linux", "windows": "windows", "darwin": "macos"}
+
+logger = logging.getLogger(__name__)
 
 
 def main() -> int:
@@ -15,53 +35,770 @@ def main() -> int:
 
     Executes consolidatewheels and returns the exit code.
     """
-    detected_system = platform.system().lower()
+    with log_to_stdout():
+        if sys.argv[1:3] == ["cache", "prune"]:
+            return cache_prune(sys.argv[3:])
+        if sys.argv[1:2] == ["analyze"]:
+            return analyze(sys.argv[2:])
+        watching = sys.argv[1:2] == ["watch"]
+        opts = parse_watch_options(sys.argv[2:]) if watching else parse_options()
+        try:
+            if watching:
+                opts.wheels = wait_for_wheels(opts)
+            report = consolidate_wheels(opts)
+        except (OSError, RuntimeError, ValueError) as err:
+            print(f"Error: {err}")
+            return 1
+    return 1 if report["failures"] else 0
+
+
+@contextlib.contextmanager
+def log_to_stdout() -> Iterator[None]:
+    """Print the progress logged by consolidatewheels on stdout.
+
+    The library only logs its progress, so that tools using
+    ``consolidatewheels.api`` decide where it goes,
+    while the command line tool prints it as it happens.
+    """
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    package_logger = logging.getLogger(__package__)
+    level = package_logger.level
+    package_logger.addHandler(handler)
+    package_logger.setLevel(logging.INFO)
+    try:
+        yield
+    finally:
+        package_logger.removeHandler(handler)
+        package_logger.setLevel(level)
+
+
+def consolidate_wheels(opts: argparse.Namespace) -> dict:
+    """Consolidate the wheels provided by the options.
+
+    Wheels are grouped by their python and platform tags,
+    and each group is consolidated independently and concurrently,
+    at most ``opts.jobs`` groups at the same time.
+
+    Raises ``RuntimeError`` or ``ValueError`` when the wheels can't
+    be consolidated at all. Groups that fail don't prevent the others
+    from completing, and are reported in the returned details:
+    the groups that had to be consolidated, their ``results``,
+    their ``failures``, the wheels that were ``passed`` through
+    as they were and how long each phase took in seconds.
+    """
+    timings = {}  # type: dict[str, float]
+    started = time.perf_counter()
+    groups = group_wheels(find_wheels(opts.wheels))
+    if opts.verify_inputs:
+        wheels = [wheel for wheels in groups.values() for wheel in wheels]
+        logger.info(f"Verifying {len(wheels)} wheels against their RECORD")
+        verify_wheels(wheels)
+
+    codesign = opts.codesign
+    targets = {}
+    for group, wheels in groups.items():
+        target = opts.target
+        if target == "auto":
+            target = detect_target(wheels)
+        if not requirements_satisfied(target, codesign):
+            raise RuntimeError("System requirements are not satisfied")
+        targets[group] = target or HOST_TARGETS[platform.system().lower()]
+
+    previous_manifest = None
+    if opts.against is not None:
+        previous_manifest = manifest.load_manifest(opts.against)
+
+    locks = regroup_locks(previous_manifest["groups"]) if previous_manifest else {}
+    pending = {}
+    passed = []
+    for group, wheels in groups.items():
+        if manifest.consolidated_together(wheels):
+            # Consolidating them again would only repeat the same work.
+            logger.info(
+                f"{group}: wheels are already consolidated, passing them through."
+            )
+            passed.extend(pass_through(wheels, opts.dest))
+            continue
+        previous_lock = locks.get(group)
+        if previous_lock is not None:
+            wheels = manifest.changed_wheels(previous_lock, wheels)
+            if not wheels:
+                logger.info(
+                    f"{group}: all wheels match the manifest, nothing to consolidate."
+                )
+                continue
+        pending[group] = wheels
+
+    if not check_disk_space(pending, targets, opts):
+        raise RuntimeError("Not enough free space to consolidate the wheels")
+    timings["discover"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    results = {}
+    failures = {}  # type: dict[str, Exception]
+    with concurrent.futures.ThreadPoolExecutor(opts.jobs) as executor:
+        futures = {
+            group: executor.submit(
+                consolidate_group,
+                targets[group],
+                wheels,
+                opts,
+                against=locks.get(group),
+                codesign=codesign,
+            )
+            for group, wheels in pending.items()
+        }
+        for group, future in futures.items():
+            try:
+                results[group] = future.result()
+            except (OSError, RuntimeError, ValueError) as err:
+                failures[group] = err
+    timings["consolidate"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for group, result in results.items():
+        locks[group] = manifest.update_manifest(
+            locks.get(group), targets[group], pending[group], result
+        )
+    if results:
+        logger.info(f"Manifest written to {manifest.write_manifest(opts.dest, locks)}")
+    timings["manifest"] = time.perf_counter() - started
+
+    log_summary(pending, results, failures)
+    if opts.cache_dir is not None:
+        prune_cache(opts.cache_dir, opts.cache_max_size)
+    return {
+        "pending": pending,
+        "results": results,
+        "failures": failures,
+        "passed": passed,
+        "timings": timings,
+    }
 
-    if not requirements_satisfied():
-        return 1
 
-    opts = parse_options()
-    if detected_system == "linux":
-        consolidate_linux.consolidate(opts.wheels, opts.dest)
-    elif detected_system == "windows":
+def regroup_locks(groups: dict[str, dict]) -> dict[str, dict]:
+    """Key the groups of a manifest like ``group_wheels`` does.
+
+    Manifests written by previous versions keyed the groups
+    by the exact platform tags of their wheels.
+    """
+    locks = {}
+    for group, lock in groups.items():
+        inputs = [entry["input"] for entry in lock["wheels"].values()]
+        regrouped = list(group_wheels(inputs))
+        locks[regrouped[0] if len(regrouped) == 1 else group] = lock
+    return locks
+
+
+def consolidate_group(
+    target: str,
+    wheels: list[str],
+    opts: argparse.Namespace,
+    against: dict | None = None,
+    codesign: list[str] | None = None,
+) -> dict:
+    """Consolidate a group of wheels that are meant to be installed together.
+
+    Returns the details that have to be recorded in the manifest,
+    including the libraries removed by ``dedupe``.
+
+    Platform backends are imported only when they are needed,
+    so that their dependencies don't slow down the startup of the tool.
+    Wheels are unpacked from ``opts.cache_dir`` when it's provided,
+    the deduped wheels are never cached as they are only used once.
+    """
+    if opts.strip_debug and target != "linux":
+        # PE and Mach-O libraries usually keep their debug information
+        # in separate files, and it's not worth laying them out again.
+        logger.warning(
+            f"Debug sections are only stripped from Linux wheels, not {target}"
+        )
+    if target == "linux":
+        from . import consolidate_linux
+
+        if opts.libs_wheel is None:
+            return consolidate_linux.consolidate(
+                wheels,
+                opts.dest,
+                against=against,
+                workdir=opts.workdir,
+                reproducible=opts.reproducible,
+                cachedir=opts.cache_dir,
+                strip=opts.strip_debug,
+            )
+        # Libraries can only be moved into a new wheel after
+        # the duplicated copies embedded by auditwheel are removed.
+        from . import dedupe
+
+        with workspace.make_workdir(opts.workdir, prefix="dedupe-") as dedupedir:
+            deduped = dedupe.dedupe(
+                wheels,
+                dedupedir,
+                mangled=True,
+                workdir=opts.workdir,
+                libs_wheel=opts.libs_wheel,
+                reproducible=opts.reproducible,
+                compatible=consolidate_linux.compatible_copies,
+                cachedir=opts.cache_dir,
+                demangle=consolidate_linux.demangle_libname,
+            )
+            result = consolidate_linux.consolidate(
+                deduped["outputs"],
+                opts.dest,
+                workdir=opts.workdir,
+                libs_wheel=opts.libs_wheel,
+                reproducible=opts.reproducible,
+                strip=opts.strip_debug,
+            )
+    elif target == "windows":
+        from . import consolidate_win, dedupe
+
         # On Windows, we need to include all libraries
         # so that they get mangled and reserve the right
         # size in the IMPORTS section of the DLL to account for
         # the mangling hash. That way we can then replace the hash
         # without risk of overflowing.
         # dedupe will take care that they don't appear twice.
-        with tempfile.TemporaryDirectory() as dedupedir:
-            wheels = dedupe.dedupe(opts.wheels, dedupedir, mangled=True)
-            consolidate_win.consolidate(wheels, opts.dest)
-    elif detected_system == "darwin":
+        with workspace.make_workdir(opts.workdir, prefix="dedupe-") as dedupedir:
+            deduped = dedupe.dedupe(
+                wheels,
+                dedupedir,
+                mangled=True,
+                provided=manifest.locked_providers(against, wheels),
+                workdir=opts.workdir,
+                libs_wheel=opts.libs_wheel,
+                reproducible=opts.reproducible,
+                cachedir=opts.cache_dir,
+            )
+            result = consolidate_win.consolidate(
+                deduped["outputs"],
+                opts.dest,
+                against=against,
+                workdir=opts.workdir,
+                reproducible=opts.reproducible,
+            )
+    elif target == "macos":
+        from . import consolidate_osx, dedupe
+
+        if codesign is None:
+            codesign = default_codesign()
         # On Mac, delocate does not mangle library names,
         # but there is no --exclude option,
         # so we just have to remove the extra lib.
-        with tempfile.TemporaryDirectory() as dedupedir:
-            wheels = dedupe.dedupe(opts.wheels, dedupedir)
-            consolidate_osx.consolidate(wheels, opts.dest)
+        with workspace.make_workdir(opts.workdir, prefix="dedupe-") as dedupedir:
+            deduped = dedupe.dedupe(
+                wheels,
+                dedupedir,
+                provided=manifest.locked_providers(against, wheels),
+                workdir=opts.workdir,
+                libs_wheel=opts.libs_wheel,
+                reproducible=opts.reproducible,
+                cachedir=opts.cache_dir,
+            )
+            result = consolidate_osx.consolidate(
+                deduped["outputs"],
+                opts.dest,
+                against=against,
+                workdir=opts.workdir,
+                codesign=codesign,
+                libs_wheel=opts.libs_wheel,
+                reproducible=opts.reproducible,
+            )
+    else:
+        raise ValueError(f"Unsupported target {target}")
+    result.update(removed=deduped["removed"], bytes_saved=deduped["bytes_saved"])
+    return result
+
+
+def wait_for_wheels(opts: argparse.Namespace) -> list[str]:
+    """Wait for the wheels of the watch command to appear in ``opts.directory``.
+
+    Each wheel is verified, when requested, and unpacked in the cache
+    as soon as it appears, while the others are still being built,
+    so that only patching and packing them is left when all are there.
+
+    Returns the wheels that have to be consolidated.
+    """
+    from .watch import watch_wheels
+
+    logger.info(f"Watching {opts.directory} for wheels")
+    futures = []  # type: list[concurrent.futures.Future]
+    with concurrent.futures.ThreadPoolExecutor(opts.jobs) as executor:
+
+        def on_wheel(wheel: str) -> None:
+            # Stop at the first failure instead of waiting for all the wheels.
+            for future in futures:
+                if future.done():
+                    future.result()
+            logger.info(f"Found {wheel}")
+            futures.append(executor.submit(prepare_wheel, wheel, opts))
+
+        wheels = watch_wheels(
+            opts.directory,
+            on_wheel,
+            expected=opts.expect,
+            sentinel=opts.until,
+            interval=opts.interval,
+            timeout=opts.timeout,
+        )
+        for future in futures:
+            future.result()
+    logger.info(f"All {len(wheels)} wheels arrived")
+    # They were already verified while waiting for the others.
+    opts.verify_inputs = False
+    return wheels
+
+
+def prepare_wheel(wheel: str, opts: argparse.Namespace) -> None:
+    """Do the work that doesn't need the other wheels to be there."""
+    if opts.verify_inputs:
+        verify_wheels([wheel])
+    cache_wheel(wheel, opts.cache_dir)
+
+
+def pass_through(wheels: list[str], destdir: str) -> list[str]:
+    """Publish wheels into ``destdir`` as they are.
+
+    Returns the paths of the published wheels.
+    """
+    os.makedirs(destdir, exist_ok=True)
+    published = []
+    for wheel in wheels:
+        target = os.path.join(destdir, os.path.basename(wheel))
+        published.append(target)
+        if os.path.exists(target) and os.path.samefile(wheel, target):
+            continue
+        with workspace.atomic_target(target) as tmptarget:
+            workspace.clone_file(wheel, tmptarget)
+    return published
+
+
+def prune_cache(cachedir: str, max_size: int) -> None:
+    """Evict unpacked wheels from the cache until it fits in ``max_size``."""
+    evicted, freed = cache.prune(cachedir, max_size)
+    if evicted:
+        logger.info(
+            f"Evicted {evicted} wheels from the cache in {cachedir}, "
+            f"{_format_size(freed)} freed"
+        )
+
+
+def cache_prune(args: list[str]) -> int:
+    """Entry point of the ``consolidatewheels cache prune`` command."""
+    parser = argparse.ArgumentParser(
+        prog="consolidatewheels cache prune",
+        description="Evict the least recently used wheels from the cache "
+        "of unpacked wheels.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=cache.default_cache_dir(),
+        help="Directory of the cache, by default the one used by --cache-dir.",
+    )
+    parser.add_argument(
+        "--max-size",
+        default="0",
+        type=cache.parse_size,
+        metavar="SIZE",
+        help="Size the cache is reduced to, like 500M or 2G. "
+        "By default the whole cache is emptied.",
+    )
+    opts = parser.parse_args(args)
+    try:
+        prune_cache(opts.cache_dir, opts.max_size)
+    except OSError as err:
+        print(f"Error: {err}")
+        return 1
+    return 0
+
+
+def analyze(args: list[str]) -> int:
+    """Entry point of the ``consolidatewheels analyze`` command."""
+    parser = argparse.ArgumentParser(
+        prog="consolidatewheels analyze",
+        description="Measure the libraries loaded and the time spent importing "
+        "the packages of a set of wheels, installed without network access "
+        "in a temporary virtual environment. Only works on Linux.",
+        fromfile_prefix_chars="@",
+    )
+    parser.add_argument(
+        "wheels",
+        nargs="+",
+        help="Wheels to analyze, usually the ones that are going to be "
+        "consolidated, directories containing them or glob patterns.",
+    )
+    parser.add_argument(
+        "--consolidated",
+        default=None,
+        nargs="+",
+        metavar="WHEEL",
+        help="The consolidated wheels, which are analyzed too and compared.",
+    )
+    parser.add_argument(
+        "--workdir",
+        default=None,
+        help="Directory where the virtual environments are created, "
+        "by default the system temporary directory.",
+    )
+    opts = parser.parse_args(args)
+
+    from .analyze import analyze_wheels
+
+    wheel_sets = {"Inputs": opts.wheels}
+    if opts.consolidated is not None:
+        wheel_sets["Consolidated"] = opts.consolidated
+    reports = {}
+    try:
+        for label, paths in wheel_sets.items():
+            wheels = list(find_wheels(paths))
+            print(f"Analyzing {len(wheels)} wheels")
+            reports[label] = analyze_wheels(wheels, opts.workdir)
+    except (OSError, RuntimeError, ValueError) as err:
+        print(f"Error: {err}")
+        return 1
+    print_analysis(reports)
     return 0
 
 
+def print_analysis(reports: dict[str, dict]) -> None:
+    """Report the measures of ``analyze_wheels`` for each set of wheels.
+
+    When there are two sets, how they compare when all their
+    packages are imported together is reported too.
+    """
+    for label, report in reports.items():
+        print(f"{label}:")
+        for name, measures in [*report["packages"].items(), ("all", report["all"])]:
+            print(f"  {name}: {_describe_measures(measures)}")
+            if measures["error"] is not None:
+                print(f"    Import failed, {measures['error']}")
+    if len(reports) == 2:
+        before, after = (report["all"] for report in reports.values())
+        print("Importing all the packages together, after consolidation:")
+        print(
+            f"  {sum(before['libraries'].values())} -> "
+            f"{sum(after['libraries'].values())} embedded libraries loaded"
+        )
+        print(
+            f"  {_format_size(before['mapped_bytes'])} -> "
+            f"{_format_size(after['mapped_bytes'])} of libraries mapped"
+        )
+        print(f"  {before['seconds']:.3f}s -> {after['seconds']:.3f}s to import")
+
+
+def _describe_measures(measures: dict) -> str:
+    description = (
+        f"{measures['seconds']:.3f}s to import, "
+        f"{_format_size(measures['mapped_bytes'])} of libraries mapped, "
+        f"{len(measures['libraries'])} embedded libraries"
+    )
+    duplicated = [
+        f"{libname} x{copies}"
+        for libname, copies in measures["libraries"].items()
+        if copies > 1
+    ]
+    if duplicated:
+        description += f", loaded multiple times: {', '.join(duplicated)}"
+    return description
+
+
+def log_summary(
+    pending: dict[str, list[str]],
+    results: dict[str, dict],
+    failures: dict[str, Exception],
+) -> None:
+    """Report the outcome of the consolidation of each group of wheels."""
+    logger.info(f"Consolidated {len(results)} of {len(pending)} groups of wheels:")
+    for group, wheels in pending.items():
+        if group in results:
+            result = results[group]
+            logger.info(
+                f"  {group}: {len(wheels)} wheels, "
+                f"{len(result['providers'])} shared libraries, "
+                f"{result.get('patched', 0)} binaries patched, "
+                f"{result.get('skipped', 0)} skipped"
+            )
+        else:
+            logger.error(f"  {group}: FAILED, {failures[group]}")
+
+
+def estimate_disk_usage(
+    pending: dict[str, list[str]], targets: dict[str, str], opts: argparse.Namespace
+) -> tuple[int, int]:
+    """Estimate the peak disk usage in the workdir and in the destination.
+
+    Sizes are read from the central directory of the wheels.
+    Each group is unpacked and packed again in the workdir, groups that
+    are deduped first also keep the deduped wheels until they are consolidated.
+    Groups are consolidated concurrently, so their usage adds up.
+    """
+    workdir_usage = dest_usage = 0
+    for group, wheels in pending.items():
+        compressed, uncompressed = wheels_size(wheels)
+        deduped = targets[group] != "linux" or opts.libs_wheel is not None
+        workdir_usage += uncompressed + compressed * (2 if deduped else 1)
+        dest_usage += compressed
+    return workdir_usage, dest_usage
+
+
+def check_disk_space(
+    pending: dict[str, list[str]], targets: dict[str, str], opts: argparse.Namespace
+) -> bool:
+    """Verify that there is enough free space to consolidate the wheels.
+
+    When no workdir was provided and there isn't enough space in
+    the destination, the system temporary directory is used if it has enough.
+
+    Returns ``False`` if there isn't enough space, wheels that
+    can't be read raise ``ValueError``.
+    """
+    workdir_usage, dest_usage = estimate_disk_usage(pending, targets, opts)
+    logger.info(f"Estimated disk usage: {_format_size(workdir_usage)}")
+
+    error = _missing_space(opts.workdir, opts.dest, workdir_usage, dest_usage)
+    if error is None:
+        return True
+    if opts.workdir == opts.dest:
+        tmpdir = tempfile.gettempdir()
+        if _missing_space(tmpdir, opts.dest, workdir_usage, dest_usage) is None:
+            logger.warning(
+                f"Not enough free space in {opts.workdir}, working inside {tmpdir}"
+            )
+            opts.workdir = tmpdir
+            return True
+    logger.error(f"Error: {error}")
+    return False
+
+
+def _missing_space(
+    workdir: str, dest: str, workdir_usage: int, dest_usage: int
+) -> str | None:
+    """Describe what's missing when workdir or dest don't have enough space."""
+    requirements = [(workdir, workdir_usage)]
+    if not workspace.same_filesystem(
+        workspace.existing_parent(workdir), workspace.existing_parent(dest)
+    ):
+        # Otherwise consolidated wheels are just renamed from workdir to dest.
+        requirements.append((dest, dest_usage))
+    for path, usage in requirements:
+        available = workspace.free_space(path)
+        if available < usage:
+            return (
+                f"about {_format_size(usage)} of free space are required "
+                f"in {path}, only {_format_size(available)} available"
+            )
+    return None
+
+
+def _format_size(size: int) -> str:
+    value = float(size)
+    for unit in ("B", "KB", "MB", "GB"):
+        if value < 1024:
+            break
+        value /= 1024
+    else:
+        unit = "TB"
+    return f"{value:.1f} {unit}"
+
+
+def find_wheels(paths: Iterable[str]) -> Iterator[str]:
+    """Expand directories and glob patterns in ``paths`` to the wheels they match.
+
+    Wheels are discovered lazily, one path at a time, and glob
+    patterns that match nothing are reported with a ``ValueError``.
+    Existing files are taken literally, even if their name looks like a pattern.
+    """
+    for path in paths:
+        if not path:
+            # Empty lines of argument files.
+            continue
+        elif os.path.isdir(path):
+            yield from sorted(glob.iglob(os.path.join(glob.escape(path), "*.whl")))
+        elif glob.escape(path) != path and not os.path.exists(path):
+            matches = sorted(glob.iglob(path, recursive=True))
+            if not matches:
+                raise ValueError(f"No wheels match {path}")
+            yield from matches
+        else:
+            yield path
+
+
 def parse_options() -> argparse.Namespace:
     """Parse the options supported by the tool
 
     Returns an object with options as attributes.
     """
     parser = argparse.ArgumentParser(
-        description="Export the report from the Engineering Report Clickup List"
+        description="Export the report from the Engineering Report Clickup List",
+        fromfile_prefix_chars="@",
     )
     parser.add_argument(
-        "wheels", nargs="+", help="List of wheel files that have to be consolidated."
+        "wheels",
+        nargs="+",
+        help="List of wheel files that have to be consolidated, "
+        "directories containing them or glob patterns. "
+        "Use @FILE to read them from a file, one per line.",
     )
+    add_consolidation_options(parser)
+    return check_options(parser, parser.parse_args())
+
+
+def parse_watch_options(args: list[str]) -> argparse.Namespace:
+    """Parse the options of the ``consolidatewheels watch`` command.
+
+    Wheels are always unpacked in the cache, by default the one
+    used by --cache-dir, so that they are unpacked while waiting.
+    """
+    parser = argparse.ArgumentParser(
+        prog="consolidatewheels watch",
+        description="Consolidate the wheels that appear in a directory, "
+        "preparing each one of them as soon as it appears.",
+    )
+    parser.add_argument("directory", help="Directory where the wheels appear.")
+    parser.add_argument(
+        "--expect",
+        default=None,
+        type=int,
+        metavar="N",
+        help="Consolidate the wheels when N of them appeared.",
+    )
+    parser.add_argument(
+        "--until",
+        default=None,
+        metavar="FILENAME",
+        help="Consolidate the wheels when FILENAME appears in the directory.",
+    )
+    parser.add_argument(
+        "--interval",
+        default=1.0,
+        type=float,
+        metavar="SECONDS",
+        help="How often the directory is checked for new wheels.",
+    )
+    parser.add_argument(
+        "--timeout",
+        default=None,
+        type=float,
+        metavar="SECONDS",
+        help="Fail if the wheels didn't appear within SECONDS.",
+    )
+    add_consolidation_options(parser)
+    opts = parser.parse_args(args)
+    if opts.expect is None and opts.until is None:
+        parser.error("either --expect or --until is required")
+    opts.wheels = []
+    opts = check_options(parser, opts)
+    opts.directory = os.path.abspath(opts.directory)
+    if opts.cache_dir is None:
+        opts.cache_dir = cache.default_cache_dir()
+    return opts
+
+
+def add_consolidation_options(parser: argparse.ArgumentParser) -> None:
+    """Options controlling how wheels are consolidated, shared by all commands."""
     parser.add_argument(
         "--dest",
         default=None,
         nargs="?",
         help="Destination dir where to place consolidated wheels.",
     )
-    opts = parser.parse_args()
+    parser.add_argument(
+        "--against",
+        default=None,
+        help="Manifest of a previous consolidation, "
+        "only wheels that changed since then are consolidated.",
+    )
+    parser.add_argument(
+        "--workdir",
+        default=None,
+        help="Directory where wheels are unpacked while they are consolidated, "
+        "by default the destination dir. When on a different filesystem than "
+        "the destination, the consolidated wheels have to be copied.",
+    )
+    parser.add_argument(
+        "--target",
+        default="auto",
+        choices=("auto",) + TARGETS,
+        help="Platform the wheels were built for, by default detected "
+        "from the platform tags of the wheels. It doesn't have to be "
+        "the platform the tool is running on.",
+    )
+    parser.add_argument(
+        "--codesign",
+        default=None,
+        help="Command used to sign macOS libraries after they are patched, "
+        "the library path is appended to it. By default `codesign` on macOS "
+        "and `rcodesign sign` elsewhere, use `none` to disable signing.",
+    )
+    parser.add_argument(
+        "--libs-wheel",
+        default=None,
+        metavar="PREFIX",
+        help="Move all the libraries embedded in the wheels into a new "
+        "PREFIX_libs wheel that the other wheels depend on, "
+        "so that they are downloaded only once.",
+    )
+    parser.add_argument(
+        "--reproducible",
+        action="store_true",
+        help="Produce the same wheels every time the same wheels are consolidated, "
+        "timestamps are set to SOURCE_DATE_EPOCH when it's provided.",
+    )
+    parser.add_argument(
+        "--strip-debug",
+        action="store_true",
+        help="Remove the debug sections from the libraries of Linux wheels "
+        "while they are patched, to reduce the size of the wheels.",
+    )
+    parser.add_argument(
+        "--verify-inputs",
+        action="store_true",
+        help="Verify that the content of the wheels matches their RECORD "
+        "before consolidating them, to detect corrupted or truncated wheels.",
+    )
+    parser.add_argument(
+        "--jobs",
+        default=None,
+        type=int,
+        metavar="N",
+        help="Groups of wheels consolidated at the same time, "
+        "by default depending on the number of CPUs.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        nargs="?",
+        const=cache.default_cache_dir(),
+        metavar="DIR",
+        help="Keep the unpacked wheels in DIR and reuse them when the same "
+        "wheels are consolidated again, by default in the user cache directory. "
+        "Use `consolidatewheels cache prune` to empty it.",
+    )
+    parser.add_argument(
+        "--cache-max-size",
+        default=cache.DEFAULT_MAX_SIZE,
+        type=cache.parse_size,
+        metavar="SIZE",
+        help="Least recently used wheels are evicted from the cache "
+        "at the end of each run until it fits in SIZE, like 500M or 2G. "
+        "By default 5G.",
+    )
+
 
+def check_options(
+    parser: argparse.ArgumentParser, opts: argparse.Namespace
+) -> argparse.Namespace:
+    """Report options that can't be used together and normalize them."""
+    if opts.libs_wheel is not None and opts.against is not None:
+        parser.error("--libs-wheel can't be used together with --against")
+    if opts.codesign is not None:
+        opts.codesign = [] if opts.codesign == "none" else shlex.split(opts.codesign)
+    return normalize_options(opts)
+
+
+def normalize_options(opts: argparse.Namespace) -> argparse.Namespace:
+    """Make paths in the options absolute and fill in their defaults."""
     if opts.dest is None:
         # If no destination directory was provided,
         # by default save the new wheels in current directory.
@@ -71,44 +808,84 @@ def parse_options() -> argparse.Namespace:
     # the rest of the script don't have to care about relative paths
     # when it changes working directory.
     opts.dest = os.path.abspath(opts.dest)
+    if opts.against is not None:
+        opts.against = os.path.abspath(opts.against)
+    opts.workdir = os.path.abspath(opts.workdir or opts.dest)
+    if opts.cache_dir is not None:
+        opts.cache_dir = os.path.abspath(opts.cache_dir)
     return opts
 
 
-def requirements_satisfied() -> bool:
+def detect_target(wheels: list[str]) -> str | None:
+    """Detect the platform the wheels were built for from their tags.
+
+    Returns ``None`` when no wheel is platform specific,
+    and raises ``ValueError`` when they target different platforms.
+    """
+    targets = {wheel_platform(wheel) or "" for wheel in wheels} - {""}
+    if len(targets) > 1:
+        raise ValueError(
+            f"Wheels were built for multiple platforms: {', '.join(sorted(targets))}"
+        )
+    return targets.pop() if targets else None
+
+
+def default_codesign() -> list[str]:
+    """Command used to sign macOS libraries when none was provided."""
+    from .consolidate_osx import DEFAULT_CODESIGN
+
+    if platform.system().lower() != "darwin" and shutil.which("rcodesign"):
+        # rcodesign can apply ad-hoc signatures on any platform.
+        return ["rcodesign", "sign"]
+    return list(DEFAULT_CODESIGN)
+
+
+def requirements_satisfied(
+    target: str | None = None, codesign: list[str] | None = None
+) -> bool:
     """Verifies that all system requirements are satisfied.
 
     Those can't be esily verified during install process,
     so it's easier to just check them when the tool starts.
 
+    ``target`` is the platform of the wheels that have to be
+    consolidated, by default the one the tool is running on.
+
     Returns ``False`` is the requirements are not satisfied.
     """
     detected_system = platform.system().lower()
+    if target is None:
+        target = HOST_TARGETS.get(detected_system)
+    if target == "macos":
+        if codesign is None:
+            codesign = default_codesign()
 
-    if detected_system == "darwin":
-        if not shutil.which("install_name_tool"):
-            print("Cannot find required utility `install_name_tool` in PATH")
+        # Outside of macOS libraries are patched in process.
+        if detected_system == "darwin" and not shutil.which("install_name_tool"):
+            logger.error("Cannot find required utility `install_name_tool` in PATH")
             return False
 
-        if not shutil.which("codesign"):
-            print("Cannot find required utility `codesign` in PATH")
+        if codesign and not shutil.which(codesign[0]):
+            logger.error(f"Cannot find required utility `{codesign[0]}` in PATH")
+            logger.error("A different signing command can be provided with --codesign")
             return False
-    elif detected_system == "linux":
+    elif target == "linux":
         # Ensure that patchelf exists and we can use it.
         if not shutil.which("patchelf"):
-            print("Cannot find required utility `patchelf` in PATH")
+            logger.error("Cannot find required utility `patchelf` in PATH")
             return False
 
         try:
             subprocess.check_output(["patchelf", "--version"]).decode("utf-8")
         except subprocess.CalledProcessError:
-            print("Could not call `patchelf` binary")
+            logger.error("Could not call `patchelf` binary")
             return False
-    elif detected_system == "windows":
+    elif target == "windows":
         # At the moment there are no system dependencies required.
         pass
     else:
-        print("Error: This tool only supports Linux, MacOSX and Windows")
-        print("Detected System:", detected_system)
+        logger.error("Error: This tool only supports Linux, MacOSX and Windows")
+        logger.error(f"Detected System: {detected_system}")
         return False
 
     # All requirements are in place, that's good!
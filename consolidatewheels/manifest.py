@@ -0,0 +1,216 @@
+from __future__ import annotations
+
+import hashlib
+import itertools
+import json
+import logging
+import os
+import pathlib
+import zipfile
+
+from .wheelsfunc import DIST_INFO_RE, find_dist_info
+from .workspace import file_sha256, locked, write_atomic
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = "consolidation.lock.json"
+MANIFEST_VERSION = 2
+
+# Written in the .dist-info directory of every consolidated wheel
+MARKER_FILENAME = "consolidatewheels.json"
+
+
+def load_manifest(path: str) -> dict:
+    """Load a manifest previously written by ``write_manifest``.
+
+    The manifest records the consolidation of each group of wheels
+    in ``groups``, keyed by the python and platform tags of the group.
+    """
+    with open(path) as manifest_f:
+        lock = json.load(manifest_f)
+    if lock.get("version") != MANIFEST_VERSION:
+        raise ValueError(f"Unsupported manifest version in {path}")
+    return lock
+
+
+def write_manifest(destdir: str, groups: dict[str, dict]) -> str:
+    """Write the consolidation manifest into ``destdir`` and return its path.
+
+    ``groups`` are the results of ``update_manifest`` for each group of wheels,
+    they are merged into the manifest already in ``destdir``, replacing the
+    groups with the same tags. The manifest is locked while it's merged,
+    so that jobs consolidating different groups of wheels into the same
+    directory at the same time all get recorded, and it's replaced
+    atomically, so it's never seen partially written.
+    A manifest that can't be loaded is replaced.
+    """
+    path = os.path.join(destdir, MANIFEST_FILENAME)
+    with locked(os.path.join(destdir, f".{MANIFEST_FILENAME}.lock")):
+        merged = {}  # type: dict[str, dict]
+        try:
+            merged.update(load_manifest(path)["groups"])
+        except (FileNotFoundError, ValueError):
+            pass
+        merged.update(groups)
+        lock = {"version": MANIFEST_VERSION, "groups": merged}
+        content = json.dumps(lock, indent=2, sort_keys=True) + "\n"
+        write_atomic(path, content.encode("utf-8"))
+    return path
+
+
+def update_manifest(
+    previous: dict | None, system: str, wheels: list[str], result: dict
+) -> dict:
+    """Record the outcome of the consolidation of a group of wheels.
+
+    ``wheels`` are the input wheels that were consolidated
+    and ``result`` is what the platform ``consolidate`` function returned.
+    When a ``previous`` manifest is provided, the entries
+    for wheels that were not consolidated again are preserved.
+    """
+    if previous is None:
+        lock = {
+            "platform": system,
+            "providers": {},
+            "wheels": {},
+        }  # type: dict
+    else:
+        lock = json.loads(json.dumps(previous))
+
+    if "mangling_map" in result:
+        lock.setdefault("mangling_map", {}).update(result["mangling_map"])
+    if "consolidated_id" in result:
+        lock["consolidated_id"] = result["consolidated_id"]
+
+    from packaging.utils import canonicalize_name
+
+    # Outputs are named after their .dist-info directory, which can
+    # be spelled differently from the name of the input wheel.
+    reprocessed = {canonicalize_name(wheel_distname(wheel)) for wheel in wheels}
+    lock["providers"] = {
+        libname: distname
+        for libname, distname in lock["providers"].items()
+        if canonicalize_name(distname) not in reprocessed
+    }
+    lock["providers"].update(result["providers"])
+
+    outputs = {
+        canonicalize_name(wheel_distname(output)): output
+        for output in result["outputs"]
+    }
+    for wheel in wheels:
+        distname = wheel_distname(wheel)
+        output = outputs[canonicalize_name(distname)]
+        lock["wheels"][distname] = {
+            "input": os.path.basename(wheel),
+            "input_sha256": file_sha256(wheel),
+            "output": os.path.basename(output),
+            "output_sha256": file_sha256(output),
+        }
+    return lock
+
+
+def changed_wheels(lock: dict, wheels: list[str]) -> list[str]:
+    """Return the wheels that don't match the ones recorded in the manifest.
+
+    A wheel matches when it is the same exact input that was consolidated
+    or the output that the consolidation produced for it.
+    """
+    changed = []
+    for wheel in wheels:
+        entry = lock["wheels"].get(wheel_distname(wheel))
+        if entry and file_sha256(wheel) in (
+            entry["input_sha256"],
+            entry["output_sha256"],
+        ):
+            logger.info(f"Skipping {wheel} as it matches the manifest.")
+            continue
+        changed.append(wheel)
+    return changed
+
+
+def locked_providers(lock: dict | None, wheels: list[str]) -> dict[str, str]:
+    """Libraries provided by wheels of the manifest that are not in ``wheels``.
+
+    Those are the libraries that wheels being consolidated
+    against the manifest should not provide again.
+    """
+    if lock is None:
+        return {}
+    reprocessed = {wheel_distname(wheel) for wheel in wheels}
+    return {
+        libname: distname
+        for libname, distname in lock["providers"].items()
+        if distname not in reprocessed
+    }
+
+
+def write_markers(wheeldirs: list[str], mapping: dict) -> None:
+    """Record in each wheel directory that it was consolidated with the others.
+
+    The marker contains the digest of ``mapping``, how the wheels
+    were made consistent, and the name and version of all the wheels
+    that were consolidated together, see ``consolidated_together``.
+    """
+    digest = hashlib.sha256(
+        json.dumps(mapping, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+    dist_info_dirs = [find_dist_info(wheeldir) for wheeldir in wheeldirs]
+    siblings = sorted(os.path.splitext(dirname)[0] for dirname in dist_info_dirs)
+    content = json.dumps({"digest": digest, "siblings": siblings}, sort_keys=True)
+    for wheeldir, dist_info_dir in zip(wheeldirs, dist_info_dirs):
+        write_atomic(
+            os.path.join(wheeldir, dist_info_dir, MARKER_FILENAME),
+            (content + "\n").encode("utf-8"),
+        )
+
+
+def consolidated_together(wheels: list[str]) -> bool:
+    """Whether the wheels are the outcome of consolidating them together.
+
+    That is the case when all of them have the same marker written
+    by ``write_markers``, and it lists exactly these wheels.
+    Wheels that can't be read were never consolidated.
+    """
+    markers = []
+    namevers = []
+    for wheel in wheels:
+        try:
+            with zipfile.ZipFile(wheel) as wf:
+                for name in wf.namelist():
+                    dirname, _, filename = name.partition("/")
+                    match = DIST_INFO_RE.match(dirname)
+                    if match and filename == MARKER_FILENAME:
+                        markers.append(json.loads(wf.read(name)))
+                        namevers.append(match.group("namever"))
+                        break
+                else:
+                    return False
+        except (OSError, ValueError, zipfile.BadZipFile):
+            return False
+    return (
+        bool(markers)
+        and all(marker == markers[0] for marker in markers)
+        and markers[0].get("siblings") == sorted(namevers)
+    )
+
+
+def find_providers(wheeldirs: list[str]) -> dict[str, str]:
+    """Map each library embedded in the wheel directories to the providing wheel."""
+    providers = {}  # type: dict[str, str]
+    for wheeldir in wheeldirs:
+        distname = wheel_distname(wheeldir)
+        for libpath in itertools.chain(
+            pathlib.Path(wheeldir).rglob(".dylibs/*"),
+            pathlib.Path(wheeldir).rglob("*.libs/*"),
+        ):
+            if libpath.name.startswith(".load-order-"):
+                continue
+            providers.setdefault(libpath.name, distname)
+    return providers
+
+
+def wheel_distname(path: str) -> str:
+    """Distribution name of a wheel file or unpacked wheel directory."""
+    distname, _ = os.path.basename(path).split("-", 1)
+    return distname
@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import subprocess
+from typing import Iterable, Sequence, Union
+
+Command = Sequence[Union[str, "os.PathLike[str]"]]
+
+
+class ToolError(RuntimeError):
+    """An external tool failed or timed out.
+
+    ``index`` is the position of the failed command in the list
+    provided to ``run_tools`` and ``result`` its captured output.
+    """
+
+    def __init__(
+        self, index: int, result: subprocess.CompletedProcess, reason: str = ""
+    ) -> None:
+        self.index = index
+        self.result = result
+        if not reason:
+            reason = f"exit code {result.returncode}"
+        stderr = (result.stderr or b"").decode("utf-8", "replace").strip()
+        message = f"{' '.join(result.args)} failed: {reason}"
+        if stderr:
+            message = f"{message}\n{stderr}"
+        super().__init__(message)
+
+
+def run_tools(
+    commands: Iterable[Command],
+    max_jobs: int | None = None,
+    timeout: float | None = None,
+    check: bool = True,
+) -> list[subprocess.CompletedProcess]:
+    """Run external tools concurrently and return their results.
+
+    At most ``max_jobs`` commands run at the same time, by default
+    one per available CPU. The stdout and stderr of every command
+    are captured and returned as ``subprocess.CompletedProcess``
+    in the same order the commands were provided.
+
+    When ``check`` is enabled, the first command that fails or
+    doesn't complete within ``timeout`` seconds cancels all the
+    pending ones and a ``ToolError`` is raised.
+    """
+    argslist = [[os.fspath(arg) for arg in command] for command in commands]
+    if not argslist:
+        return []
+    max_jobs = max_jobs or os.cpu_count() or 1
+    return asyncio.run(_run_all(argslist, max_jobs, timeout, check))
+
+
+async def _run_all(
+    argslist: list[list[str]], max_jobs: int, timeout: float | None, check: bool
+) -> list[subprocess.CompletedProcess]:
+    semaphore = asyncio.Semaphore(max_jobs)
+    tasks = [
+        asyncio.ensure_future(_run_one(index, args, semaphore, timeout, check))
+        for index, args in enumerate(argslist)
+    ]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in tasks:
+            # Report the failure of the first command in order,
+            # so that errors are consistent across runs.
+            if task.done() and task.exception() is not None:
+                raise task.exception()  # type: ignore[misc]
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return [task.result() for task in tasks]
+
+
+async def _run_one(
+    index: int,
+    args: list[str],
+    semaphore: asyncio.Semaphore,
+    timeout: float | None,
+    check: bool,
+) -> subprocess.CompletedProcess:
+    async with semaphore:
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *args, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            )
+        except OSError as err:
+            result = subprocess.CompletedProcess(args, 127, b"", str(err).encode())
+            if check:
+                raise ToolError(index, result) from err
+            return result
+
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+        except asyncio.TimeoutError:
+            returncode = await _terminate(proc)
+            result = subprocess.CompletedProcess(args, returncode, b"", b"")
+            if check:
+                raise ToolError(index, result, f"timed out after {timeout}s")
+            return result
+        except asyncio.CancelledError:
+            await _terminate(proc)
+            raise
+
+    returncode = await proc.wait()
+    result = subprocess.CompletedProcess(args, returncode, stdout, stderr)
+    if check and result.returncode:
+        raise ToolError(index, result)
+    return result
+
+
+async def _terminate(proc: asyncio.subprocess.Process) -> int:
+    if proc.returncode is None:
+        try:
+            proc.kill()
+        except ProcessLookupError:  # pragma: no cover
+            pass
+    return await proc.wait()
@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+import glob
+import os
+import time
+from typing import Callable
+
+
+def watch_wheels(
+    directory: str,
+    on_wheel: Callable[[str], None],
+    expected: int | None = None,
+    sentinel: str | None = None,
+    interval: float = 1.0,
+    timeout: float | None = None,
+) -> list[str]:
+    """Wait for wheels to appear in ``directory`` until all of them are there.
+
+    The directory is polled every ``interval`` seconds and ``on_wheel``
+    is called with each wheel as soon as it's complete, which is when
+    its size and modification time didn't change since the previous poll,
+    so that wheels that are still being copied are not read.
+
+    Waiting ends when ``expected`` wheels were found, or when the
+    ``sentinel`` file exists in the directory and all the wheels
+    that are there are complete.
+
+    Returns the wheels that were found, in the order they appeared.
+    Raises ``RuntimeError`` if they didn't appear within ``timeout`` seconds.
+    """
+    if expected is None and sentinel is None:
+        raise ValueError("Either the expected wheels or a sentinel are required")
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    found = []  # type: list[str]
+    pending = {}  # type: dict[str, tuple[int, int]]
+    while True:
+        signatures = {}  # type: dict[str, tuple[int, int]]
+        for wheel in sorted(glob.iglob(os.path.join(glob.escape(directory), "*.whl"))):
+            if wheel in found:
+                continue
+            try:
+                stat = os.stat(wheel)
+            except FileNotFoundError:
+                # Renamed or removed since it was listed.
+                continue
+            signatures[wheel] = (stat.st_size, stat.st_mtime_ns)
+        for wheel, signature in signatures.items():
+            if pending.get(wheel) == signature:
+                found.append(wheel)
+                on_wheel(wheel)
+        pending = {
+            wheel: signature
+            for wheel, signature in signatures.items()
+            if wheel not in found
+        }
+
+        if expected is not None and len(found) >= expected:
+            return found
+        if (
+            sentinel is not None
+            and not pending
+            and os.path.exists(os.path.join(directory, sentinel))
+        ):
+            return found
+        if deadline is not None and time.monotonic() >= deadline:
+            raise RuntimeError(
+                f"Timed out waiting for wheels in {directory}, found {len(found)}"
+            )
+        time.sleep(interval)
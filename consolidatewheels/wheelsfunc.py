@@ -1,53 +1,609 @@
 from __future__ import annotations
 
+import base64
+import concurrent.futures
+import contextlib
+import csv
+import email.parser
+import functools
+import hashlib
+import logging
 import os
+import re
 import shutil
-import subprocess
+import stat
+import threading
+import time
+import zipfile
+import zlib
+from typing import Any, Callable, Iterable, TypeVar
 
+from . import cache
+from .workspace import COPY_BUFSIZE, make_workdir, move_file
 
-def unpackwheels(wheels: list[str], workdir: str) -> list[str]:
+logger = logging.getLogger(__name__)
+
+# Members are written in Zip64 format as soon as they get close to
+# the limit of the standard format. Compressed data can be slightly
+# bigger than the original one, so a margin is left for that.
+ZIP64_THRESHOLD = zipfile.ZIP64_LIMIT // 2
+
+# Wheels queued or in progress at the same time in each stage of the pipeline,
+# it bounds the memory used to track them and the work that is wasted
+# when one fails.
+PIPELINE_DEPTH = 2 * (os.cpu_count() or 1)
+
+# The ZIP format can't represent timestamps before 1980
+MINIMUM_TIMESTAMP = 315532800
+
+# Host system recorded in reproducible wheels, regardless of where they are built
+ZIP_UNIX_SYSTEM = 3
+
+WHEEL_NAME_RE = re.compile(
+    r"^(?P<namever>(?P<name>[^\s-]+?)-(?P<ver>[^\s-]+?))"
+    r"(-(?P<build>\d[^\s-]*))?-(?P<pyver>[^\s-]+?)-(?P<abi>[^\s-]+?)"
+    r"-(?P<plat>\S+)\.whl$"
+)
+DIST_INFO_RE = re.compile(r"^(?P<namever>(?P<name>.+?)-(?P<ver>\d.*?))\.dist-info$")
+# Platform tags that only differ by the version of the OS or libc they need
+PLATFORM_TAG_RE = re.compile(
+    r"^(?P<os>manylinux|musllinux|macosx)(_\d+_\d+|1|2010|2014)_(?P<arch>.+)$"
+)
+PYTHON_TAG_RE = re.compile(r"^(?P<impl>[a-z]+)(?P<major>\d)(?P<minor>\d*)$")
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def unpackwheels(
+    wheels: list[str], workdir: str, cachedir: str | None = None
+) -> list[str]:
     """Unpack multiple wheels into workdir and returns list of resulting directories.
 
     All provided paths are expected to be in absolute format
     and the returned results are absolute paths too.
+
+    Wheels are unpacked concurrently, the content of their members
+    is streamed to disk so that memory usage doesn't depend on their size.
+
+    When ``cachedir`` is provided, wheels that were already unpacked
+    there are linked from it instead, see ``cache.unpack_cached``.
+    """
+    return [
+        wheeldir for wheeldir, _ in unpack_and_scan(wheels, workdir, cachedir=cachedir)
+    ]
+
+
+def unpack_and_scan(
+    wheels: list[str],
+    workdir: str,
+    scan: Callable[[str], T] | None = None,
+    cachedir: str | None = None,
+) -> list[tuple[str, T | None]]:
+    """Unpack multiple wheels like ``unpackwheels`` and scan each one of them.
+
+    ``scan`` is called with the directory of each wheel as soon as
+    that wheel is unpacked, while the others are still being unpacked.
+    Returns the directory of each wheel with the result of its scan.
     """
     if os.listdir(workdir):
         raise ValueError("workdir must be empty")
+    return _run_stage(
+        functools.partial(_unpack_and_scan, workdir, scan, cachedir), wheels
+    )
 
-    resulting_wheeldirs = []
-    tmpdir = os.path.join(workdir, "tmp")
-    for wheel in wheels:
-        if subprocess.call(["wheel", "unpack", wheel, "--dest", tmpdir]):
-            raise RuntimeError(f"Unable to unpack {wheel}")
 
-        # This is a bit of an hack to preserve order of directories
-        wheeldir = os.listdir(tmpdir)[0]
-        shutil.move(os.path.join(tmpdir, wheeldir), workdir)
-        resulting_wheeldirs.append(os.path.join(workdir, wheeldir))
+def cache_wheel(wheel: str, cachedir: str) -> None:
+    """Unpack a wheel in the cache, so that it's not unpacked when it's consolidated.
 
-    return resulting_wheeldirs
+    See ``cache.unpack_cached``.
+    """
+    try:
+        cache.cached_tree(wheel, cachedir, _unpack_wheel)
+    except (OSError, ValueError, zipfile.BadZipFile) as err:
+        raise RuntimeError(f"Unable to unpack {wheel}") from err
 
 
-def packwheels(wheeldirs: list[str], destdir: str) -> list[str]:
+def packwheels(
+    wheeldirs: list[str],
+    destdir: str,
+    workdir: str | None = None,
+    reproducible: bool = False,
+) -> list[str]:
     """Pack multiple wheel directories as wheel files into a destination path.
 
     If the destination path doesn't exist it will be created.
+
+    Wheels are packed concurrently, the content of their files
+    is streamed into the archive so that memory usage doesn't depend
+    on their size. The RECORD of each wheel is generated again.
+
+    Wheels are staged in a temporary directory inside ``workdir``
+    (``destdir`` by default) and then moved to ``destdir``,
+    which is just a rename when they are on the same filesystem.
+    Each wheel is published with an atomic rename, so concurrent
+    consolidations sharing ``destdir`` never see partially written wheels.
+
+    When ``reproducible`` is set, the same content always produces
+    the same wheel: timestamps are set to ``SOURCE_DATE_EPOCH``, or to
+    the oldest date a ZIP file supports, and permissions are normalized.
+    """
+    packed = patch_and_pack(
+        wheeldirs, destdir, workdir=workdir, reproducible=reproducible
+    )
+    return [wheel for wheel, _ in packed]
+
+
+def patch_and_pack(
+    wheeldirs: list[str],
+    destdir: str,
+    patch: Callable[[str], T] | None = None,
+    workdir: str | None = None,
+    reproducible: bool = False,
+) -> list[tuple[str, T | None]]:
+    """Patch multiple wheel directories and pack them like ``packwheels``.
+
+    ``patch`` is called with each wheel directory, and the wheel is
+    packed as soon as it returns, while the other wheels are still
+    being patched. Returns each packed wheel with the result of its patch.
+    """
+    os.makedirs(destdir, exist_ok=True)
+    with make_workdir(workdir or destdir, prefix="pack-") as tmpdir:
+        staged = _run_stage(
+            functools.partial(_patch_and_pack, tmpdir, patch, reproducible),
+            list(enumerate(wheeldirs)),
+        )
+
+        packed = []
+        for staged_wheel, patched in staged:
+            wheel = os.path.join(destdir, os.path.basename(staged_wheel))
+            move_file(staged_wheel, wheel)
+            packed.append((wheel, patched))
+    return packed
+
+
+def wheels_size(wheels: list[str]) -> tuple[int, int]:
+    """Total compressed and uncompressed size of the wheels.
+
+    Only the central directory of each wheel is read,
+    the members are not decompressed.
+    """
+    compressed = uncompressed = 0
+    for wheel in wheels:
+        try:
+            with zipfile.ZipFile(wheel) as wf:
+                uncompressed += sum(zinfo.file_size for zinfo in wf.infolist())
+            compressed += os.path.getsize(wheel)
+        except (OSError, zipfile.BadZipFile) as err:
+            raise ValueError(f"Unable to read {wheel}: {err}") from err
+    return compressed, uncompressed
+
+
+def verify_wheels(wheels: list[str]) -> None:
+    """Check that the members of the wheels match the RECORD of each wheel.
+
+    Every member is decompressed and its digest and size are compared
+    with the ones in RECORD, members missing from RECORD or from the
+    wheel are reported too. Truncated archives and members that don't
+    match their CRC are detected by ``zipfile`` itself.
+
+    Members are streamed, and verified concurrently across
+    ``PIPELINE_DEPTH`` wheels at a time, as decompressing and hashing
+    them doesn't hold the GIL.
+
+    Raises ``ValueError`` for the first problem that is found.
+    """
+    for start in range(0, len(wheels), PIPELINE_DEPTH):
+        end = start + PIPELINE_DEPTH
+        with contextlib.ExitStack() as stack:
+            members = []
+            for wheel in wheels[start:end]:
+                try:
+                    wf = stack.enter_context(zipfile.ZipFile(wheel))
+                    record_path, records = _read_record(wf)
+                except (OSError, zipfile.BadZipFile) as err:
+                    raise ValueError(f"Unable to read {wheel}: {err}") from err
+                # Only RECORD and its signatures can't record their own hash.
+                unhashed = {record_path + suffix for suffix in ("", ".jws", ".p7s")}
+                lock = threading.Lock()
+                for zinfo in wf.infolist():
+                    if zinfo.is_dir():
+                        continue
+                    if zinfo.filename in unhashed:
+                        records.pop(zinfo.filename, None)
+                        continue
+                    if zinfo.filename not in records:
+                        raise ValueError(
+                            f"{wheel}: {zinfo.filename} is not listed in RECORD"
+                        )
+                    recorded = records.pop(zinfo.filename)
+                    if not recorded[0]:
+                        raise ValueError(
+                            f"{wheel}: {zinfo.filename} has no hash in RECORD"
+                        )
+                    members.append((wheel, wf, lock, zinfo, recorded))
+                if records:
+                    raise ValueError(
+                        f"{wheel}: {', '.join(sorted(records))} listed in RECORD "
+                        "but missing"
+                    )
+            _run_stage(_verify_member, members)
+
+
+def group_wheels(wheels: Iterable[str]) -> dict[str, list[str]]:
+    """Group wheels by the interpreter and the platform they are for.
+
+    Each group is a set of wheels that can be installed together,
+    so wheels are consolidated within their group only.
+    Platform tags are compared by OS and architecture, so wheels that
+    need different manylinux or macOS versions go together, and groups
+    are keyed by ``{python tag}-{platform}``, like ``cp310-linux_x86_64``.
+
+    Wheels that work with multiple interpreters or platforms, like abi3
+    and pure wheels, join the group of the wheels they can be installed with.
+    When they can be installed with more than one group they are
+    consolidated on their own, and a warning is logged.
+    Groups preserve the order in which wheels were provided.
+    """
+    tagged = []
+    for wheel in wheels:
+        match = WHEEL_NAME_RE.match(os.path.basename(wheel))
+        if match is None:
+            raise ValueError(f"Invalid wheel filename: {wheel}")
+        platforms = frozenset(
+            _platform_family(tag) for tag in match.group("plat").split(".")
+        )
+        group = f"{match.group('pyver')}-{'.'.join(sorted(platforms))}"
+        tagged.append(
+            (wheel, group, match.group("pyver"), match.group("abi"), platforms)
+        )
+
+    specific = {
+        group: (pyver, platforms)
+        for _, group, pyver, abi, platforms in tagged
+        if abi not in ("abi3", "none") and "any" not in platforms
+    }
+    groups = {}  # type: dict[str, list[str]]
+    for wheel, group, pyver, abi, platforms in tagged:
+        if group not in specific:
+            compatible = [
+                specific_group
+                for specific_group, (group_pyver, group_platforms) in specific.items()
+                if _python_compatible(pyver, abi, group_pyver)
+                and ("any" in platforms or platforms & group_platforms)
+            ]
+            if len(compatible) == 1:
+                group = compatible[0]
+            elif compatible:
+                logger.warning(
+                    f"Warning: {os.path.basename(wheel)} can be installed with "
+                    f"the wheels of {', '.join(compatible)}, "
+                    "it's consolidated on its own"
+                )
+        groups.setdefault(group, []).append(wheel)
+    return groups
+
+
+def wheel_platform(wheel: str) -> str | None:
+    """Detect the platform a wheel was built for from its platform tags.
+
+    Returns ``linux``, ``windows`` or ``macos``, or ``None`` for pure
+    wheels and files whose name is not a valid wheel name.
     """
-    tmpdir = os.path.join(destdir, "tmp")
-    os.makedirs(tmpdir, exist_ok=True)
+    match = WHEEL_NAME_RE.match(os.path.basename(wheel))
+    if match is None:
+        return None
+    for tag in match.group("plat").split("."):
+        if tag.startswith("win"):
+            return "windows"
+        elif tag.startswith("macosx"):
+            return "macos"
+        elif tag.startswith(("linux", "manylinux", "musllinux")):
+            return "linux"
+    return None
+
+
+def find_dist_info(wheeldir: str) -> str:
+    """Name of the .dist-info directory of an unpacked wheel."""
+    dist_info_dirs = [
+        fn
+        for fn in os.listdir(wheeldir)
+        if os.path.isdir(os.path.join(wheeldir, fn)) and DIST_INFO_RE.match(fn)
+    ]
+    if len(dist_info_dirs) != 1:
+        raise ValueError(f"Expected one .dist-info directory in {wheeldir}")
+    return dist_info_dirs[0]
+
+
+def libs_wheel_distname(prefix: str) -> str:
+    """Name of the wheel that provides the libraries when ``prefix`` is used."""
+    return re.sub(r"[-_.]+", "_", prefix) + "_libs"
 
-    resulting_wheels = []
+
+def find_libs_wheeldir(wheeldirs: list[str], prefix: str) -> str | None:
+    """Find the directory of the wheel created by ``dedupe.make_libs_wheel``."""
+    distname = libs_wheel_distname(prefix)
     for wheeldir in wheeldirs:
-        if subprocess.call(["wheel", "pack", wheeldir, "--dest-dir", tmpdir]):
-            raise RuntimeError(f"Unable to pack {wheeldir} into {tmpdir}")
-
-        # This is a bit of an hack to preserve order of directories
-        wheel = os.listdir(tmpdir)[0]
-        expected_dest_file = os.path.join(destdir, wheel)
-        if os.path.exists(expected_dest_file):
-            # This is required by windows as it is unable to
-            # overwrite the existing file.
-            os.unlink(expected_dest_file)
-        shutil.move(os.path.join(tmpdir, wheel), destdir)
-        resulting_wheels.append(os.path.join(destdir, wheel))
-    return resulting_wheels
+        if os.path.basename(wheeldir).split("-", 1)[0] == distname:
+            return wheeldir
+    return None
+
+
+def _platform_family(tag: str) -> str:
+    """The OS and architecture of a platform tag, like ``linux_x86_64``."""
+    match = PLATFORM_TAG_RE.match(tag)
+    if match is None:
+        return tag
+    family = "linux" if match.group("os") == "manylinux" else match.group("os")
+    return f"{family}_{match.group('arch')}"
+
+
+def _python_compatible(pyver: str, abi: str, group_pyver: str) -> bool:
+    """Whether a wheel with ``pyver`` and ``abi`` works with ``group_pyver``.
+
+    Wheels for the stable ABI work with all the later minor versions,
+    pure ones with all the interpreters of the same major version.
+    """
+    for tag in pyver.split("."):
+        for group_tag in group_pyver.split("."):
+            if tag == group_tag:
+                return True
+            python = PYTHON_TAG_RE.match(tag)
+            group_python = PYTHON_TAG_RE.match(group_tag)
+            if (
+                python is None
+                or group_python is None
+                or python.group("major") != group_python.group("major")
+            ):
+                continue
+            if abi == "none" and python.group("impl") == "py":
+                return True
+            if (
+                abi == "abi3"
+                and python.group("impl") == group_python.group("impl")
+                and int(group_python.group("minor") or 0)
+                >= int(python.group("minor") or 0)
+            ):
+                return True
+    return False
+
+
+def _run_stage(func: Callable[[Any], R], items: list) -> list[R]:
+    """Call ``func`` concurrently for each one of the items, preserving their order.
+
+    At most ``PIPELINE_DEPTH`` items are queued or in progress at the same time.
+    When one of them fails, the others in progress are completed but
+    no more are started, and the error of the first failed item is raised.
+    """
+    results = {}  # type: dict[int, R]
+    errors = {}  # type: dict[int, BaseException]
+    pending = {}  # type: dict[concurrent.futures.Future, int]
+    queue = iter(enumerate(items))
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        while True:
+            while not errors and len(pending) < PIPELINE_DEPTH:
+                queued = next(queue, None)
+                if queued is None:
+                    break
+                pending[executor.submit(func, queued[1])] = queued[0]
+            if not pending:
+                break
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                idx = pending.pop(future)
+                try:
+                    results[idx] = future.result()
+                except Exception as err:
+                    errors[idx] = err
+    if errors:
+        raise errors[min(errors)]
+    return [results[idx] for idx in range(len(items))]
+
+
+def _read_record(wf: zipfile.ZipFile) -> tuple[str, dict[str, tuple[str, str]]]:
+    """The path of RECORD and the hash and size it records for each member.
+
+    Both are empty for members recorded without a hash, like RECORD itself.
+    """
+    record_paths = [
+        name
+        for name in wf.namelist()
+        if name.count("/") == 1 and name.endswith(".dist-info/RECORD")
+    ]
+    if len(record_paths) != 1:
+        raise zipfile.BadZipFile("Expected one .dist-info/RECORD file")
+    with wf.open(record_paths[0]) as record_f:
+        lines = record_f.read().decode("utf-8").splitlines()
+    records = {}
+    for row in csv.reader(lines):
+        if row:
+            path, digest, size = (row + ["", ""])[:3]
+            records[path] = (digest, size)
+    return record_paths[0], records
+
+
+def _verify_member(
+    member: tuple[
+        str, zipfile.ZipFile, threading.Lock, zipfile.ZipInfo, tuple[str, str]
+    ]
+) -> None:
+    wheel, wf, lock, zinfo, (recorded_digest, recorded_size) = member
+    algorithm, _, expected_digest = recorded_digest.partition("=")
+    try:
+        digest = hashlib.new(algorithm)
+    except ValueError as err:
+        raise ValueError(f"{wheel}: unsupported hash for {zinfo.filename}") from err
+    size = 0
+    try:
+        # Reads are already serialized by zipfile, but opening and closing
+        # members update a reference count of the archive that is not.
+        with lock:
+            src = wf.open(zinfo)
+        try:
+            for chunk in iter(lambda: src.read(COPY_BUFSIZE), b""):
+                digest.update(chunk)
+                size += len(chunk)
+        finally:
+            with lock:
+                src.close()
+    except (OSError, zipfile.BadZipFile, EOFError, zlib.error) as err:
+        raise ValueError(f"{wheel}: {zinfo.filename} is corrupted: {err}") from err
+    encoded_digest = base64.urlsafe_b64encode(digest.digest()).rstrip(b"=")
+    if encoded_digest.decode("ascii") != expected_digest or (
+        recorded_size and int(recorded_size) != size
+    ):
+        raise ValueError(f"{wheel}: {zinfo.filename} doesn't match its RECORD")
+
+
+def _unpack_and_scan(
+    workdir: str, scan: Callable[[str], T] | None, cachedir: str | None, wheel: str
+) -> tuple[str, T | None]:
+    try:
+        if cachedir is not None:
+            wheeldir = cache.unpack_cached(wheel, workdir, cachedir, _unpack_wheel)
+        else:
+            wheeldir = _unpack_wheel(wheel, workdir)
+    except (OSError, ValueError, zipfile.BadZipFile) as err:
+        raise RuntimeError(f"Unable to unpack {wheel}") from err
+    return wheeldir, scan(wheeldir) if scan is not None else None
+
+
+def _patch_and_pack(
+    tmpdir: str,
+    patch: Callable[[str], T] | None,
+    reproducible: bool,
+    indexed_wheeldir: tuple[int, str],
+) -> tuple[str, T | None]:
+    idx, wheeldir = indexed_wheeldir
+    patched = patch(wheeldir) if patch is not None else None
+    try:
+        return _pack_wheel(wheeldir, tmpdir, str(idx), reproducible), patched
+    except (OSError, ValueError) as err:
+        raise RuntimeError(f"Unable to pack {wheeldir}") from err
+
+
+def _unpack_wheel(wheel: str, workdir: str) -> str:
+    """Extract a wheel in a directory named after its name and version."""
+    match = WHEEL_NAME_RE.match(os.path.basename(wheel))
+    if match is None:
+        raise ValueError(f"Invalid wheel filename: {wheel}")
+    wheeldir = os.path.join(workdir, match.group("namever"))
+
+    with zipfile.ZipFile(wheel) as wf:
+        for zinfo in wf.infolist():
+            path = os.path.normpath(os.path.join(wheeldir, zinfo.filename))
+            if os.path.commonpath([wheeldir, path]) != wheeldir:
+                raise ValueError(f"Member {zinfo.filename} is outside of the wheel")
+            if zinfo.is_dir():
+                os.makedirs(path, exist_ok=True)
+                continue
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with wf.open(zinfo) as src, open(path, "wb") as dst:
+                shutil.copyfileobj(src, dst, COPY_BUFSIZE)
+            permissions = zinfo.external_attr >> 16 & 0o777
+            if permissions:
+                os.chmod(path, permissions)
+    return wheeldir
+
+
+def _pack_wheel(
+    wheeldir: str, tmpdir: str, stagingname: str, reproducible: bool = False
+) -> str:
+    """Pack a wheel directory, the wheel name is computed from its metadata.
+
+    The wheel is written in its own ``stagingname`` directory inside ``tmpdir``.
+    """
+    dist_info_dir = find_dist_info(wheeldir)
+    name_version = DIST_INFO_RE.match(dist_info_dir).group("namever")  # type: ignore
+
+    with open(os.path.join(wheeldir, dist_info_dir, "WHEEL")) as wheel_f:
+        wheel_info = email.parser.Parser().parse(wheel_f)
+    tags = wheel_info.get_all("Tag", [])
+    if not tags:
+        raise ValueError(f"No tags present in {dist_info_dir}/WHEEL")
+    if wheel_info.get("Build"):
+        name_version += "-" + wheel_info["Build"]
+
+    stagingdir = os.path.join(tmpdir, stagingname)
+    os.makedirs(stagingdir)
+    wheel_filename = f"{name_version}-{_compute_tagline(tags)}.whl"
+    wheel_path = os.path.join(stagingdir, wheel_filename)
+    record_path = f"{dist_info_dir}/RECORD"
+    files = []
+    deferred = []
+    for root, dirnames, filenames in os.walk(wheeldir):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.join(root, name)
+            arcname = os.path.relpath(path, wheeldir).replace(os.path.sep, "/")
+            if arcname == record_path:
+                continue
+            elif arcname.startswith(f"{dist_info_dir}/"):
+                # Metadata is placed at the end of the archive
+                deferred.append((path, arcname))
+            else:
+                files.append((path, arcname))
+
+    logger.info(f"Repacking wheel as {wheel_path}")
+    records = []
+    with zipfile.ZipFile(wheel_path, "w", compression=zipfile.ZIP_DEFLATED) as wf:
+        for path, arcname in files + sorted(deferred):
+            digest, size = _write_member(wf, path, arcname, reproducible)
+            records.append(f"{arcname},sha256={digest},{size}\n")
+        records.append(f"{record_path},,\n")
+        zinfo = zipfile.ZipInfo(
+            record_path, date_time=_zipinfo_datetime(reproducible=reproducible)
+        )
+        if reproducible:
+            zinfo.create_system = ZIP_UNIX_SYSTEM
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zinfo.external_attr = (0o664 | stat.S_IFREG) << 16
+        wf.writestr(zinfo, "".join(records))
+    return wheel_path
+
+
+def _write_member(
+    wf: zipfile.ZipFile, path: str, arcname: str, reproducible: bool = False
+) -> tuple[str, int]:
+    """Stream a file into the archive, returning its RECORD hash and size."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as src:
+        st = os.fstat(src.fileno())
+        zinfo = zipfile.ZipInfo(
+            arcname, date_time=_zipinfo_datetime(st.st_mtime, reproducible)
+        )
+        mode = stat.S_IMODE(st.st_mode)
+        if reproducible:
+            # Only whether the file is executable matters,
+            # not the umask of who unpacked it.
+            mode = 0o755 if mode & 0o111 else 0o644
+            zinfo.create_system = ZIP_UNIX_SYSTEM
+        zinfo.external_attr = (mode | stat.S_IFMT(st.st_mode)) << 16
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zinfo.file_size = st.st_size
+        force_zip64 = st.st_size >= ZIP64_THRESHOLD
+        with wf.open(zinfo, "w", force_zip64=force_zip64) as dst:
+            for chunk in iter(lambda: src.read(COPY_BUFSIZE), b""):
+                digest.update(chunk)
+                dst.write(chunk)
+    encoded_digest = base64.urlsafe_b64encode(digest.digest()).rstrip(b"=")
+    return encoded_digest.decode("ascii"), st.st_size
+
+
+def _zipinfo_datetime(
+    timestamp: float | None = None, reproducible: bool = False
+) -> tuple:
+    if reproducible:
+        timestamp = MINIMUM_TIMESTAMP
+    timestamp = int(os.environ.get("SOURCE_DATE_EPOCH", timestamp or time.time()))
+    return time.gmtime(max(timestamp, MINIMUM_TIMESTAMP))[0:6]
+
+
+def _compute_tagline(tags: list[str]) -> str:
+    impls = sorted({tag.split("-")[0] for tag in tags})
+    abivers = sorted({tag.split("-")[1] for tag in tags})
+    platforms = sorted({tag.split("-")[2] for tag in tags})
+    return "-".join([".".join(impls), ".".join(abivers), ".".join(platforms)])
@@ -0,0 +1,204 @@
+from __future__ import annotations
+
+import contextlib
+import errno
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import uuid
+from typing import Iterator
+
+# Size of the buffer used to stream the content of files,
+# regardless of how big wheels are, memory usage is bounded by this.
+COPY_BUFSIZE = 1024 * 1024
+
+# ioctl request to share the extents of a file on copy-on-write
+# filesystems like btrfs or xfs, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+
+@contextlib.contextmanager
+def make_workdir(
+    basedir: str | None, prefix: str = "consolidatewheels-"
+) -> Iterator[str]:
+    """Create a temporary working directory inside ``basedir``.
+
+    The directory is removed with all its content when the context exits.
+    When ``basedir`` is None the system temporary directory is used.
+    """
+    if basedir is not None:
+        os.makedirs(basedir, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=basedir, prefix=f".{prefix}") as tmpdir:
+        yield tmpdir
+
+
+def same_filesystem(path: str, otherpath: str) -> bool:
+    """Check if two existing paths live on the same filesystem."""
+    return os.stat(path).st_dev == os.stat(otherpath).st_dev
+
+
+def existing_parent(path: str) -> str:
+    """The nearest directory containing ``path`` that already exists."""
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def free_space(path: str) -> int:
+    """Bytes available on the filesystem where ``path`` is or will be created."""
+    return shutil.disk_usage(existing_parent(path)).free
+
+
+def move_file(src: str, dst: str) -> None:
+    """Move a file, replacing the destination if it exists.
+
+    This is a rename when source and destination are on the same
+    filesystem, otherwise the file is cloned or copied next to
+    the destination and then renamed over it.
+    """
+    try:
+        os.replace(src, dst)
+        return
+    except OSError as err:
+        if err.errno != errno.EXDEV:
+            raise
+
+    with atomic_target(dst) as tmpdst:
+        clone_file(src, tmpdst)
+    os.unlink(src)
+
+
+def write_atomic(path: str, data: bytes) -> None:
+    """Replace the content of a file so that readers never see it partially written.
+
+    The data is written to a temporary file next to ``path``,
+    which is then renamed over it, preserving its permissions.
+    """
+    with atomic_target(path) as tmppath:
+        with open(tmppath, "wb") as f:
+            f.write(data)
+        if os.path.exists(path):
+            shutil.copymode(path, tmppath)
+
+
+@contextlib.contextmanager
+def atomic_target(path: str) -> Iterator[str]:
+    """Provide a temporary path that is renamed to ``path`` when the context exits.
+
+    The temporary path is next to ``path`` and unique, so that concurrent
+    writers, even threads of the same process, never share it.
+    Readers only ever see the previous or the complete new file, and
+    nothing is left behind when the context exits with an error.
+    """
+    tmppath = f"{path}.{uuid.uuid4().hex[:16]}.tmp"
+    try:
+        yield tmppath
+        os.replace(tmppath, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmppath)
+        raise
+
+
+@contextlib.contextmanager
+def locked(path: str) -> Iterator[None]:
+    """Hold an exclusive lock on the file ``path`` until the context exits.
+
+    The file is created when it doesn't exist and it's left in place,
+    as removing it would let another process lock a different file.
+    Whoever else locks the same path waits for the lock to be released.
+    """
+    with open(path, "a+b") as lock_f:
+        if sys.platform == "win32":  # pragma: no cover
+            import msvcrt
+
+            while True:
+                try:
+                    # Gives up with an error after trying for 10 seconds.
+                    msvcrt.locking(lock_f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+            try:
+                yield
+            finally:
+                msvcrt.locking(lock_f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+
+            fcntl.flock(lock_f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_f, fcntl.LOCK_UN)
+
+
+def clone_file(src: str, dst: str) -> None:
+    """Copy a file sharing its data with the source when possible.
+
+    On filesystems that support copy-on-write (btrfs, xfs, ...)
+    the copy is a reflink and no data is actually copied.
+    Otherwise it falls back to a regular copy.
+    """
+    with open(src, "rb") as srcf, open(dst, "wb") as dstf:
+        if not _reflink(srcf.fileno(), dstf.fileno()):
+            shutil.copyfileobj(srcf, dstf, COPY_BUFSIZE)
+    shutil.copystat(src, dst)
+
+
+def link_tree(src: str, dst: str) -> None:
+    """Replicate the directory ``src`` in ``dst`` without copying file contents.
+
+    Files are hardlinked, so they must be detached with ``detach_file``
+    before being modified in place. When ``dst`` is on a different
+    filesystem they are cloned instead, see ``clone_file``.
+    """
+    for root, _, filenames in os.walk(src):
+        dstroot = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(dstroot, exist_ok=True)
+        for filename in filenames:
+            srcpath = os.path.join(root, filename)
+            dstpath = os.path.join(dstroot, filename)
+            try:
+                os.link(srcpath, dstpath)
+            except OSError:
+                clone_file(srcpath, dstpath)
+
+
+def detach_file(path: str | os.PathLike) -> None:
+    """Make sure that modifying a file in place doesn't affect its other links.
+
+    Files linked by ``link_tree`` share their content with the cache
+    they come from, so they are replaced by a copy of themselves,
+    which is a copy-on-write clone where the filesystem supports it.
+    """
+    path = os.fspath(path)
+    if os.stat(path).st_nlink > 1:
+        with atomic_target(path) as tmppath:
+            clone_file(path, tmppath)
+
+
+def file_sha256(path: str) -> str:
+    """Compute the sha256 digest of a file without loading it in memory."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(COPY_BUFSIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _reflink(srcfd: int, dstfd: int) -> bool:
+    try:
+        import fcntl
+    except ImportError:  # pragma: no cover
+        # Not available on Windows
+        return False
+
+    try:
+        fcntl.ioctl(dstfd, FICLONE, srcfd)
+    except OSError:
+        return False
+    return True
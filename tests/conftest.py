@@ -0,0 +1,313 @@
+from __future__ import annotations
+
+import struct
+
+import pytest
+
+from consolidatewheels import elf, macho
+
+
+def _build_macho(libid=None, dependencies=(), padding=0):
+    """Build a minimal 64bit little endian Mach-O dylib."""
+    commands = []
+    for cmd, name in [(macho.LC_ID_DYLIB, libid)] + [
+        (macho.LC_LOAD_DYLIB, dep) for dep in dependencies
+    ]:
+        if name is None:
+            continue
+        encoded = name.encode("utf-8") + b"\0"
+        size = macho.DYLIB_COMMAND_SIZE + len(encoded)
+        size += -size % 8
+        commands.append(
+            struct.pack("<IIIIII", cmd, size, 24, 2, 0x10000, 0x10000)
+            + encoded.ljust(size - 24, b"\0")
+        )
+
+    # A __TEXT segment with a single section right after the headers.
+    segment_size = 72 + 80
+    sizeofcmds = segment_size + sum(len(c) for c in commands)
+    text_offset = 32 + sizeofcmds + padding
+    section = struct.pack(
+        "<16s16sQQIIIIIIII",
+        b"__text",
+        b"__TEXT",
+        0,
+        4,
+        text_offset,
+        0,
+        0,
+        0,
+        0,
+        0,
+        0,
+        0,
+    )
+    segment = struct.pack(
+        "<II16sQQQQiiII",
+        macho.LC_SEGMENT_64,
+        segment_size,
+        b"__TEXT",
+        0,
+        0x1000,
+        0,
+        0x1000,
+        5,
+        5,
+        1,
+        0,
+    )
+    header = struct.pack(
+        "<IiiIIIII",
+        macho.MH_MAGIC_64,
+        0x01000007,
+        3,
+        6,
+        len(commands) + 1,
+        sizeofcmds,
+        0,
+        0,
+    )
+    return header + segment + section + b"".join(commands) + b"\0" * padding + b"CODE"
+
+
+@pytest.fixture
+def make_macho():
+    """Write a synthetic Mach-O library, universal when ``fat`` is set."""
+
+    def make(path, libid=None, dependencies=(), padding=0, fat=False):
+        binary = _build_macho(libid, dependencies, padding)
+        if fat:
+            # Two slices of the same library, aligned to 4KB.
+            header = struct.pack(">II", macho.FAT_MAGIC, 2)
+            header += struct.pack(">iiIII", 0x01000007, 3, 4096, len(binary), 12)
+            header += struct.pack(">iiIII", 0x0100000C, 0, 8192, len(binary), 12)
+            binary = header.ljust(4096, b"\0") + binary.ljust(4096, b"\0") + binary
+        with open(path, "wb") as f:
+            f.write(binary)
+        return path
+
+    return make
+
+
+def _build_elf(
+    needed=(),
+    soname=None,
+    is64=True,
+    endian="<",
+    slack=0,
+    versions=False,
+    symbols=(),
+    sections=(),
+):
+    """Build a minimal ELF shared object with only a dynamic section.
+
+    ``slack`` unused bytes are left at the end of the string table,
+    ``versions`` adds a version requirement for each needed library
+    and version definitions for the library itself, ``V1``
+    or the names it lists,
+    and ``symbols`` are dynamic symbols, listed in the section headers.
+    ``sections`` are the names and content of sections that are not
+    loaded in memory, placed after the loaded ones like linkers do.
+    """
+    defined = ["V1"] if versions is True else list(versions or ())
+    strings = b"\0"
+    offsets = {}
+    for name in [soname, *needed, *defined, *symbols]:
+        if name is not None and name not in offsets:
+            offsets[name] = len(strings)
+            strings += name.encode("utf-8") + b"\0"
+    strings += b"\0" * slack
+
+    entries = []
+    if soname is not None:
+        entries.append((elf.DT_SONAME, offsets[soname]))
+    entries += [(elf.DT_NEEDED, offsets[n]) for n in needed]
+    header_size, phentsize = (64, 56) if is64 else (52, 32)
+    dynstr_offset = header_size + 2 * phentsize
+    entries += [(elf.DT_STRTAB, dynstr_offset), (elf.DT_STRSZ, len(strings))]
+    entry_format = endian + ("qQ" if is64 else "iI")
+    entry_size = struct.calcsize(entry_format)
+    dynamic_offset = dynstr_offset + len(strings)
+    nentries = len(entries) + 1 + (4 if versions else 0) + (1 if symbols else 0)
+    verneed_offset = dynamic_offset + nentries * entry_size
+
+    verneed = b""
+    if versions:
+        entries += [(elf.DT_VERNEED, verneed_offset), (elf.DT_VERNEEDNUM, len(needed))]
+        for idx, name in enumerate(needed):
+            next_offset = 32 if idx < len(needed) - 1 else 0
+            verneed += struct.pack(
+                endian + "HHIII", 1, 1, offsets[name], 16, next_offset
+            )
+            verneed += struct.pack(
+                endian + "IHHII", 0x1234, 0, 2, offsets[defined[0]], 0
+            )
+        entries += [
+            (elf.DT_VERDEF, verneed_offset + len(verneed)),
+            (elf.DT_VERDEFNUM, len(defined)),
+        ]
+        for idx, name in enumerate(defined):
+            next_offset = 28 if idx < len(defined) - 1 else 0
+            verneed += struct.pack(
+                endian + "HHHHIII", 1, 0, idx + 2, 1, 0x1234, 20, next_offset
+            )
+            verneed += struct.pack(endian + "II", offsets[name], 0)
+    dynsym_offset = verneed_offset + len(verneed)
+
+    dynsym = b""
+    sym_size = 24 if is64 else 16
+    if symbols:
+        entries.append((elf.DT_SYMTAB, dynsym_offset))
+        dynsym = b"\0" * sym_size
+        for name in symbols:
+            dynsym += struct.pack(endian + "I", offsets[name]).ljust(sym_size, b"\0")
+    entries.append((elf.DT_NULL, 0))
+    dynamic = b"".join(struct.pack(entry_format, *entry) for entry in entries)
+    filesize = dynsym_offset + len(dynsym)
+
+    if is64:
+        section_format, section_size = "IIQQQQIIQQ", 64
+    else:
+        section_format, section_size = "IIIIIIIIII", 40
+    headers = []
+    if symbols:
+        headers.append(
+            struct.pack(
+                endian + section_format,
+                0,
+                elf.SHT_DYNSYM,
+                2,
+                dynsym_offset,
+                dynsym_offset,
+                len(dynsym),
+                0,
+                1,
+                8,
+                sym_size,
+            )
+        )
+    tail = b""
+    shstrndx = 0
+    if sections:
+        shstrtab = b"\0"
+        named = []
+        for name, content in [*sections, (".shstrtab", None)]:
+            named.append((len(shstrtab), content))
+            shstrtab += name.encode("utf-8") + b"\0"
+        for name_offset, content in named:
+            section_type = 1 if content is not None else 3
+            content = content if content is not None else shstrtab
+            tail += b"\0" * (-(filesize + len(tail)) % 8)
+            headers.append(
+                struct.pack(
+                    endian + section_format,
+                    name_offset,
+                    section_type,
+                    0,
+                    0,
+                    filesize + len(tail),
+                    len(content),
+                    0,
+                    0,
+                    8,
+                    0,
+                )
+            )
+            tail += content
+        tail += b"\0" * (-(filesize + len(tail)) % 8)
+        shstrndx = len(headers)
+    section_headers = b"\0" * section_size + b"".join(headers) if headers else b""
+    shoff = filesize + len(tail) if section_headers else 0
+    shnum = len(headers) + 1 if section_headers else 0
+
+    ident = elf.ELF_MAGIC + bytes(
+        [
+            elf.ELFCLASS64 if is64 else elf.ELFCLASS32,
+            elf.ELFDATA2LSB if endian == "<" else elf.ELFDATA2MSB,
+            1,
+        ]
+    )
+    ident = ident.ljust(16, b"\0")
+    if is64:
+        header = struct.pack(
+            endian + "HHIQQQIHHHHHH",
+            3,
+            62,
+            1,
+            0,
+            header_size,
+            shoff,
+            0,
+            header_size,
+            phentsize,
+            2,
+            64,
+            shnum,
+            shstrndx,
+        )
+        phdrs = struct.pack(
+            endian + "IIQQQQQQ", elf.PT_LOAD, 5, 0, 0, 0, filesize, filesize, 4096
+        ) + struct.pack(
+            endian + "IIQQQQQQ",
+            elf.PT_DYNAMIC,
+            6,
+            dynamic_offset,
+            dynamic_offset,
+            dynamic_offset,
+            len(dynamic),
+            len(dynamic),
+            8,
+        )
+    else:
+        header = struct.pack(
+            endian + "HHIIIIIHHHHHH",
+            3,
+            3,
+            1,
+            0,
+            header_size,
+            shoff,
+            0,
+            header_size,
+            phentsize,
+            2,
+            40,
+            shnum,
+            shstrndx,
+        )
+        phdrs = struct.pack(
+            endian + "IIIIIIII", elf.PT_LOAD, 0, 0, 0, filesize, filesize, 5, 4096
+        ) + struct.pack(
+            endian + "IIIIIIII",
+            elf.PT_DYNAMIC,
+            dynamic_offset,
+            dynamic_offset,
+            dynamic_offset,
+            len(dynamic),
+            len(dynamic),
+            6,
+            4,
+        )
+    return (
+        ident
+        + header
+        + phdrs
+        + strings
+        + dynamic
+        + verneed
+        + dynsym
+        + tail
+        + section_headers
+    )
+
+
+@pytest.fixture
+def make_elf():
+    """Write a synthetic ELF shared object depending on ``needed`` libraries."""
+
+    def make(path, needed=(), soname=None, is64=True, endian="<", **kwargs):
+        with open(path, "wb") as f:
+            f.write(_build_elf(needed, soname, is64, endian, **kwargs))
+        return path
+
+    return make
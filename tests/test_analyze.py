@@ -0,0 +1,159 @@
+from __future__ import annotations
+
+import json
+import os
+import subprocess
+import sys
+import zipfile
+from unittest import mock
+
+import pytest
+
+from consolidatewheels import analyze
+
+HERE = os.path.dirname(__file__)
+LIBTWO_WHEEL = os.path.join(
+    HERE, "files", "libtwo-0.0.0-cp310-cp310-manylinux1_x86_64.manylinux_2_5_x86_64.whl"
+)
+LIBFIRST_WHEEL = os.path.join(
+    HERE,
+    "files",
+    "libfirst-0.0.0-cp310-cp310-manylinux1_x86_64.manylinux_2_5_x86_64.whl",
+)
+
+
+def test_top_level_packages(tmpdir):
+    assert analyze.top_level_packages(LIBTWO_WHEEL) == ["libtwo"]
+    assert analyze.top_level_packages(LIBFIRST_WHEEL) == ["libfirst"]
+
+    wheel = str(tmpdir.join("one-1.0-py3-none-any.whl"))
+    with zipfile.ZipFile(wheel, "w") as wf:
+        wf.writestr("one/__init__.py", "")
+        wf.writestr("one/sub/__init__.py", "")
+        wf.writestr("one.libs/libfoo-3faccd3s.so", "")
+        wf.writestr("helper.py", "")
+        wf.writestr("_speedups.cpython-310-x86_64-linux-gnu.so", "")
+        wf.writestr("one-1.0.dist-info/METADATA", "")
+        wf.writestr("one-1.0.data/scripts/run.py", "")
+    assert analyze.top_level_packages(wheel) == ["_speedups", "helper", "one"]
+
+
+def test_summarize_maps(tmpdir):
+    envdir = str(tmpdir.join("env"))
+    site = os.path.join(os.path.realpath(envdir), "lib", "site-packages")
+    maps = "\n".join(
+        [
+            "7f0000000000-7f0000001000 r--p 00000000 00:00 0 ",
+            "7f0000001000-7f0000002000 rw-p 00000000 00:00 0 [heap]",
+            f"7f0000002000-7f0000004000 r-xp 00000000 08:01 1 {site}/one.libs/"
+            "libdbg-aaaa1111.so",
+            f"7f0000004000-7f0000005000 r--p 00002000 08:01 1 {site}/one.libs/"
+            "libdbg-aaaa1111.so",
+            f"7f0000005000-7f0000006000 r-xp 00000000 08:01 2 {site}/two.libs/"
+            "libdbg-bbbb2222.so",
+            f"7f0000006000-7f0000007000 r-xp 00000000 08:01 3 {site}/one/"
+            "_one.cpython-310-x86_64-linux-gnu.so",
+            f"7f0000007000-7f0000008000 r--p 00000000 08:01 4 {site}/one/data.bin",
+            "7f0000008000-7f0000009000 r-xp 00000000 08:01 5 /usr/lib/libc.so.6",
+        ]
+    )
+    assert analyze.summarize_maps(maps, envdir) == {
+        "mapped_bytes": 0x5000,
+        "libraries": {"libdbg.so": 2},
+    }
+    assert analyze.summarize_maps("", envdir) == {"mapped_bytes": 0, "libraries": {}}
+
+
+def test_probe(tmpdir):
+    measures = analyze.probe(sys.executable, str(tmpdir), ["json", "email"])
+    assert measures["seconds"] > 0
+    assert measures["error"] is None
+    assert measures["mapped_bytes"] == 0
+    assert measures["libraries"] == {}
+
+    measures = analyze.probe(sys.executable, str(tmpdir), ["json", "nonexisting"])
+    assert measures["error"].startswith("nonexisting: ModuleNotFoundError")
+
+    with mock.patch(
+        "subprocess.run",
+        side_effect=subprocess.CalledProcessError(-11, ["python"]),
+    ):
+        with pytest.raises(
+            RuntimeError, match="Interpreter failed importing one, two: exit code -11"
+        ):
+            analyze.probe(sys.executable, str(tmpdir), ["one", "two"])
+
+
+def test_create_env(tmpdir):
+    envdir = str(tmpdir.join("env"))
+    python = os.path.join(envdir, "bin", "python")
+    with mock.patch("subprocess.run") as run:
+        assert analyze.create_env(envdir, [LIBTWO_WHEEL]) == python
+    assert run.call_args_list[0][0][0] == [sys.executable, "-m", "venv", envdir]
+    install = run.call_args_list[1][0][0]
+    assert install[:4] == [python, "-m", "pip", "install"]
+    assert "--no-index" in install and "--no-deps" in install
+    assert install[-1] == LIBTWO_WHEEL
+
+    with mock.patch(
+        "subprocess.run",
+        side_effect=[
+            None,
+            subprocess.CalledProcessError(
+                1, ["pip"], stderr=b"ERROR: not a supported wheel\n"
+            ),
+        ],
+    ):
+        with pytest.raises(
+            RuntimeError,
+            match="Unable to install the wheels: ERROR: not a supported wheel$",
+        ):
+            analyze.create_env(envdir, [LIBTWO_WHEEL])
+
+
+def test_analyze_wheels(tmpdir):
+    def fake_run(command, check, capture_output, cwd=None):
+        if command[1:3] != ["-I", "-c"]:
+            return None
+        envdir = os.path.realpath(cwd)
+        maps = "".join(
+            f"7f0000000000-7f0000001000 r-xp 00000000 08:01 1 {envdir}/lib/"
+            f"{package}.libs/libfoo-{package}.so\n"
+            for package in command[4:]
+        )
+        stdout = json.dumps({"seconds": 0.5, "error": None, "maps": maps})
+        return subprocess.CompletedProcess(command, 0, stdout.encode("utf-8"))
+
+    with mock.patch("subprocess.run", side_effect=fake_run) as run:
+        report = analyze.analyze_wheels(
+            [LIBTWO_WHEEL, LIBFIRST_WHEEL], workdir=str(tmpdir)
+        )
+    assert report == {
+        "packages": {
+            "libfirst": {
+                "seconds": 0.5,
+                "error": None,
+                "mapped_bytes": 4096,
+                "libraries": {"libfoo.so": 1},
+            },
+            "libtwo": {
+                "seconds": 0.5,
+                "error": None,
+                "mapped_bytes": 4096,
+                "libraries": {"libfoo.so": 1},
+            },
+        },
+        "all": {
+            "seconds": 0.5,
+            "error": None,
+            "mapped_bytes": 8192,
+            "libraries": {"libfoo.so": 2},
+        },
+    }
+    assert run.call_count == 5
+    # The virtual environment is removed once analyzed.
+    assert tmpdir.listdir() == []
+
+    with mock.patch("os.path.exists", return_value=False):
+        with pytest.raises(RuntimeError, match="can only be analyzed on Linux"):
+            analyze.analyze_wheels([LIBTWO_WHEEL])
@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+import logging
+import os
+import zipfile
+from unittest import mock
+
+import pytest
+
+from consolidatewheels import api
+
+HERE = os.path.dirname(__file__)
+FIXTURE_FILES = {
+    "libtwo.whl": os.path.join(
+        HERE,
+        "files",
+        "libtwo-0.0.0-cp310-cp310-manylinux1_x86_64.manylinux_2_5_x86_64.whl",
+    ),
+    "libfirst.whl": os.path.join(
+        HERE,
+        "files",
+        "libfirst-0.0.0-cp310-cp310-manylinux1_x86_64.manylinux_2_5_x86_64.whl",
+    ),
+}
+
+
+@pytest.fixture(autouse=True)
+def requirements_satisfied():
+    with mock.patch(
+        "consolidatewheels.main.requirements_satisfied", return_value=True
+    ) as requirements_satisfied:
+        yield requirements_satisfied
+
+
+def test_consolidate(tmpdir, capsys, caplog):
+    caplog.set_level(logging.INFO)
+    dest = os.path.join(tmpdir, "dest")
+    with mock.patch("consolidatewheels.consolidate_linux.run_tools"), mock.patch(
+        "consolidatewheels.elf.needed_libraries", return_value=["libfoo-3faccd3s.so"]
+    ):
+        result = api.consolidate(
+            [FIXTURE_FILES["libtwo.whl"], FIXTURE_FILES["libfirst.whl"]],
+            dest,
+            target="linux",
+            jobs=1,
+        )
+    assert sorted(os.path.basename(output) for output in result.outputs) == sorted(
+        os.path.basename(wheel) for wheel in FIXTURE_FILES.values()
+    )
+    assert all(os.path.dirname(output) == dest for output in result.outputs)
+    group = "cp310-linux_x86_64"
+    assert result.mangling_map[group]["libfoo.so"] == "libfoo-3fac4b7b.so"
+    assert result.providers[group]["libfoo.so"] == "libfirst"
+    assert os.path.join("libtwo-0.0.0", "libtwo.libs", "libfoo-3faccd3s.so") in (
+        result.removed
+    )
+    assert result.bytes_saved > 0
+    assert result.patched > 0
+    assert len(result.patched_files) == result.patched
+    assert (
+        os.path.join(
+            "libtwo-0.0.0", "libtwo", "_libtwo.cpython-310-x86_64-linux-gnu.so"
+        )
+        in result.patched_files
+    )
+    assert not result.failures
+    assert set(result.timings) == {"discover", "consolidate", "manifest"}
+    # Progress is logged instead of printed.
+    assert capsys.readouterr().out == ""
+    assert "Manifest written to" in caplog.text
+
+    # Consolidated wheels are passed through as they are.
+    again = api.consolidate(
+        [os.path.join(dest, "*.whl")], os.path.join(tmpdir, "again")
+    )
+    assert sorted(os.path.basename(output) for output in again.outputs) == sorted(
+        os.path.basename(output) for output in result.outputs
+    )
+    assert again.patched == 0
+    assert again.patched_files == []
+
+
+def test_consolidate_failures(tmpdir):
+    # Groups that fail are reported without raising.
+    with mock.patch(
+        "consolidatewheels.consolidate_linux.consolidate",
+        side_effect=RuntimeError("Unable to apply mangling"),
+    ):
+        result = api.consolidate(
+            [FIXTURE_FILES["libtwo.whl"]], os.path.join(tmpdir, "dest")
+        )
+    assert result.outputs == []
+    assert [str(err) for err in result.failures.values()] == [
+        "Unable to apply mangling"
+    ]
+
+    # Options that can't work together are refused.
+    with pytest.raises(ValueError, match="Unsupported target os2"):
+        api.consolidate([FIXTURE_FILES["libtwo.whl"]], target="os2")
+    with pytest.raises(ValueError, match="can't be used together"):
+        api.consolidate(
+            [FIXTURE_FILES["libtwo.whl"]], libs_wheel="family", against="lock.json"
+        )
+
+    # When wheels can't be consolidated at all, errors are raised.
+    with mock.patch(
+        "consolidatewheels.main.check_disk_space", return_value=False
+    ), pytest.raises(RuntimeError, match="Not enough free space"):
+        api.consolidate([FIXTURE_FILES["libtwo.whl"]], os.path.join(tmpdir, "full"))
+
+
+def _patch_in_place(commands):
+    # Like patchelf, write the patched libraries over the original ones.
+    for command in commands:
+        with open(command[-1], "r+b") as f:
+            f.write(b"patched")
+
+
+def test_consolidate_cache(tmpdir):
+    cachedir = os.path.join(tmpdir, "cache")
+    with mock.patch(
+        "consolidatewheels.consolidate_linux.run_tools", side_effect=_patch_in_place
+    ), mock.patch(
+        "consolidatewheels.elf.needed_libraries", return_value=["libfoo-3faccd3s.so"]
+    ):
+        for run in ("first", "second"):
+            result = api.consolidate(
+                [FIXTURE_FILES["libtwo.whl"], FIXTURE_FILES["libfirst.whl"]],
+                os.path.join(tmpdir, run),
+                target="linux",
+                cache_dir=cachedir,
+            )
+            assert result.patched > 0
+
+    # Libraries patched in the workdir are left untouched in the cache.
+    treesdir = os.path.join(cachedir, "trees")
+    (tree,) = [
+        os.path.join(treesdir, tree, "libtwo-0.0.0")
+        for tree in os.listdir(treesdir)
+        if os.path.exists(os.path.join(treesdir, tree, "libtwo-0.0.0"))
+    ]
+    with zipfile.ZipFile(FIXTURE_FILES["libtwo.whl"]) as wf:
+        for zinfo in wf.infolist():
+            if not zinfo.is_dir():
+                with open(os.path.join(tree, zinfo.filename), "rb") as f:
+                    assert f.read() == wf.read(zinfo)
+
+    # The cache was pruned to its maximum size.
+    with mock.patch("consolidatewheels.consolidate_linux.run_tools"):
+        api.consolidate(
+            [FIXTURE_FILES["libtwo.whl"]],
+            os.path.join(tmpdir, "third"),
+            target="linux",
+            cache_dir=cachedir,
+            cache_max_size=0,
+        )
+    assert os.listdir(treesdir) == []
@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+import os
+from unittest import mock
+
+import pytest
+
+from consolidatewheels import cache, wheelsfunc, workspace
+
+HERE = os.path.dirname(__file__)
+LIBTWO_WHEEL = os.path.join(
+    HERE, "files", "libtwo-0.0.0-cp310-cp310-manylinux1_x86_64.manylinux_2_5_x86_64.whl"
+)
+LIBFIRST_WHEEL = os.path.join(
+    HERE,
+    "files",
+    "libfirst-0.0.0-cp310-cp310-manylinux1_x86_64.manylinux_2_5_x86_64.whl",
+)
+
+
+def test_default_cache_dir():
+    with mock.patch.dict(os.environ, {"XDG_CACHE_HOME": "/xdg"}):
+        assert cache.default_cache_dir() == os.path.join("/xdg", "consolidatewheels")
+    with mock.patch.dict(os.environ, {"XDG_CACHE_HOME": ""}):
+        assert cache.default_cache_dir() == os.path.join(
+            os.path.expanduser("~/.cache"), "consolidatewheels"
+        )
+
+
+def test_parse_size():
+    assert cache.parse_size("1024") == 1024
+    assert cache.parse_size("500M") == 500 * 1024**2
+    assert cache.parse_size("1.5kb") == 1536
+    assert cache.parse_size("5G") == cache.DEFAULT_MAX_SIZE
+    with pytest.raises(ValueError, match="Invalid size lots"):
+        cache.parse_size("lots")
+
+
+def test_unpack_cached(tmpdir):
+    cachedir = os.path.join(tmpdir, "cache")
+    unpack = mock.Mock(side_effect=wheelsfunc._unpack_wheel)
+
+    # The first time the wheel is unpacked into the cache and linked from there.
+    first = os.path.join(tmpdir, "first")
+    wheeldir = cache.unpack_cached(LIBTWO_WHEEL, first, cachedir, unpack)
+    assert wheeldir == os.path.join(first, "libtwo-0.0.0")
+    assert unpack.call_count == 1
+    (tree,) = os.listdir(os.path.join(cachedir, "trees"))
+    assert os.listdir(cachedir) == ["trees"]
+    libpath = os.path.join("libtwo.libs", "libfoo-3faccd3s.so")
+    cached_lib = os.path.join(cachedir, "trees", tree, "libtwo-0.0.0", libpath)
+    assert os.path.samefile(os.path.join(wheeldir, libpath), cached_lib)
+
+    # The next times it's only linked.
+    second = os.path.join(tmpdir, "second")
+    wheeldir = cache.unpack_cached(LIBTWO_WHEEL, second, cachedir, unpack)
+    assert unpack.call_count == 1
+    assert sorted(os.listdir(wheeldir)) == sorted(
+        os.listdir(os.path.join(first, "libtwo-0.0.0"))
+    )
+
+    # Patching a detached file doesn't change the cache.
+    with open(cached_lib, "rb") as f:
+        content = f.read()
+    linked_lib = os.path.join(wheeldir, libpath)
+    workspace.detach_file(linked_lib)
+    with open(linked_lib, "r+b") as f:
+        f.write(b"patched")
+    with open(cached_lib, "rb") as f:
+        assert f.read() == content
+
+
+def test_unpack_cached_concurrent(tmpdir):
+    cachedir = os.path.join(tmpdir, "cache")
+
+    # Another process cached the same wheel while this one was unpacking it.
+    def unpack(wheel, directory):
+        cache.unpack_cached(
+            wheel, os.path.join(tmpdir, "other"), cachedir, wheelsfunc._unpack_wheel
+        )
+        return wheelsfunc._unpack_wheel(wheel, directory)
+
+    wheeldir = cache.unpack_cached(
+        LIBTWO_WHEEL, os.path.join(tmpdir, "workdir"), cachedir, unpack
+    )
+    assert os.path.exists(os.path.join(wheeldir, "libtwo.libs"))
+    assert len(os.listdir(os.path.join(cachedir, "trees"))) == 1
+    assert os.listdir(cachedir) == ["trees"]
+
+    # Other errors are not hidden.
+    with mock.patch("os.rename", side_effect=PermissionError("Permission denied")):
+        with pytest.raises(PermissionError):
+            cache.unpack_cached(
+                LIBFIRST_WHEEL,
+                os.path.join(tmpdir, "denied"),
+                cachedir,
+                wheelsfunc._unpack_wheel,
+            )
+    assert os.listdir(cachedir) == ["trees"]
+
+
+def test_prune(tmpdir):
+    cachedir = os.path.join(tmpdir, "cache")
+    assert cache.prune(cachedir) == (0, 0)
+
+    for idx, wheel in enumerate((LIBTWO_WHEEL, LIBFIRST_WHEEL)):
+        cache.unpack_cached(
+            wheel, os.path.join(tmpdir, str(idx)), cachedir, wheelsfunc._unpack_wheel
+        )
+    treesdir = os.path.join(cachedir, "trees")
+    trees = {
+        os.listdir(os.path.join(treesdir, tree))[0]: os.path.join(treesdir, tree)
+        for tree in os.listdir(treesdir)
+    }
+    # libtwo was used the most recently.
+    os.utime(trees["libfirst-0.0.0"], (1000, 1000))
+    sizes = {namever: cache._tree_size(tree) for namever, tree in trees.items()}
+
+    # Nothing is evicted while the cache fits.
+    assert cache.prune(cachedir, sum(sizes.values())) == (0, 0)
+
+    # The least recently used wheels are evicted first.
+    assert cache.prune(cachedir, sizes["libtwo-0.0.0"]) == (
+        1,
+        sizes["libfirst-0.0.0"],
+    )
+    assert list(map(os.path.exists, trees.values())) == [
+        namever == "libtwo-0.0.0" for namever in trees
+    ]
+    assert cache.prune(cachedir, 0) == (1, sizes["libtwo-0.0.0"])
+    assert os.listdir(treesdir) == []
@@ -1,13 +1,18 @@
 from __future__ import annotations
 
+import logging
 import os
+import pathlib
 import re
 import shutil
+import subprocess
+import zipfile
 from unittest import mock
 
 import pytest
 
-from consolidatewheels import consolidate_linux, wheelsfunc
+from consolidatewheels import consolidate_linux, dedupe, elf, manifest, wheelsfunc
+from consolidatewheels.runner import ToolError
 
 HERE = os.path.dirname(__file__)
 FIXTURE_FILES = {
@@ -15,7 +20,12 @@ FIXTURE_FILES = {
         HERE,
         "files",
         "libtwo-0.0.0-cp310-cp310-manylinux1_x86_64.manylinux_2_5_x86_64.whl",
-    )
+    ),
+    "libfirst.whl": os.path.join(
+        HERE,
+        "files",
+        "libfirst-0.0.0-cp310-cp310-manylinux1_x86_64.manylinux_2_5_x86_64.whl",
+    ),
 }
 
 
@@ -38,9 +48,13 @@ def test_buildlibmap(tmpdir):
     assert re.search(r"Library lib.+\.so appears multiple times: ", str(err.value))
 
 
-def test_patch_wheeldirs(tmpdir):
+def test_patch_wheeldirs(tmpdir, make_elf):
     wheeldir = wheelsfunc.unpackwheels([FIXTURE_FILES["libtwo.whl"]], workdir=tmpdir)
     wheeldir = wheeldir[0]
+    extension = os.path.join(
+        wheeldir, "libtwo", "_libtwo.cpython-310-x86_64-linux-gnu.so"
+    )
+    make_elf(extension, needed=["libbar-3fac4b7b.so", "libc.so.6"])
 
     # Create a second wheel without the mangled lib
     duplicatewheeldir = os.path.join(tmpdir, "anotherwheel")
@@ -49,56 +63,68 @@ def test_patch_wheeldirs(tmpdir):
         os.path.join(duplicatewheeldir, "libtwo.libs", "libbar-3fac4b7b.so"),
         os.path.join(duplicatewheeldir, "libtwo.libs", "libotherlib.so"),
     )
+    make_elf(
+        os.path.join(duplicatewheeldir, "libtwo.libs", "libotherlib.so"),
+        needed=["libbar.so"],
+    )
+    make_elf(
+        os.path.join(
+            duplicatewheeldir, "libtwo", "_libtwo.cpython-310-x86_64-linux-gnu.so"
+        ),
+        needed=["libbar.so", "libfoo.so", "libc.so.6"],
+    )
 
-    # Ensure that patch_wheels patches all shared objects in provided wheels
-    # according to the mangling_map
-    with mock.patch("subprocess.call", return_value=0) as mock_call:
-        consolidate_linux.patch_wheeldirs(
+    # Ensure that patch_wheels patches only the shared objects depending
+    # on libraries of the mangling_map, and only for those libraries.
+    with mock.patch("consolidatewheels.consolidate_linux.run_tools") as mock_run:
+        patched = consolidate_linux.patch_wheeldirs(
             [wheeldir, duplicatewheeldir],
-            mangling_map={"libbar.so": "libbar-3fac4b7b.so"},
+            mangling_map={
+                "libbar.so": "libbar-3fac4b7b.so",
+                "libc.so.7": "libc-1234.so.7",
+            },
         )
-    mock_call.assert_has_calls(
+    commands = list(mock_run.call_args[0][0])
+    assert sorted(commands) == [
         [
-            mock.call(
-                [
-                    "patchelf",
-                    "--replace-needed",
-                    "libbar.so",
-                    "libbar-3fac4b7b.so",
-                    os.path.join(duplicatewheeldir, "libtwo.libs", "libotherlib.so"),
-                ]
-            ),
-            mock.call(
-                [
-                    "patchelf",
-                    "--replace-needed",
-                    "libbar.so",
-                    "libbar-3fac4b7b.so",
-                    os.path.join(
-                        duplicatewheeldir,
-                        "libtwo",
-                        "_libtwo.cpython-310-x86_64-linux-gnu.so",
-                    ),
-                ]
+            "patchelf",
+            "--replace-needed",
+            "libbar.so",
+            "libbar-3fac4b7b.so",
+            os.path.join(duplicatewheeldir, "libtwo.libs", "libotherlib.so"),
+        ],
+        [
+            "patchelf",
+            "--replace-needed",
+            "libbar.so",
+            "libbar-3fac4b7b.so",
+            os.path.join(
+                duplicatewheeldir,
+                "libtwo",
+                "_libtwo.cpython-310-x86_64-linux-gnu.so",
             ),
-            mock.call(
-                [
-                    "patchelf",
-                    "--replace-needed",
-                    "libbar.so",
-                    "libbar-3fac4b7b.so",
-                    os.path.join(
-                        wheeldir, "libtwo", "_libtwo.cpython-310-x86_64-linux-gnu.so"
-                    ),
-                ]
+        ],
+    ]
+    # The extension of the first wheel already uses the mangled name
+    # and the other libraries are not ELF files.
+    assert patched == {
+        "patched": 2,
+        "patched_files": [
+            os.path.join("anotherwheel", "libtwo.libs", "libotherlib.so"),
+            os.path.join(
+                "anotherwheel", "libtwo", "_libtwo.cpython-310-x86_64-linux-gnu.so"
             ),
         ],
-        any_order=True,
-    )
+        "skipped": 8,
+        "stripped": 0,
+    }
 
     # Ensure we trap errors in patching files
     with pytest.raises(RuntimeError) as err:
-        with mock.patch("subprocess.call", return_value=1) as mock_call:
+        with mock.patch(
+            "consolidatewheels.consolidate_linux.run_tools",
+            side_effect=ToolError(0, subprocess.CompletedProcess(["patchelf"], 1)),
+        ):
             consolidate_linux.patch_wheeldirs(
                 [wheeldir, duplicatewheeldir],
                 mangling_map={"libbar.so": "libbar-3fac4b7b.so"},
@@ -107,35 +133,436 @@ def test_patch_wheeldirs(tmpdir):
         r"Unable to apply mangling to .+, libbar.so->libbar-3fac4b7b.so"
     ).match(str(err.value))
 
+    # Ensure nothing is patched when there is nothing to mangle
+    with mock.patch("consolidatewheels.consolidate_linux.run_tools") as mock_run:
+        patched = consolidate_linux.patch_wheeldirs([wheeldir], mangling_map={})
+    assert list(mock_run.call_args[0][0]) == []
+    assert patched == {
+        "patched": 0,
+        "patched_files": [],
+        "skipped": 5,
+        "stripped": 0,
+    }
+
+
+def test_read_dependencies(tmpdir, make_elf):
+    os.makedirs(os.path.join(tmpdir, "one"))
+    extension = make_elf(os.path.join(tmpdir, "one", "_one.so"), needed=["libfoo.so"])
+    notelf = os.path.join(tmpdir, "one", "notelf.so")
+    with open(notelf, "w") as f:
+        f.write("not a library")
+    assert consolidate_linux.read_dependencies(str(tmpdir)) == {
+        extension: ["libfoo.so"],
+        notelf: [],
+    }
+
+
+def test_patch_wheeldirs_in_place(tmpdir, make_elf, caplog):
+    caplog.set_level(logging.INFO)
+    wheeldir = os.path.join(tmpdir, "one-1.0")
+    os.makedirs(os.path.join(wheeldir, "one"))
+    same_length = make_elf(
+        os.path.join(wheeldir, "one", "_one.so"), needed=["libfoo-aaaaaaaa.so"]
+    )
+    with_slack = make_elf(
+        os.path.join(wheeldir, "one", "_two.so"),
+        needed=["libfoo.so", "libc.so.6"],
+        slack=32,
+    )
+    relayout = make_elf(
+        os.path.join(wheeldir, "one", "_three.so"), needed=["libfoo.so"]
+    )
+
+    # Only the files that have no space for the new names are given to patchelf.
+    with mock.patch("consolidatewheels.consolidate_linux.run_tools") as mock_run:
+        patched = consolidate_linux.patch_wheeldirs(
+            [wheeldir], mangling_map={"libfoo.so": "libfoo-bbbbbbbb.so"}
+        )
+    assert list(mock_run.call_args[0][0]) == [
+        ["patchelf", "--replace-needed", "libfoo.so", "libfoo-bbbbbbbb.so", relayout]
+    ]
+    assert patched == {
+        "patched": 3,
+        "patched_files": [
+            os.path.join("one-1.0", "one", "_one.so"),
+            os.path.join("one-1.0", "one", "_three.so"),
+            os.path.join("one-1.0", "one", "_two.so"),
+        ],
+        "skipped": 0,
+        "stripped": 0,
+    }
+    assert elf.needed_libraries(same_length) == ["libfoo-bbbbbbbb.so"]
+    assert elf.needed_libraries(with_slack) == ["libfoo-bbbbbbbb.so", "libc.so.6"]
+    output = caplog.text
+    assert f"Patching {same_length} (in place)" in output
+    assert f"Patching {with_slack} (reused space)" in output
+    assert f"Patching {relayout} (relayout)" in output
+    assert "Patched 3 libraries (1 in place, 1 reused space, 1 relayout)" in output
+
+
+def test_patch_wheeldirs_strip(tmpdir, make_elf, caplog):
+    caplog.set_level(logging.INFO)
+    wheeldir = os.path.join(tmpdir, "one-1.0")
+    os.makedirs(os.path.join(wheeldir, "one"))
+    debug = [(".debug_info", b"D" * 1000)]
+    in_place = make_elf(
+        os.path.join(wheeldir, "one", "_one.so"),
+        needed=["libfoo-aaaaaaaa.so"],
+        sections=debug,
+    )
+    relayout = make_elf(
+        os.path.join(wheeldir, "one", "_two.so"), needed=["libfoo.so"], sections=debug
+    )
+    unpatched = make_elf(
+        os.path.join(wheeldir, "one", "_three.so"), needed=["libc.so.6"], sections=debug
+    )
+    notelf = os.path.join(wheeldir, "one", "notelf.so")
+    with open(notelf, "w") as f:
+        f.write("not a library")
+    sizes = {lib: os.path.getsize(lib) for lib in (in_place, relayout, unpatched)}
+
+    # Debug sections are stripped from all the libraries, patched or not.
+    with mock.patch("consolidatewheels.consolidate_linux.run_tools") as mock_run:
+        patched = consolidate_linux.patch_wheeldirs(
+            [wheeldir], mangling_map={"libfoo.so": "libfoo-bbbbbbbb.so"}, strip=True
+        )
+    assert list(mock_run.call_args[0][0]) == [
+        ["patchelf", "--replace-needed", "libfoo.so", "libfoo-bbbbbbbb.so", relayout]
+    ]
+    stripped = sum(size - os.path.getsize(lib) for lib, size in sizes.items())
+    assert all(os.path.getsize(lib) < size - 900 for lib, size in sizes.items())
+    assert patched == {
+        "patched": 2,
+        "patched_files": [
+            os.path.join("one-1.0", "one", "_one.so"),
+            os.path.join("one-1.0", "one", "_two.so"),
+        ],
+        "skipped": 2,
+        "stripped": stripped,
+    }
+    assert elf.needed_libraries(in_place) == ["libfoo-bbbbbbbb.so"]
+    output = caplog.text
+    assert f"Stripped debug sections of {wheeldir}, {stripped} bytes saved" in output
+
+
+def test_patch_wheeldirs_libs_wheel(tmpdir, make_elf):
+    libs_wheeldir = os.path.join(tmpdir, "family_libs-1.0")
+    os.makedirs(os.path.join(libs_wheeldir, "family_libs.libs"))
+    make_elf(
+        os.path.join(libs_wheeldir, "family_libs.libs", "libfoo-aaaa.so"),
+        needed=["libbar-aaaa.so"],
+    )
+    make_elf(os.path.join(libs_wheeldir, "family_libs.libs", "libbar-aaaa.so"))
+    wheeldir = os.path.join(tmpdir, "one-1.0")
+    os.makedirs(os.path.join(wheeldir, "one", "sub"))
+    extension = make_elf(
+        os.path.join(wheeldir, "one", "sub", "_one.so"),
+        needed=["libfoo-bbbb.so", "libc.so.6"],
+    )
+
+    # The copy of libfoo that was removed is replaced by the one
+    # in the libs wheel, which is found through the RPATH.
+    with mock.patch("consolidatewheels.consolidate_linux.run_tools") as mock_run:
+        patched = consolidate_linux.patch_wheeldirs(
+            [libs_wheeldir, wheeldir],
+            consolidate_linux.buildlibmap([libs_wheeldir, wheeldir]),
+            libs_wheeldir=libs_wheeldir,
+        )
+    assert list(mock_run.call_args[0][0]) == [
+        [
+            "patchelf",
+            "--replace-needed",
+            "libfoo-bbbb.so",
+            "libfoo-aaaa.so",
+            "--add-rpath",
+            "$ORIGIN/../../family_libs.libs",
+            extension,
+        ]
+    ]
+    assert patched == {
+        "patched": 1,
+        "patched_files": [os.path.join("one-1.0", "one", "sub", "_one.so")],
+        "skipped": 2,
+        "stripped": 0,
+    }
+
 
 def test_consolidate(tmpdir):
     # Integration test that actually does the whole workflow.
 
+    commands = []  # type: list[list[str]]
     with mock.patch(
-        "consolidatewheels.consolidate_linux._invoke_patchelf", return_value=0
-    ) as mock_call:
-        consolidate_linux.consolidate([FIXTURE_FILES["libtwo.whl"]], destdir=tmpdir)
+        "consolidatewheels.consolidate_linux.run_tools", side_effect=commands.extend
+    ), mock.patch(
+        "consolidatewheels.elf.needed_libraries",
+        return_value=["libbar.so", "libfoo.so"],
+    ):
+        result = consolidate_linux.consolidate(
+            [FIXTURE_FILES["libtwo.whl"]], destdir=tmpdir
+        )
+    assert result["patched"] == 5
+    assert len(result["patched_files"]) == 5
+    assert (
+        os.path.join(
+            "libtwo-0.0.0", "libtwo", "_libtwo.cpython-310-x86_64-linux-gnu.so"
+        )
+        in result["patched_files"]
+    )
+    # Consolidating the outputs again would change nothing.
+    assert manifest.consolidated_together(result["outputs"])
     # Find the workdir directly from the patchelf invokation
-    workdir = mock_call.call_args[0][-1].split("libtwo-0.0.0")[0]
-    mock_call.assert_has_calls(
-        [
-            mock.call(
-                "libbar.so",
-                "libbar-3fac4b7b.so",
-                os.path.join(
-                    workdir, "libtwo-0.0.0", "libtwo.libs", "libbar-3fac4b7b.so"
-                ),
-            ),
-            mock.call(
-                "libbar.so",
-                "libbar-3fac4b7b.so",
-                os.path.join(
-                    workdir,
-                    "libtwo-0.0.0",
-                    "libtwo",
-                    "_libtwo.cpython-310-x86_64-linux-gnu.so",
-                ),
-            ),
-        ],
-        any_order=True,
+    workdir = commands[-1][-1].split("libtwo-0.0.0")[0]
+    replacements = {
+        ("libbar.so", "libbar-3fac4b7b.so"),
+        ("libfoo.so", "libfoo-3faccd3s.so"),
+    }
+    patched_files = {}
+    for command in commands:
+        assert command[0] == "patchelf"
+        assert command[1:-1:3] == ["--replace-needed"] * len(replacements)
+        patched_files[command[-1]] = set(zip(command[2:-1:3], command[3:-1:3]))
+    assert (
+        patched_files[
+            os.path.join(workdir, "libtwo-0.0.0", "libtwo.libs", "libbar-3fac4b7b.so")
+        ]
+        == replacements
+    )
+    assert (
+        patched_files[
+            os.path.join(
+                workdir,
+                "libtwo-0.0.0",
+                "libtwo",
+                "_libtwo.cpython-310-x86_64-linux-gnu.so",
+            )
+        ]
+        == replacements
+    )
+
+
+def test_consolidate_libs_wheel(tmpdir):
+    deduped = dedupe.dedupe(
+        [FIXTURE_FILES["libfirst.whl"], FIXTURE_FILES["libtwo.whl"]],
+        destdir=os.path.join(tmpdir, "deduped"),
+        mangled=True,
+        libs_wheel="family",
+    )["outputs"]
+    commands = []  # type: list[list[str]]
+    with mock.patch(
+        "consolidatewheels.consolidate_linux.run_tools", side_effect=commands.extend
+    ), mock.patch(
+        "consolidatewheels.elf.needed_libraries", return_value=["libfoo-3faccd3s.so"]
+    ):
+        result = consolidate_linux.consolidate(
+            deduped, destdir=os.path.join(tmpdir, "dest"), libs_wheel="family"
+        )
+    assert set(result["providers"].values()) == {"family_libs"}
+    # libtwo refers to the copy of libfoo that was preserved in the libs wheel.
+    extension = [
+        c for c in commands if c[-1].endswith("_libtwo.cpython-310-x86_64-linux-gnu.so")
+    ]
+    assert extension[0][1:-1] == [
+        "--replace-needed",
+        "libfoo-3faccd3s.so",
+        "libfoo-3fac4b7b.so",
+        "--add-rpath",
+        "$ORIGIN/../family_libs.libs",
+    ]
+    # Libraries of the libs wheel already find each other.
+    libbar = [c for c in commands if c[-1].endswith("libbar-3fac4b7b.so")]
+    assert "--add-rpath" not in libbar[0]
+
+
+def test_consolidate_duplicates(tmpdir):
+    # Both wheels embed an identical copy of libfoo,
+    # the one of libfirst is preserved as libtwo depends on it.
+    commands = []  # type: list[list[str]]
+    with mock.patch(
+        "consolidatewheels.consolidate_linux.run_tools", side_effect=commands.extend
+    ), mock.patch(
+        "consolidatewheels.elf.needed_libraries", return_value=["libfoo-3faccd3s.so"]
+    ):
+        result = consolidate_linux.consolidate(
+            [FIXTURE_FILES["libtwo.whl"], FIXTURE_FILES["libfirst.whl"]],
+            destdir=tmpdir,
+        )
+    assert result["mangling_map"]["libfoo.so"] == "libfoo-3fac4b7b.so"
+    assert result["providers"]["libfoo.so"] == "libfirst"
+    extension = [
+        c for c in commands if c[-1].endswith("_libtwo.cpython-310-x86_64-linux-gnu.so")
+    ]
+    assert extension[0][1:-1] == [
+        "--replace-needed",
+        "libfoo-3faccd3s.so",
+        "libfoo-3fac4b7b.so",
+    ]
+    with zipfile.ZipFile(result["outputs"][0]) as wf:
+        assert "libtwo.libs/libfoo-3faccd3s.so" not in wf.namelist()
+
+    # Different versions of the library can't be consolidated.
+    with mock.patch(
+        "consolidatewheels.consolidate_linux.compatible_copies", return_value=False
+    ), pytest.raises(
+        ValueError, match="appears multiple times with incompatible copies"
+    ):
+        consolidate_linux.consolidate(
+            [FIXTURE_FILES["libtwo.whl"], FIXTURE_FILES["libfirst.whl"]],
+            destdir=os.path.join(tmpdir, "incompatible"),
+        )
+
+
+def _make_linux_wheel(tmpdir, make_elf, name, libs):
+    """Write a wheel embedding ``libs``, with an extension depending on all of them."""
+    wheeldir = tmpdir.mkdir(f"src-{name}")
+    libsdir = wheeldir.mkdir(f"{name}.libs")
+    for libname in libs:
+        make_elf(str(libsdir.join(libname)), soname=libname)
+    make_elf(str(wheeldir.mkdir(name).join("_ext.so")), needed=libs)
+    wheel = str(tmpdir.join(f"{name}-1.0-cp310-cp310-linux_x86_64.whl"))
+    with zipfile.ZipFile(wheel, "w") as wf:
+        for path in sorted(pathlib.Path(wheeldir).rglob("*.so*")):
+            wf.write(path, path.relative_to(wheeldir).as_posix())
+        wf.writestr(f"{name}-1.0.dist-info/METADATA", f"Name: {name}\nVersion: 1.0\n")
+        wf.writestr(
+            f"{name}-1.0.dist-info/WHEEL",
+            "Wheel-Version: 1.0\nTag: cp310-cp310-linux_x86_64\n",
+        )
+        wf.writestr(f"{name}-1.0.dist-info/RECORD", "")
+    return wheel
+
+
+def test_consolidate_hyphenated_sonames(tmpdir, make_elf):
+    # libxcb and libxcb-render are different libraries,
+    # only libz is embedded by both wheels.
+    first = _make_linux_wheel(
+        tmpdir,
+        make_elf,
+        "first",
+        ["libxcb-aaaa1111.so.1", "libxcb-render-bbbb2222.so.0", "libz-cccc3333.so.1"],
+    )
+    second = _make_linux_wheel(tmpdir, make_elf, "second", ["libz-dddd4444.so.1"])
+    with mock.patch("consolidatewheels.consolidate_linux.run_tools"):
+        result = consolidate_linux.consolidate(
+            [first, second], destdir=str(tmpdir.mkdir("dest"))
+        )
+    assert result["mangling_map"] == {
+        "libxcb.so.1": "libxcb-aaaa1111.so.1",
+        "libxcb-render.so.0": "libxcb-render-bbbb2222.so.0",
+        "libz.so.1": "libz-cccc3333.so.1",
+    }
+    assert result["removed"] == [
+        os.path.join("second-1.0", "second.libs", "libz-dddd4444.so.1")
+    ]
+    with zipfile.ZipFile(result["outputs"][0]) as wf:
+        assert sorted(n for n in wf.namelist() if n.startswith("first.libs/")) == [
+            "first.libs/libxcb-aaaa1111.so.1",
+            "first.libs/libxcb-render-bbbb2222.so.0",
+            "first.libs/libz-cccc3333.so.1",
+        ]
+
+
+def test_compatible_copies(tmpdir, make_elf):
+    lib = make_elf(os.path.join(tmpdir, "libfoo-aaaa.so.1"), soname="libfoo-aaaa.so.1")
+    same = pathlib.Path(tmpdir, "libfoo-bbbb.so.1")
+    shutil.copyfile(lib, same)
+    assert consolidate_linux.compatible_copies(pathlib.Path(lib), same)
+
+    # A different build of the same version of the library.
+    rebuilt = make_elf(
+        os.path.join(tmpdir, "libfoo-cccc.so.1"),
+        soname="libfoo-cccc.so.1",
+        needed=["libc.so.6"],
+    )
+    assert consolidate_linux.compatible_copies(pathlib.Path(lib), rebuilt)
+
+    # A build defining more symbol versions can replace the other one,
+    # but not the other way around.
+    gomp = make_elf(
+        os.path.join(tmpdir, "libgomp-aaaa.so.1"),
+        soname="libgomp-aaaa.so.1",
+        versions=["OMP_1.0", "GOMP_4.0"],
+    )
+    gomp_newer = make_elf(
+        os.path.join(tmpdir, "libgomp-bbbb.so.1"),
+        soname="libgomp-bbbb.so.1",
+        versions=["OMP_1.0", "GOMP_4.0", "GOMP_5.0"],
     )
+    assert consolidate_linux.compatible_copies(pathlib.Path(gomp_newer), gomp)
+    assert not consolidate_linux.compatible_copies(pathlib.Path(gomp), gomp_newer)
+
+    # Another version of the library, or one without a SONAME.
+    newer = make_elf(
+        os.path.join(tmpdir, "libfoo-dddd.so.2"), soname="libfoo-dddd.so.2"
+    )
+    assert not consolidate_linux.compatible_copies(pathlib.Path(lib), newer)
+    nosoname = make_elf(os.path.join(tmpdir, "libfoo-eeee.so.1"))
+    assert not consolidate_linux.compatible_copies(pathlib.Path(lib), nosoname)
+    notelf = pathlib.Path(tmpdir, "libfoo-ffff.so.1")
+    notelf.write_bytes(b"not a library")
+    assert not consolidate_linux.compatible_copies(pathlib.Path(lib), notelf)
+
+
+def test_demangle_libname():
+    assert consolidate_linux.demangle_libname("libfoo-3fac4b7b.so") == "libfoo.so"
+    assert consolidate_linux.demangle_libname("libfoo-3fac4b7b.so.1.2") == (
+        "libfoo.so.1.2"
+    )
+    assert consolidate_linux.demangle_libname("libfoo.so.1") == "libfoo.so.1"
+
+
+def test_lock_mangling(tmpdir):
+    wheeldir = wheelsfunc.unpackwheels([FIXTURE_FILES["libtwo.whl"]], workdir=tmpdir)
+    wheeldir = wheeldir[0]
+
+    with mock.patch("consolidatewheels.consolidate_linux.run_tools") as mock_run:
+        renames = consolidate_linux.lock_mangling(
+            [wheeldir],
+            {"libbar.so": "libbar-3fac4b7b.so", "libfoo.so": "libfoo-00000000.so"},
+        )
+    assert renames == {"libfoo-3faccd3s.so": "libfoo-00000000.so"}
+    renamed_lib = os.path.join(wheeldir, "libtwo.libs", "libfoo-00000000.so")
+    assert os.path.exists(renamed_lib)
+    assert list(mock_run.call_args[0][0]) == [
+        ["patchelf", "--set-soname", "libfoo-00000000.so", pathlib.Path(renamed_lib)]
+    ]
+
+    with pytest.raises(RuntimeError) as err:
+        with mock.patch(
+            "consolidatewheels.consolidate_linux.run_tools",
+            side_effect=ToolError(0, subprocess.CompletedProcess(["patchelf"], 1)),
+        ):
+            consolidate_linux.lock_mangling([wheeldir], {"libbar.so": "libbar-1.so"})
+    assert str(err.value) == "Unable to set soname of " + os.path.join(
+        wheeldir, "libtwo.libs", "libbar-1.so"
+    )
+
+
+def test_consolidate_against(tmpdir):
+    commands = []  # type: list[list[str]]
+    with mock.patch(
+        "consolidatewheels.consolidate_linux.run_tools", side_effect=commands.extend
+    ), mock.patch(
+        "consolidatewheels.elf.needed_libraries",
+        return_value=["libfoo.so", "libfoo-3faccd3s.so"],
+    ):
+        result = consolidate_linux.consolidate(
+            [FIXTURE_FILES["libtwo.whl"]],
+            destdir=tmpdir,
+            against={"mangling_map": {"libfoo.so": "libfoo-00000000.so"}},
+        )
+    assert result["mangling_map"] == {
+        "libbar.so": "libbar-3fac4b7b.so",
+        "libfoo.so": "libfoo-00000000.so",
+    }
+    assert result["providers"]["libfoo-00000000.so"] == "libtwo"
+    assert [os.path.basename(output) for output in result["outputs"]] == [
+        os.path.basename(FIXTURE_FILES["libtwo.whl"])
+    ]
+
+    # Libraries depending on the renamed library are patched too.
+    patchelf_commands = [c for c in commands if "--replace-needed" in c]
+    assert patchelf_commands
+    for command in patchelf_commands:
+        replacements = set(zip(command[2:-1:3], command[3:-1:3]))
+        assert ("libfoo-3faccd3s.so", "libfoo-00000000.so") in replacements
+        assert ("libfoo.so", "libfoo-00000000.so") in replacements
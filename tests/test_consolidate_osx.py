@@ -1,10 +1,11 @@
 from __future__ import annotations
 
 import os
-import pathlib
 from unittest import mock
 
-from consolidatewheels import consolidate_osx, wheelsfunc
+import pytest
+
+from consolidatewheels import consolidate_osx, dedupe, wheelsfunc
 
 HERE = os.path.dirname(__file__)
 FIXTURE_FILES = {
@@ -19,150 +20,325 @@ FIXTURE_FILES = {
         "libfirst-0.0.0-cp310-cp310-manylinux1_x86_64.manylinux_2_5_x86_64.whl",
     ),
 }
+APPLE_TOOLS_AVAILABLE = consolidate_osx._apple_tools_available
+
+
+@pytest.fixture(autouse=True)
+def apple_tools():
+    """By default behave like on macOS, where install_name_tool is available."""
+    with mock.patch(
+        "consolidatewheels.consolidate_osx._apple_tools_available", return_value=True
+    ) as available:
+        yield available
+
+
+def _fake_run_tools(dependencies):
+    """Emulate run_tools recording commands and faking otool output."""
+    commands = []
+
+    def run_tools(argslist, check=True):
+        results = []
+        for args in argslist:
+            args = [os.fspath(arg) for arg in args]
+            commands.append(args)
+            stdout = b""
+            if args[0] == "otool":
+                stdout = "\n".join(
+                    f"{dependency} (compatibility version 0.0.0)"
+                    for dependency in dependencies
+                ).encode("utf-8")
+            results.append(mock.Mock(args=args, returncode=0, stdout=stdout))
+        return results
+
+    return commands, run_tools
 
 
 def test_consolidate(tmpdir):
     # Integration test that actually does the whole workflow.
     consolidated_id = "ASDFGH"
+    commands, fake_run_tools = _fake_run_tools(["@loader_path/fake/libfoo.so"])
     with mock.patch(
         "secrets.token_hex", return_value=consolidated_id
     ) as mock_token_hex, mock.patch(
-        "consolidatewheels.consolidate_osx.update_library_id", return_value=0
-    ) as mock_update_library_id, mock.patch(
-        "consolidatewheels.consolidate_osx.update_dependency_path", return_value=0
-    ) as mock_update_dependency_path, mock.patch(
-        "consolidatewheels.consolidate_osx.resign_library"
-    ) as mock_resign_library, mock.patch(
-        "consolidatewheels.consolidate_osx.get_library_dependencies",
-        return_value={"libfoo.so": "/fake/dependency/path/libfoo.so"},
+        "consolidatewheels.consolidate_osx.run_tools", side_effect=fake_run_tools
     ):
-        consolidate_osx.consolidate(
+        result = consolidate_osx.consolidate(
             [FIXTURE_FILES["libfirst.whl"], FIXTURE_FILES["libtwo.whl"]], destdir=tmpdir
         )
     mock_token_hex.assert_called_once_with(consolidate_osx.CONSOLIDATED_ID_BYTES)
-
-    # Find the workdir directly from the patchelf invokation
-    workdir = str(mock_resign_library.call_args[0][-1]).split("libtwo-0.0.0")[0]
-
-    mock_update_library_id.assert_has_calls(
-        [
-            mock.call(
-                pathlib.Path(
-                    os.path.join(workdir, "libfirst-0.0.0", ".dylibs", "libfoo.so")
-                ),
-                os.path.join(
-                    f"{consolidate_osx.CONSOLIDATED_LIB_PREFIX}{consolidated_id}",
-                    "libfoo.so",
-                ),
-            )
-        ],
-        any_order=True,
+    assert len(result["patched_files"]) == result["patched"]
+    assert os.path.join("libfirst-0.0.0", ".dylibs", "libfoo.so") in (
+        result["patched_files"]
     )
 
-    mock_update_dependency_path.assert_has_calls(
-        [
-            mock.call(
-                pathlib.Path(
-                    os.path.join(workdir, "libtwo-0.0.0", ".dylibs", "libbar.so")
-                ),
-                "/fake/dependency/path/libfoo.so",
-                os.path.join(
-                    f"{consolidate_osx.CONSOLIDATED_LIB_PREFIX}{consolidated_id}",
-                    "libfoo.so",
-                ),
-            )
-        ],
-        any_order=True,
+    # Find the workdir directly from the codesign invokation,
+    # wheels are patched concurrently so any of them can be the last one.
+    workdir = [c[-1] for c in commands if "libtwo-0.0.0" in c[-1]][0]
+    workdir = workdir.split("libtwo-0.0.0")[0]
+    libid = os.path.join(
+        f"{consolidate_osx.CONSOLIDATED_LIB_PREFIX}{consolidated_id}", "libfoo.so"
     )
+    libfirst_libfoo = os.path.join(workdir, "libfirst-0.0.0", ".dylibs", "libfoo.so")
+    libtwo_libbar = os.path.join(workdir, "libtwo-0.0.0", ".dylibs", "libbar.so")
 
-    mock_resign_library.assert_has_calls(
-        [
-            mock.call(
-                pathlib.Path(
-                    os.path.join(workdir, "libtwo-0.0.0", ".dylibs", "libbar.so")
-                )
-            )
-        ]
+    # First provider of libfoo gets the consolidated identifier.
+    assert ["install_name_tool", "-id", libid, libfirst_libfoo] in commands
+    # Wheels loaded after it refer to libfoo by the consolidated identifier.
+    assert [
+        "install_name_tool",
+        "-id",
+        libid.replace("libfoo.so", "libbar.so"),
+        "-change",
+        "@loader_path/fake/libfoo.so",
+        libid,
+        libtwo_libbar,
+    ] in commands
+    # Every patched library gets signed again.
+    assert ["codesign", "--force", "-s", "-", libtwo_libbar] in commands
+    assert ["codesign", "--force", "-s", "-", libfirst_libfoo] in commands
+
+
+def test_consolidate_reproducible(tmpdir):
+    wheels = [FIXTURE_FILES["libfirst.whl"], FIXTURE_FILES["libtwo.whl"]]
+    _, fake_run_tools = _fake_run_tools([])
+    with mock.patch("secrets.token_hex") as mock_token_hex, mock.patch(
+        "consolidatewheels.consolidate_osx.run_tools", side_effect=fake_run_tools
+    ):
+        result = consolidate_osx.consolidate(wheels, destdir=tmpdir, reproducible=True)
+    # The identifier only depends on the content of the wheels.
+    mock_token_hex.assert_not_called()
+    assert result["consolidated_id"] == consolidate_osx.content_id(wheels[::-1])
+    assert len(result["consolidated_id"]) == consolidate_osx.CONSOLIDATED_ID_BYTES * 2
+    assert consolidate_osx.content_id(wheels[:1]) != result["consolidated_id"]
+
+
+def test_consolidate_libs_wheel(tmpdir):
+    deduped = dedupe.dedupe(
+        [FIXTURE_FILES["libfirst.whl"], FIXTURE_FILES["libtwo.whl"]],
+        destdir=os.path.join(tmpdir, "deduped"),
+        libs_wheel="family",
+    )["outputs"]
+    commands, fake_run_tools = _fake_run_tools(["@loader_path/.dylibs/libfoo.so"])
+    with mock.patch(
+        "consolidatewheels.consolidate_osx.run_tools", side_effect=fake_run_tools
+    ):
+        consolidate_osx.consolidate(
+            deduped, destdir=os.path.join(tmpdir, "dest"), libs_wheel="family"
+        )
+    libtwo_ext = [c[-1] for c in commands if c[0] == "otool" and "_libtwo" in c[-1]][0]
+    assert [
+        "install_name_tool",
+        "-change",
+        "@loader_path/.dylibs/libfoo.so",
+        "@loader_path/../family_libs/.dylibs/libfoo.so",
+        libtwo_ext,
+    ] in commands
+
+
+def _patch_wheeldirs(
+    wheeldirs, consolidated_id, codesign=consolidate_osx.DEFAULT_CODESIGN, **kwargs
+):
+    # Like consolidate, plan the changes across all the wheels
+    # and apply to each wheel directory its own changes.
+    changes, skipped = consolidate_osx.plan_changes(
+        wheeldirs, consolidated_id, **kwargs
     )
+    for wheeldir in dict.fromkeys(wheeldirs):
+        consolidate_osx._apply_wheeldir_changes(
+            wheeldir, changes=changes, codesign=codesign
+        )
+    return len(changes), skipped
 
 
-def test_patch_wheeldirs(tmpdir):
+def test_apply_wheeldir_changes(tmpdir):
     workdir = os.path.join(tmpdir, "wheeldirs")
     os.makedirs(workdir)
     wheeldirs = wheelsfunc.unpackwheels([FIXTURE_FILES["libtwo.whl"]], workdir=workdir)
-
-    consolidate_id = "ASDFGH"
-    with mock.patch("subprocess.run"), mock.patch(
-        "subprocess.call"
-    ) as mock_subprocess_call:
-        consolidate_osx.patch_wheeldirs(wheeldirs, consolidate_id)
-    mock_subprocess_call.assert_has_calls(
-        [
-            mock.call(
-                [
-                    "install_name_tool",
-                    pathlib.Path(
-                        os.path.join(workdir, "libtwo-0.0.0", ".dylibs", "libfoo.so")
-                    ),
-                    "-id",
-                    os.path.join(
-                        f"{consolidate_osx.CONSOLIDATED_LIB_PREFIX}{consolidate_id}",
-                        "libfoo.so",
-                    ),
-                ]
-            ),
-            mock.call(
-                [
-                    "codesign",
-                    "--force",
-                    "-s",
-                    "-",
-                    pathlib.Path(
-                        os.path.join(workdir, "libtwo-0.0.0", ".dylibs", "libfoo.so")
-                    ),
-                ]
-            ),
-        ],
+    libfoo = os.path.join(workdir, "libtwo-0.0.0", ".dylibs", "libfoo.so")
+    libid = os.path.join(
+        f"{consolidate_osx.CONSOLIDATED_LIB_PREFIX}ASDFGH", "libfoo.so"
     )
 
-    consolidate_id = "ASDFGH"
+    commands, fake_run_tools = _fake_run_tools([])
     with mock.patch(
-        "consolidatewheels.consolidate_osx.get_library_dependencies",
-        return_value={"libfoo.so": "/fake/dependency/path/libfoo.so"},
-    ), mock.patch("subprocess.call") as mock_subprocess_call:
-        consolidate_osx.patch_wheeldirs(wheeldirs * 2, consolidate_id)
-    mock_subprocess_call.assert_has_calls(
-        [
-            mock.call(
-                [
-                    "install_name_tool",
-                    pathlib.Path(
-                        os.path.join(workdir, "libtwo-0.0.0", ".dylibs", "libfoo.so")
-                    ),
-                    "-change",
-                    "/fake/dependency/path/libfoo.so",
-                    os.path.join(
-                        f"{consolidate_osx.CONSOLIDATED_LIB_PREFIX}{consolidate_id}",
-                        "libfoo.so",
-                    ),
-                ]
-            ),
-        ]
+        "consolidatewheels.consolidate_osx.run_tools", side_effect=fake_run_tools
+    ):
+        _patch_wheeldirs(wheeldirs, "ASDFGH")
+    assert ["install_name_tool", "-id", libid, libfoo] in commands
+    assert ["codesign", "--force", "-s", "-", libfoo] in commands
+
+    # Libraries with no changes are not touched at all.
+    libtwo_ext = os.path.join(
+        workdir, "libtwo-0.0.0", "libtwo", "_libtwo.cpython-310-x86_64-linux-gnu.so"
     )
+    assert ["codesign", "--force", "-s", "-", libtwo_ext] not in commands
+
+    commands, fake_run_tools = _fake_run_tools(["@loader_path/fake/libfoo.so"])
+    with mock.patch(
+        "consolidatewheels.consolidate_osx.run_tools", side_effect=fake_run_tools
+    ):
+        _patch_wheeldirs(wheeldirs * 2, "ASDFGH")
+    assert [
+        "install_name_tool",
+        "-id",
+        libid,
+        "-change",
+        "@loader_path/fake/libfoo.so",
+        libid,
+        libfoo,
+    ] in commands
 
 
 def test_get_library_dependencies():
     lpath = "@loader_path/../libfirst/.dylibs/libfoo.so"
     with mock.patch(
-        "subprocess.run",
-        return_value=mock.Mock(
-            stdout=f"""
+        "consolidatewheels.consolidate_osx.run_tools",
+        return_value=[
+            mock.Mock(
+                stdout=f"""
     libCat.dylib (compatibility version 0.0.0, current version 0.0.0)
     {lpath} (compatibility version 0.0.0, current version 0.0.0)
 """.encode(
-                "utf-8"
+                    "utf-8"
+                )
             )
-        ),
+        ],
+    ) as mock_run_tools:
+        result = consolidate_osx.get_library_dependencies(["FAKE_PATH"])
+    assert result == [{"libfoo.so": lpath}]
+    assert list(mock_run_tools.call_args[0][0]) == [["otool", "-X", "-L", "FAKE_PATH"]]
+
+
+def test_consolidate_against(tmpdir):
+    commands, fake_run_tools = _fake_run_tools(["@loader_path/fake/libfoo.so"])
+    with mock.patch("secrets.token_hex") as mock_token_hex, mock.patch(
+        "consolidatewheels.consolidate_osx.run_tools", side_effect=fake_run_tools
     ):
-        result = consolidate_osx.get_library_dependencies("FAKE_PATH")
-    assert result == {"libfoo.so": lpath}
+        result = consolidate_osx.consolidate(
+            [FIXTURE_FILES["libtwo.whl"]],
+            destdir=tmpdir,
+            against={
+                "consolidated_id": "LOCKED",
+                "providers": {"libfoo.so": "libfirst", "libbar.so": "libtwo"},
+            },
+        )
+    # The identifier of the manifest is reused.
+    mock_token_hex.assert_not_called()
+    assert result["consolidated_id"] == "LOCKED"
+
+    # libfoo is provided by libfirst which isn't consolidated again,
+    # so libtwo must refer to it by its identifier.
+    libid = os.path.join(
+        f"{consolidate_osx.CONSOLIDATED_LIB_PREFIX}LOCKED", "libfoo.so"
+    )
+    libtwo_ext = [c[-1] for c in commands if c[0] == "otool" and "_libtwo" in c[-1]][0]
+    assert [
+        "install_name_tool",
+        "-change",
+        "@loader_path/fake/libfoo.so",
+        libid,
+        libtwo_ext,
+    ] in commands
+
+
+def test_apply_wheeldir_changes_in_process(tmpdir, make_macho, apple_tools):
+    # Without the Apple tools, libraries are inspected and patched in process.
+    apple_tools.return_value = False
+    wheeldirs = []
+    for name in ("libfirst", "libtwo"):
+        wheeldir = os.path.join(tmpdir, name)
+        os.makedirs(os.path.join(wheeldir, name, ".dylibs"))
+        make_macho(
+            os.path.join(wheeldir, name, ".dylibs", "libfoo.so"),
+            libid="/DLC/libfoo.so",
+            padding=256,
+        )
+        make_macho(
+            os.path.join(wheeldir, name, f"_{name}.so"),
+            dependencies=["@loader_path/.dylibs/libfoo.so"],
+            padding=256,
+        )
+        wheeldirs.append(wheeldir)
+
+    commands, fake_run_tools = _fake_run_tools([])
+    with mock.patch(
+        "consolidatewheels.consolidate_osx.run_tools", side_effect=fake_run_tools
+    ):
+        _patch_wheeldirs(wheeldirs, "ASDFGH", codesign=["rcodesign", "sign"])
+    libid = os.path.join(
+        f"{consolidate_osx.CONSOLIDATED_LIB_PREFIX}ASDFGH", "libfoo.so"
+    )
+    libtwo_ext = os.path.join(wheeldirs[1], "libtwo", "_libtwo.so")
+    assert consolidate_osx.macho.get_dependencies(libtwo_ext) == [libid]
+    # The first wheel loads libfoo from its own path.
+    libfirst_ext = os.path.join(wheeldirs[0], "libfirst", "_libfirst.so")
+    assert consolidate_osx.macho.get_dependencies(libfirst_ext) == [
+        "@loader_path/.dylibs/libfoo.so"
+    ]
+    # Only the signing command is executed.
+    assert {c[0] for c in commands} == {"rcodesign"}
+    assert ["rcodesign", "sign", libtwo_ext] in commands
+
+    # Signing can be disabled and failures to patch are reported.
+    make_macho(
+        os.path.join(wheeldirs[1], "libtwo", ".dylibs", "libfoo.so"),
+        libid="/DLC/libfoo.so",
+    )
+    with mock.patch("consolidatewheels.consolidate_osx.run_tools") as run_tools:
+        with pytest.raises(RuntimeError, match="Unable to patch"):
+            _patch_wheeldirs(wheeldirs[1:], "LONGERID", codesign=())
+    run_tools.assert_not_called()
+
+
+def test_apply_wheeldir_changes_libs_wheel(tmpdir, make_macho, apple_tools):
+    apple_tools.return_value = False
+    libs_wheeldir = os.path.join(tmpdir, "family_libs-1.0")
+    os.makedirs(os.path.join(libs_wheeldir, "family_libs", ".dylibs"))
+    make_macho(
+        os.path.join(libs_wheeldir, "family_libs", ".dylibs", "libfoo.so"),
+        libid="/DLC/libfoo.so",
+        dependencies=["@loader_path/libbar.so"],
+        padding=256,
+    )
+    wheeldir = os.path.join(tmpdir, "one-1.0")
+    os.makedirs(os.path.join(wheeldir, "one"))
+    extension = make_macho(
+        os.path.join(wheeldir, "one", "_one.so"),
+        dependencies=["@loader_path/.dylibs/libfoo.so"],
+        padding=256,
+    )
+
+    # Libraries of the libs wheel are referenced by their new path,
+    # even if no other wheel loaded them before.
+    patched = _patch_wheeldirs(
+        [wheeldir, libs_wheeldir],
+        "ASDFGH",
+        codesign=(),
+        libs_wheeldir=libs_wheeldir,
+    )
+    assert consolidate_osx.macho.get_dependencies(extension) == [
+        "@loader_path/../family_libs/.dylibs/libfoo.so"
+    ]
+    # References between libraries of the libs wheel are preserved.
+    assert consolidate_osx.macho.get_dependencies(
+        os.path.join(libs_wheeldir, "family_libs", ".dylibs", "libfoo.so")
+    ) == ["@loader_path/libbar.so"]
+    assert patched == (2, 0)
+
+
+def test_get_library_dependencies_in_process(tmpdir, make_macho, apple_tools):
+    apple_tools.return_value = False
+    lib = make_macho(
+        os.path.join(tmpdir, "_ext.so"),
+        dependencies=["@loader_path/.dylibs/libfoo.so", "/usr/lib/libSystem.B.dylib"],
+    )
+    assert consolidate_osx.get_library_dependencies([lib]) == [
+        {"libfoo.so": "@loader_path/.dylibs/libfoo.so"}
+    ]
+
+
+def test_apple_tools_available():
+    with mock.patch("shutil.which", return_value=None):
+        assert APPLE_TOOLS_AVAILABLE() is False
+    with mock.patch("shutil.which", return_value="/usr/bin/otool"):
+        assert APPLE_TOOLS_AVAILABLE() is True
@@ -5,6 +5,7 @@ import re
 import shutil
 from unittest import mock
 
+import pefile
 import pytest
 
 from consolidatewheels import consolidate_win, wheelsfunc
@@ -98,6 +99,20 @@ def test_patch_wheeldirs(tmpdir):
         any_order=True,
     )
 
+    # Libraries that already import the mangled name are skipped.
+    with mock.patch(
+        "consolidatewheels.consolidate_win._get_dll_imports",
+        side_effect=lambda lib: (
+            ["bar-REPLACEMENTHASH.dll"] if "foo" in lib else ["kernel32.dll"]
+        ),
+    ), mock.patch("consolidatewheels.consolidate_win._patch_dll") as mock_call:
+        patched = consolidate_win.patch_wheeldirs(
+            [wheeldir, duplicatewheeldir],
+            mangling_map={"bar.dll": "bar-REPLACEMENTHASH.dll"},
+        )
+    mock_call.assert_not_called()
+    assert patched == {"patched": 0, "patched_files": [], "skipped": 4}
+
     # Ensure we trap errors in patching files
     with pytest.raises(RuntimeError) as err:
         with mock.patch(
@@ -180,24 +195,110 @@ def test_get_dll_imports():
     assert imports == ["test-random.dll"]
 
 
-@pytest.mark.parametrize(("retval",), [[True], [False]])
-def test_patch_dll(retval):
+def test_patch_dll(tmpdir):
+    libtopatch = os.path.join(tmpdir, "libtopatch.dll")
+    with open(libtopatch, "wb") as f:
+        f.write(b"HEADER-test-random.dll\x00TRAILER")
+
     with mock.patch("pefile.PE") as mock_pe:
-        mock_pe.return_value = dllentry = mock.Mock(
-            DIRECTORY_ENTRY_IMPORT=[
-                mock.Mock(
-                    dll=b"test-random.dll",
-                    struct=mock.MagicMock(Name="test-random.dll"),
-                )
-            ]
+        dllentry = mock_pe.return_value.__enter__.return_value
+        dllentry.DIRECTORY_ENTRY_IMPORT = [
+            mock.Mock(dll=b"other.dll", struct=mock.Mock(Name=0x1000)),
+            mock.Mock(dll=b"test-random.dll", struct=mock.Mock(Name=0x2007)),
+        ]
+        dllentry.get_offset_from_rva.side_effect = lambda rva: rva - 0x2000
+
+        result = consolidate_win._patch_dll(
+            "test-random.dll", "test-patchd.dll", libtopatch
         )
-        dllentry.set_bytes_at_rva.return_value = retval
+    assert result is True
+    dllentry.get_offset_from_rva.assert_called_once_with(0x2007)
+    with open(libtopatch, "rb") as f:
+        assert f.read() == b"HEADER-test-patchd.dll\x00TRAILER"
+
+    # Replacements longer than the original name would overflow.
+    result = consolidate_win._patch_dll(
+        "test-random.dll", "test-toolongname.dll", libtopatch
+    )
+    assert result is False
 
+    # Invalid addresses can't be patched.
+    with mock.patch("pefile.PE") as mock_pe:
+        dllentry = mock_pe.return_value.__enter__.return_value
+        dllentry.DIRECTORY_ENTRY_IMPORT = [
+            mock.Mock(dll=b"test-patchd.dll", struct=mock.Mock(Name=0x2007)),
+        ]
+        dllentry.get_offset_from_rva.side_effect = pefile.PEFormatError("Bad RVA")
         result = consolidate_win._patch_dll(
-            "test-random.dll", "test-replaced.dll", "libtopatch.dll"
+            "test-patchd.dll", "test-random.dll", libtopatch
         )
-        assert result == retval
+    assert result is False
+    with open(libtopatch, "rb") as f:
+        assert f.read() == b"HEADER-test-patchd.dll\x00TRAILER"
+
+
+def test_lock_mangling(tmpdir):
+    wheeldir = wheelsfunc.unpackwheels([FIXTURE_FILES["libtwo.whl"]], workdir=tmpdir)
+    wheeldir = wheeldir[0]
+
+    consolidate_win.lock_mangling(
+        [wheeldir],
+        {
+            "bar.dll": "bar-d7b39fe6bdc290ef3cdc9fb9c8ded0b9.dll",
+            "foo.dll": "foo-LOCKEDHASH.dll",
+        },
+    )
+    libsdir = os.path.join(wheeldir, "libtwo.libs")
+    assert sorted(os.listdir(libsdir)) == [
+        ".load-order-libtwo-0.0.0",
+        "bar-d7b39fe6bdc290ef3cdc9fb9c8ded0b9.dll",
+        "foo-LOCKEDHASH.dll",
+        "libbar-3fac4b7b.so",
+        "libfoo-3faccd3s.so",
+    ]
+    with open(os.path.join(libsdir, ".load-order-libtwo-0.0.0")) as load_order:
+        assert load_order.read().splitlines() == [
+            "foo-LOCKEDHASH.dll",
+            "bar-d7b39fe6bdc290ef3cdc9fb9c8ded0b9.dll",
+        ]
 
-        dllentry.set_bytes_at_rva.assert_has_calls(
-            [mock.call("test-random.dll", b"test-replaced.dll\x00")]
+    # Load-order files are replaced atomically, never left half written.
+    with mock.patch(
+        "consolidatewheels.workspace.shutil.copymode", side_effect=OSError("Full")
+    ), pytest.raises(OSError, match="Full"):
+        consolidate_win.lock_mangling([wheeldir], {"foo.dll": "foo-OTHERHASH.dll"})
+    with open(os.path.join(libsdir, ".load-order-libtwo-0.0.0")) as load_order:
+        assert load_order.read().splitlines() == [
+            "foo-LOCKEDHASH.dll",
+            "bar-d7b39fe6bdc290ef3cdc9fb9c8ded0b9.dll",
+        ]
+    assert len(os.listdir(libsdir)) == 5
+
+
+def test_consolidate_against(tmpdir):
+    with mock.patch(
+        "consolidatewheels.consolidate_win._patch_dll"
+    ) as mock_call, mock.patch(
+        "consolidatewheels.consolidate_win._get_dll_imports",
+        return_value=["foo-1897da919eaed88c4c6f41b2487930e8.dll", "baz-mangled.dll"],
+    ):
+        result = consolidate_win.consolidate(
+            [FIXTURE_FILES["libtwo.whl"]],
+            destdir=tmpdir,
+            against={
+                "mangling_map": {
+                    "foo.dll": "foo-LOCKEDHASH.dll",
+                    "baz.dll": "baz-LOCKEDHASH.dll",
+                }
+            },
         )
+    assert result["mangling_map"] == {
+        "bar.dll": "bar-d7b39fe6bdc290ef3cdc9fb9c8ded0b9.dll",
+        "foo.dll": "foo-LOCKEDHASH.dll",
+        "baz.dll": "baz-LOCKEDHASH.dll",
+    }
+    replaced = {(c[0][0], c[0][1]) for c in mock_call.call_args_list}
+    assert replaced == {
+        ("foo-1897da919eaed88c4c6f41b2487930e8.dll", "foo-LOCKEDHASH.dll"),
+        ("baz-mangled.dll", "baz-LOCKEDHASH.dll"),
+    }
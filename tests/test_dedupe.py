@@ -1,7 +1,11 @@
 from __future__ import annotations
 
+import logging
 import os
 import pathlib
+from unittest import mock
+
+import pytest
 
 from consolidatewheels import dedupe, wheelsfunc
 
@@ -26,7 +30,7 @@ def test_dedupe(tmpdir):
         [FIXTURE_FILES["libfirst.whl"], FIXTURE_FILES["libtwo.whl"]],
         destdir=tmpdir,
         mangled=False,
-    )
+    )["outputs"]
     assert len(results) == 2
 
     os.makedirs(os.path.join(tmpdir, "wheeldirs"))
@@ -55,7 +59,7 @@ def test_dedupe_mangled(tmpdir):
         [FIXTURE_FILES["libfirst.whl"], FIXTURE_FILES["libtwo.whl"]],
         destdir=tmpdir,
         mangled=True,
-    )
+    )["outputs"]
     assert len(results) == 2
 
     os.makedirs(os.path.join(tmpdir, "wheeldirs"))
@@ -82,6 +86,240 @@ def test_dedupe_mangled(tmpdir):
             assert False, f"unexpected wheel {wheeldir}"
 
 
+def test_dedupe_provided(tmpdir):
+    # Libraries provided by other wheels are removed from all wheels
+    results = dedupe.dedupe(
+        [FIXTURE_FILES["libtwo.whl"]],
+        destdir=tmpdir,
+        mangled=False,
+        provided=["libbar.so"],
+    )["outputs"]
+    os.makedirs(os.path.join(tmpdir, "wheeldirs"))
+    wheeldirs = wheelsfunc.unpackwheels(
+        results, workdir=os.path.join(tmpdir, "wheeldirs")
+    )
+    dylibs = [p.name for p in pathlib.Path(wheeldirs[0]).rglob(".dylibs/*")]
+    assert dylibs == ["libfoo.so"]
+
+
+def test_delete_duplicate_libs_load_order(tmpdir):
+    wheeldirs = wheelsfunc.unpackwheels(
+        [FIXTURE_FILES["libfirst.whl"], FIXTURE_FILES["libtwo.whl"]], workdir=tmpdir
+    )
+    load_order = os.path.join(wheeldirs[1], "libtwo.libs", ".load-order-libtwo-0.0.0")
+
+    # All the libraries removed from a wheel are dropped
+    # from its load-order file with a single rewrite.
+    with mock.patch(
+        "consolidatewheels.workspace.write_atomic",
+        wraps=dedupe.workspace.write_atomic,
+    ) as write_atomic:
+        dedupe.delete_duplicate_libs(wheeldirs, mangled=True, provided=["bar-0000.dll"])
+    write_atomic.assert_called_once_with(load_order, mock.ANY)
+    with open(load_order, "rb") as f:
+        assert f.read() == b""
+    assert sorted(os.listdir(os.path.join(wheeldirs[1], "libtwo.libs"))) == [
+        ".load-order-libtwo-0.0.0",
+        "libbar-3fac4b7b.so",
+    ]
+    # Line endings of the preserved entries are untouched.
+    load_order = os.path.join(wheeldirs[0], "libfirst.libs", ".load-order-libone-0.0.0")
+    with open(load_order, "rb") as f:
+        assert f.read() == b"foo-93c7258ead29c23ea6ef9c0778a28c9a.dll\r\n"
+
+
+def test_dedupe_libs_wheel(tmpdir):
+    results = dedupe.dedupe(
+        [FIXTURE_FILES["libfirst.whl"], FIXTURE_FILES["libtwo.whl"]],
+        destdir=tmpdir,
+        mangled=True,
+        libs_wheel="lib-family",
+    )["outputs"]
+    assert [os.path.basename(r) for r in results] == [
+        "lib_family_libs-0.0.0-py3-none-manylinux1_x86_64.manylinux_2_5_x86_64.whl",
+        "libfirst-0.0.0-cp310-cp310-manylinux1_x86_64.manylinux_2_5_x86_64.whl",
+        "libtwo-0.0.0-cp310-cp310-manylinux1_x86_64.manylinux_2_5_x86_64.whl",
+    ]
+
+    os.makedirs(os.path.join(tmpdir, "wheeldirs"))
+    libs_wheeldir, libfirst, libtwo = wheelsfunc.unpackwheels(
+        results, workdir=os.path.join(tmpdir, "wheeldirs")
+    )
+    # One copy of each library is moved to the new wheel.
+    libs = sorted(
+        p.relative_to(libs_wheeldir).as_posix()
+        for p in pathlib.Path(libs_wheeldir).rglob("*")
+        if p.is_file() and ".dist-info" not in str(p)
+    )
+    assert libs == [
+        "lib_family_libs.libs/bar-d7b39fe6bdc290ef3cdc9fb9c8ded0b9.dll",
+        "lib_family_libs.libs/foo-93c7258ead29c23ea6ef9c0778a28c9a.dll",
+        "lib_family_libs.libs/libbar-3fac4b7b.so",
+        "lib_family_libs.libs/libfoo-3fac4b7b.so",
+        "lib_family_libs.pth",
+        "lib_family_libs/.dylibs/libbar.so",
+        "lib_family_libs/.dylibs/libfoo.so",
+    ]
+    with open(os.path.join(libs_wheeldir, "lib_family_libs.pth")) as f:
+        assert "os.add_dll_directory" in f.read()
+
+    # The wheels have no libraries left and depend on the new wheel.
+    for wheeldir, name in ((libfirst, "libfirst"), (libtwo, "libtwo")):
+        assert not os.path.exists(os.path.join(wheeldir, ".dylibs"))
+        assert os.listdir(os.path.join(wheeldir, f"{name}.libs")) == [
+            f".load-order-{name.replace('first', 'one')}-0.0.0"
+        ]
+        with open(os.path.join(wheeldir, f"{name}-0.0.0.dist-info", "METADATA")) as f:
+            metadata = f.read()
+        assert "Requires-Dist: lib_family_libs==0.0.0\n" in metadata
+    assert "Requires-Dist: libfirst\n" in metadata
+
+
+def test_make_libs_wheel_nothing_to_move(tmpdir):
+    wheeldir = os.path.join(tmpdir, "pure-1.0")
+    os.makedirs(os.path.join(wheeldir, "pure"))
+    assert dedupe.make_libs_wheel([wheeldir], "family", False, tmpdir) is None
+    assert wheelsfunc.find_libs_wheeldir([wheeldir], "family") is None
+
+
+def test_add_requirement(tmpdir):
+    dist_info = tmpdir.mkdir("one-1.0").mkdir("one-1.0.dist-info")
+    dist_info.join("METADATA").write("Name: one\nVersion: 1.0\n\nDescription\n")
+    dedupe._add_requirement(os.path.dirname(dist_info), "family_libs==1.0")
+    assert dist_info.join("METADATA").read() == (
+        "Name: one\nVersion: 1.0\nRequires-Dist: family_libs==1.0\n\nDescription\n"
+    )
+
+
+def _make_wheeldir(path, name, libs):
+    libsdir = os.path.join(path, f"{name}-1.0", ".dylibs")
+    os.makedirs(libsdir)
+    for libname, size in libs.items():
+        with open(os.path.join(libsdir, libname), "wb") as f:
+            f.write(b"\0" * size)
+    return os.path.join(path, f"{name}-1.0")
+
+
+def test_delete_duplicate_libs_placement(tmpdir, caplog):
+    # leaf has no dependencies so it comes first in dependency order,
+    # but the library should go to core that all the others depend on.
+    wheeldirs = [
+        _make_wheeldir(tmpdir, "leaf", {"libfoo.so": 100, "libbar.so": 10}),
+        _make_wheeldir(tmpdir, "core", {"libfoo.so": 100}),
+        _make_wheeldir(tmpdir, "left", {"libfoo.so": 100}),
+        _make_wheeldir(tmpdir, "right", {"libfoo.so": 100, "libbar.so": 10}),
+        _make_wheeldir(tmpdir, "app", {"libfoo.so": 100}),
+    ]
+    dependencies = {
+        "leaf": [],
+        "core": ["numpy"],
+        "left": ["core"],
+        "right": ["core"],
+        "app": ["left", "right"],
+    }
+    result = dedupe.delete_duplicate_libs(
+        wheeldirs, mangled=False, dependencies=dependencies
+    )
+    assert "Warning: right don't depend on leaf" in caplog.text
+    assert result == {
+        "placement": {"libfoo.so": "core", "libbar.so": "leaf"},
+        "removed": [
+            os.path.join("app-1.0", ".dylibs", "libfoo.so"),
+            os.path.join("leaf-1.0", ".dylibs", "libfoo.so"),
+            os.path.join("left-1.0", ".dylibs", "libfoo.so"),
+            os.path.join("right-1.0", ".dylibs", "libbar.so"),
+            os.path.join("right-1.0", ".dylibs", "libfoo.so"),
+        ],
+        "bytes_saved": 410,
+    }
+    remaining = sorted(
+        os.path.relpath(p, tmpdir) for p in pathlib.Path(tmpdir).rglob(".dylibs/*")
+    )
+    assert remaining == [
+        os.path.join("core-1.0", ".dylibs", "libfoo.so"),
+        os.path.join("leaf-1.0", ".dylibs", "libbar.so"),
+    ]
+
+
+def test_delete_duplicate_libs_same_wheel(tmpdir):
+    # The mangled names of libxcb and libxcb-render are confused,
+    # but libraries of the same wheel are never copies of each other.
+    wheeldirs = [
+        _make_wheeldir(
+            tmpdir, "core", {"libxcb-aaaa.so": 10, "libxcb-render-bbbb.so": 20}
+        ),
+        _make_wheeldir(tmpdir, "app", {"libxcb-render-bbbb.so": 20}),
+    ]
+    result = dedupe.delete_duplicate_libs(wheeldirs, mangled=True)
+    assert result["placement"] == {"libxcb-render-bbbb.so": "core"}
+    assert result["removed"] == [
+        os.path.join("app-1.0", ".dylibs", "libxcb-render-bbbb.so")
+    ]
+    assert sorted(os.listdir(os.path.join(wheeldirs[0], ".dylibs"))) == [
+        "libxcb-aaaa.so",
+        "libxcb-render-bbbb.so",
+    ]
+
+
+def test_delete_duplicate_libs_incompatible(tmpdir):
+    wheeldirs = [
+        _make_wheeldir(tmpdir, "core", {"libfoo.so": 100}),
+        _make_wheeldir(tmpdir, "app", {"libfoo.so": 200}),
+    ]
+
+    def same_size(lib, other):
+        return lib.stat().st_size == other.stat().st_size
+
+    # Copies that can't replace each other are never removed.
+    with pytest.raises(ValueError, match="libfoo.so appears multiple times with"):
+        dedupe.delete_duplicate_libs(wheeldirs, mangled=False, compatible=same_size)
+    with pytest.raises(ValueError, match="libfoo.so appears multiple times with"):
+        dedupe.make_libs_wheel(
+            wheeldirs, "family", mangled=False, workdir=tmpdir, compatible=same_size
+        )
+    assert len(list(pathlib.Path(tmpdir).rglob("libfoo.so"))) == 2
+
+
+def test_make_libs_wheel_duplicates(tmpdir):
+    wheeldirs = wheelsfunc.unpackwheels(
+        [FIXTURE_FILES["libfirst.whl"], FIXTURE_FILES["libtwo.whl"]], workdir=tmpdir
+    )
+
+    # Only one copy of each library is moved into the libs wheel.
+    libs_wheeldir = dedupe.make_libs_wheel(
+        wheeldirs, "family", mangled=True, workdir=tmpdir
+    )
+    assert sorted(os.listdir(os.path.join(libs_wheeldir, "family_libs.libs"))) == [
+        "bar-d7b39fe6bdc290ef3cdc9fb9c8ded0b9.dll",
+        "foo-93c7258ead29c23ea6ef9c0778a28c9a.dll",
+        "libbar-3fac4b7b.so",
+        "libfoo-3fac4b7b.so",
+    ]
+
+
+def test_choose_provider():
+    closure = {"app": {"left", "right", "core"}, "left": {"core"}, "core": set()}
+    sizes = {"core": 100, "left": 100, "app": 100}
+    assert dedupe._choose_provider(sizes, closure) == ("core", [])
+    # The lowest common dependency is preferred over the first one.
+    assert dedupe._choose_provider({"app": 100, "left": 100}, closure) == ("left", [])
+    # Without dependencies between consumers, the first one is preserved.
+    assert dedupe._choose_provider({"right": 100, "left": 100}, closure) == (
+        "right",
+        ["left"],
+    )
+    # Or the one with the smallest copy.
+    assert dedupe._choose_provider({"right": 100, "left": 50}, closure) == (
+        "left",
+        ["right"],
+    )
+
+    # The copies that can be removed are weighed by their size.
+    closure = {"small": {"base"}, "large": {"other"}}
+    sizes = {"base": 100, "small": 10, "other": 100, "large": 500}
+    assert dedupe._choose_provider(sizes, closure) == ("other", ["base", "small"])
+
+
 def test_build_dependencies_tree():
     name2files, deptree = dedupe.build_dependencies_tree(
         [FIXTURE_FILES["libfirst.whl"], FIXTURE_FILES["libtwo.whl"]]
@@ -89,6 +327,16 @@ def test_build_dependencies_tree():
     assert deptree == {"libfirst": [], "libtwo": ["libfirst"]}
 
 
+def test_read_requirements(tmpdir):
+    wheeldirs = wheelsfunc.unpackwheels(
+        [FIXTURE_FILES["libfirst.whl"], FIXTURE_FILES["libtwo.whl"]], workdir=tmpdir
+    )
+    assert [dedupe.read_requirements(wheeldir) for wheeldir in wheeldirs] == [
+        [],
+        ["libfirst"],
+    ]
+
+
 def test_sort_dependencies():
     result = dedupe.sort_dependencies(
         {
@@ -108,3 +356,26 @@ def test_sort_dependencies():
         "libthird",
         "libfourth",
     ]
+
+
+def test_sort_dependencies_cycle(caplog):
+    caplog.set_level(logging.INFO)
+    result = dedupe.sort_dependencies(
+        {
+            "liba": ["libb"],
+            "libb": ["liba", "libfirst"],
+            "libfirst": [],
+            "libc": ["liba"],
+        }
+    )
+    # Wheels in a cycle can't be sorted, they come last in the provided order.
+    assert result == ["libfirst", "liba", "libb", "libc"]
+    assert "in a cycle: liba, libb, libc" in caplog.text
+
+
+def test_sort_dependencies_many():
+    # Long chains of dependencies are sorted in linear time.
+    deptree = {f"lib{idx}": [f"lib{idx + 1}"] for idx in range(20000)}
+    deptree["lib20000"] = []
+    result = dedupe.sort_dependencies(deptree)
+    assert result == [f"lib{idx}" for idx in range(20000, -1, -1)]
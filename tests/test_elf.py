@@ -0,0 +1,340 @@
+from __future__ import annotations
+
+import os
+import struct
+
+import pytest
+
+from consolidatewheels import elf
+
+
+def test_needed_libraries(tmpdir, make_elf):
+    lib = make_elf(
+        os.path.join(tmpdir, "_ext.so"),
+        needed=["libfoo.so", "libc.so.6"],
+        soname="_ext.so",
+    )
+    assert elf.needed_libraries(lib) == ["libfoo.so", "libc.so.6"]
+
+    # 32bit and big endian files are supported too.
+    lib32 = make_elf(
+        os.path.join(tmpdir, "_ext32.so"), needed=["libfoo.so"], is64=False, endian=">"
+    )
+    assert elf.needed_libraries(lib32) == ["libfoo.so"]
+
+    # Long names are read in multiple chunks.
+    long_name = "lib" + "x" * 600 + ".so"
+    lib = make_elf(os.path.join(tmpdir, "_long.so"), needed=[long_name])
+    assert elf.needed_libraries(lib) == [long_name]
+
+
+def test_soname(tmpdir, make_elf):
+    lib = make_elf(os.path.join(tmpdir, "libfoo.so"), soname="libfoo-3fac4b7b.so.1")
+    assert elf.soname(lib) == "libfoo-3fac4b7b.so.1"
+    lib = make_elf(os.path.join(tmpdir, "_ext.so"), needed=["libfoo.so"])
+    assert elf.soname(lib) is None
+
+
+def test_version_definitions(tmpdir, make_elf):
+    lib = make_elf(
+        os.path.join(tmpdir, "libgomp.so.1"),
+        soname="libgomp.so.1",
+        versions=["OMP_1.0", "GOMP_4.0"],
+    )
+    assert elf.version_definitions(lib) == {"OMP_1.0", "GOMP_4.0"}
+
+    # The base definition is the name of the library, not a version.
+    with open(lib, "r+b") as f:
+        dynamic = elf._read_dynamic(f)
+        verdef = dict(dynamic["entries"])[elf.DT_VERDEF]
+        f.seek(elf._address_to_offset(dynamic["program_headers"], verdef) + 2)
+        f.write(struct.pack("<H", elf.VER_FLG_BASE))
+    assert elf.version_definitions(lib) == {"GOMP_4.0"}
+
+    lib = make_elf(os.path.join(tmpdir, "libfoo.so"), soname="libfoo.so")
+    assert elf.version_definitions(lib) == set()
+
+
+def test_is_shared_object():
+    assert elf.is_shared_object("libfoo-3fac4b7b.so")
+    assert elf.is_shared_object("libfoo-3fac4b7b.so.1.2")
+    assert not elf.is_shared_object("libfoo.so.py")
+    assert not elf.is_shared_object("foo.dll")
+
+
+def test_needed_libraries_errors(tmpdir, make_elf):
+    notelf = os.path.join(tmpdir, "notelf.so")
+    with open(notelf, "wb") as f:
+        f.write(b"shared library")
+    with pytest.raises(elf.ELFError, match="Not an ELF file"):
+        elf.needed_libraries(notelf)
+
+    with open(notelf, "wb") as f:
+        f.write(elf.ELF_MAGIC + b"\x03\x01".ljust(60, b"\0"))
+    with pytest.raises(elf.ELFError, match="Unsupported ELF class"):
+        elf.needed_libraries(notelf)
+
+    lib = make_elf(os.path.join(tmpdir, "_ext.so"), needed=["libfoo.so"])
+    with open(lib, "rb") as f:
+        content = bytearray(f.read())
+
+    # Statically linked files have no dynamic segment.
+    static = bytearray(content)
+    # Type of the second program header, the dynamic segment.
+    static[120:124] = (0).to_bytes(4, "little")
+    with open(notelf, "wb") as f:
+        f.write(static)
+    with pytest.raises(elf.ELFError, match="Not a dynamically linked"):
+        elf.needed_libraries(notelf)
+
+    # The string table must be mapped from the file.
+    unmapped = bytearray(content)
+    # Type of the first program header, the loaded segment.
+    unmapped[64:68] = (0).to_bytes(4, "little")
+    with open(notelf, "wb") as f:
+        f.write(unmapped)
+    with pytest.raises(elf.ELFError, match="is not mapped from the file"):
+        elf.needed_libraries(notelf)
+
+    # And it must exist.
+    strtab = elf.DT_STRTAB.to_bytes(8, "little") + (64 + 2 * 56).to_bytes(8, "little")
+    nostrtab = content.replace(strtab, (99).to_bytes(8, "little") + strtab[8:])
+    assert nostrtab != content
+    with open(notelf, "wb") as f:
+        f.write(nostrtab)
+    with pytest.raises(elf.ELFError, match="no string table"):
+        elf.needed_libraries(notelf)
+
+
+def test_replace_needed(tmpdir, make_elf):
+    # Names of the same length are written over the old ones.
+    lib = make_elf(
+        os.path.join(tmpdir, "_ext.so"),
+        needed=["libfoo-aaaaaaaa.so", "libc.so.6"],
+        versions=True,
+        symbols=["PyInit__ext"],
+    )
+    size = os.path.getsize(lib)
+    strategy = elf.replace_needed(
+        lib, {"libfoo-aaaaaaaa.so": "libfoo-bbbbbbbb.so", "libmissing.so": "x.so"}
+    )
+    assert strategy == elf.IN_PLACE
+    assert elf.needed_libraries(lib) == ["libfoo-bbbbbbbb.so", "libc.so.6"]
+    assert os.path.getsize(lib) == size
+    # Version requirements refer to the new name too.
+    with open(lib, "rb") as f:
+        dynamic = elf._read_dynamic(f)
+        names = [
+            elf._read_string(f, dynamic["strtab"] + value)
+            for _, _, value, _ in elf._string_references(f, dynamic)
+        ]
+    assert names[:2] == ["libfoo-bbbbbbbb.so", "libc.so.6"]
+    assert "libfoo-bbbbbbbb.so" in names[2:] and "V1" in names[2:]
+    assert "PyInit__ext" in names
+
+    # Longer names reuse the unused space of the string table.
+    lib = make_elf(
+        os.path.join(tmpdir, "_long.so"),
+        needed=["libfoo.so", "libc.so.6"],
+        versions=True,
+        slack=32,
+        symbols=["PyInit__long"],
+        is64=False,
+        endian=">",
+    )
+    size = os.path.getsize(lib)
+    strategy = elf.replace_needed(lib, {"libfoo.so": "libfoo-3fac4b7b.so"})
+    assert strategy == elf.REUSED_SPACE
+    assert elf.needed_libraries(lib) == ["libfoo-3fac4b7b.so", "libc.so.6"]
+    assert os.path.getsize(lib) == size
+
+    # Including the space of the strings that are not used anymore.
+    lib = make_elf(
+        os.path.join(tmpdir, "_dead.so"), needed=["libfoo-aaaa.so", "libbar.so"]
+    )
+    strategy = elf.replace_needed(
+        lib, {"libfoo-aaaa.so": "libfoo.so", "libbar.so": "libbar-bb.so"}
+    )
+    assert strategy == elf.REUSED_SPACE
+    assert elf.needed_libraries(lib) == ["libfoo.so", "libbar-bb.so"]
+
+    # Adjacent names that both grow never overwrite each other.
+    lib = make_elf(
+        os.path.join(tmpdir, "_grow.so"),
+        needed=["libfoo.so", "libbar.so"],
+        slack=48,
+        symbols=["PyInit__grow"],
+    )
+    strategy = elf.replace_needed(
+        lib, {"libfoo.so": "libfoo-12345678.so", "libbar.so": "libbar-12345678.so"}
+    )
+    assert strategy == elf.REUSED_SPACE
+    assert elf.needed_libraries(lib) == ["libfoo-12345678.so", "libbar-12345678.so"]
+
+
+def test_replace_needed_errors(tmpdir, make_elf):
+    # Strings that are shared with something else are never overwritten.
+    lib = make_elf(
+        os.path.join(tmpdir, "_ext.so"), needed=["libfoo.so"], symbols=["libfoo.so"]
+    )
+    with open(lib, "rb") as f:
+        content = f.read()
+    with pytest.raises(elf.ELFError, match="Not enough space"):
+        elf.replace_needed(lib, {"libfoo.so": "libbar.so"})
+    with open(lib, "rb") as f:
+        assert f.read() == content
+
+    # Nor are the names that were not moved yet.
+    for symbols in ([], ["PyInit__ext"]):
+        lib = make_elf(
+            os.path.join(tmpdir, "_ext.so"),
+            needed=["libfoo.so", "libbar.so"],
+            slack=0,
+            symbols=symbols,
+        )
+        with open(lib, "rb") as f:
+            content = f.read()
+        with pytest.raises(elf.ELFError, match="Not enough space"):
+            elf.replace_needed(
+                lib,
+                {"libfoo.so": "libfoo-12345678.so", "libbar.so": "libbar-12345678.so"},
+            )
+        with open(lib, "rb") as f:
+            assert f.read() == content
+
+    # Symbols can only be found through the section headers.
+    lib = make_elf(os.path.join(tmpdir, "_ext.so"), needed=["l.so"], symbols=["s"])
+    with open(lib, "r+b") as f:
+        f.seek(40)
+        f.write((0).to_bytes(8, "little"))
+    with pytest.raises(elf.ELFError, match="without section headers"):
+        elf.replace_needed(lib, {"l.so": "m.so"})
+
+    # The size of the string table must be known
+    lib = make_elf(os.path.join(tmpdir, "_ext.so"), needed=["libfoo.so"])
+    with open(lib, "rb") as f:
+        content = f.read()
+    strsz = elf.DT_STRSZ.to_bytes(8, "little")
+    with open(lib, "wb") as f:
+        f.write(content.replace(strsz, (99).to_bytes(8, "little")))
+    with pytest.raises(elf.ELFError, match="no string table size"):
+        elf.replace_needed(lib, {"libfoo.so": "libbar.so"})
+
+    # And strings must be inside of it.
+    needed = elf.DT_NEEDED.to_bytes(8, "little")
+    with open(lib, "wb") as f:
+        f.write(
+            content.replace(
+                needed + (1).to_bytes(8, "little"), needed + (99).to_bytes(8, "little")
+            )
+        )
+    with pytest.raises(elf.ELFError, match="outside of the string table"):
+        elf.replace_needed(lib, {"libfoo.so": "libbar.so"})
+
+    # A string missing its terminator ends with the table.
+    assert elf._table_string(bytearray(b"\0libfoo.so"), 1) == "libfoo.so"
+
+
+def _sections(path):
+    with open(path, "rb") as f:
+        header = elf._read_header(f)
+        sections = elf._read_section_headers(f, header)
+        shstrtab = sections[header["shstrndx"]]
+        f.seek(shstrtab["offset"])
+        names = bytearray(f.read(shstrtab["size"]))
+        contents = {}
+        for section in sections[1:]:
+            f.seek(section["offset"])
+            contents[elf._table_string(names, section["name"])] = f.read(
+                section["size"]
+            )
+    return contents
+
+
+@pytest.mark.parametrize("is64,endian", [(True, "<"), (False, ">")])
+def test_strip_debug(tmpdir, make_elf, is64, endian):
+    lib = make_elf(
+        os.path.join(tmpdir, "_ext.so"),
+        needed=["libfoo.so"],
+        symbols=["PyInit__ext"],
+        is64=is64,
+        endian=endian,
+        sections=[
+            (".debug_info", b"D" * 1000),
+            (".symtab", b"S" * 40),
+            (".debug_str", b"X" * 500),
+            (".comment", b"GCC"),
+        ],
+    )
+    size = os.path.getsize(lib)
+
+    # Debug sections are emptied and the following ones moved over them.
+    saved = elf.strip_debug(lib)
+    assert saved >= 1500
+    assert os.path.getsize(lib) == size - saved
+    sections = _sections(lib)
+    assert sections[".debug_info"] == sections[".debug_str"] == b""
+    assert sections[".symtab"] == b"S" * 40
+    assert sections[".comment"] == b"GCC"
+    assert elf.needed_libraries(lib) == ["libfoo.so"]
+
+    # Nothing left to strip.
+    assert elf.strip_debug(lib) == 0
+    assert os.path.getsize(lib) == size - saved
+
+
+def test_strip_debug_unsafe(tmpdir, make_elf):
+    # Files without debug sections or section headers are left untouched.
+    lib = make_elf(os.path.join(tmpdir, "_ext.so"), sections=[(".comment", b"GCC")])
+    assert elf.strip_debug(lib) == 0
+    lib = make_elf(os.path.join(tmpdir, "_bare.so"), needed=["libfoo.so"])
+    assert elf.strip_debug(lib) == 0
+
+    # Debug sections loaded in memory can't be moved.
+    lib = make_elf(
+        os.path.join(tmpdir, "_loaded.so"), sections=[(".debug_info", b"D" * 100)]
+    )
+    with open(lib, "r+b") as f:
+        # Extend the filesz of PT_LOAD to the end of the file.
+        f.seek(64 + 32)
+        f.write(struct.pack("<Q", os.path.getsize(lib)))
+    with open(lib, "rb") as f:
+        content = f.read()
+    assert elf.strip_debug(lib) == 0
+    with open(lib, "rb") as f:
+        assert f.read() == content
+
+
+def test_replace_needed_strip(tmpdir, make_elf):
+    # Debug sections are stripped while the file is patched.
+    lib = make_elf(
+        os.path.join(tmpdir, "_ext.so"),
+        needed=["libfoo-aaaaaaaa.so"],
+        sections=[(".debug_info", b"D" * 1000)],
+    )
+    size = os.path.getsize(lib)
+    strategy = elf.replace_needed(
+        lib, {"libfoo-aaaaaaaa.so": "libfoo-bbbbbbbb.so"}, strip=True
+    )
+    assert strategy == elf.IN_PLACE
+    assert elf.needed_libraries(lib) == ["libfoo-bbbbbbbb.so"]
+    assert os.path.getsize(lib) < size - 1000 + 16
+
+    # Malformed section names don't prevent patching.
+    lib = make_elf(
+        os.path.join(tmpdir, "_bad.so"),
+        needed=["libfoo-aaaaaaaa.so"],
+        sections=[(".debug_info", b"D" * 1000)],
+    )
+    with open(lib, "r+b") as f:
+        header = elf._read_header(f)
+        shstrtab = elf._read_section_headers(f, header)[header["shstrndx"]]
+        shstrtab["size"] = 1
+        f.seek(header["shoff"] + header["shstrndx"] * header["shentsize"])
+        f.write(elf._pack_section_header(header, shstrtab))
+    size = os.path.getsize(lib)
+    with pytest.raises(elf.ELFError, match="outside of the string table"):
+        elf.strip_debug(lib)
+    elf.replace_needed(lib, {"libfoo-aaaaaaaa.so": "libfoo-bbbbbbbb.so"}, strip=True)
+    assert elf.needed_libraries(lib) == ["libfoo-bbbbbbbb.so"]
+    assert os.path.getsize(lib) == size
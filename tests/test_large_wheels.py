@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+import os
+import subprocess
+import sys
+import textwrap
+import zipfile
+
+import pytest
+
+resource = pytest.importorskip("resource")
+
+# Size of the big member of each synthetic wheel,
+# set CONSOLIDATEWHEELS_LARGE_MEMBER_SIZE to a few GB to
+# reproduce consolidation of GPU-sized wheels.
+MEMBER_SIZE = int(
+    os.environ.get("CONSOLIDATEWHEELS_LARGE_MEMBER_SIZE", 256 * 1024 * 1024)
+)
+# Memory that consolidation is allowed to use on top of what
+# the interpreter already uses once everything is imported.
+MEMORY_BUDGET = 128 * 1024 * 1024
+
+CONSOLIDATE_SCRIPT = textwrap.dedent(
+    """
+    import resource
+    import sys
+    import tempfile
+
+    from consolidatewheels import consolidate_win, dedupe
+
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmData:"):
+                used_memory = int(line.split()[1]) * 1024
+    limit = used_memory + int(sys.argv[1])
+    resource.setrlimit(resource.RLIMIT_DATA, (limit, limit))
+
+    wheels, destdir = sys.argv[3:], sys.argv[2]
+    with tempfile.TemporaryDirectory() as dedupedir:
+        wheels = dedupe.dedupe(wheels, dedupedir, mangled=True)["outputs"]
+        consolidate_win.consolidate(wheels, destdir)
+    """
+)
+
+
+def _make_big_wheel(path, name, requires=()):
+    wheel = os.path.join(path, f"{name}-1.0-py3-none-win_amd64.whl")
+    chunk = b"\0" * (1024 * 1024)
+    with zipfile.ZipFile(wheel, "w", compression=zipfile.ZIP_DEFLATED) as wf:
+        with wf.open(f"{name}/data.bin", "w", force_zip64=True) as f:
+            for _ in range(MEMBER_SIZE // len(chunk)):
+                f.write(chunk)
+        wf.writestr(f"{name}.libs/libshared-{name}.so", b"shared library")
+        metadata = f"Metadata-Version: 2.1\nName: {name}\nVersion: 1.0\n"
+        for requirement in requires:
+            metadata += f"Requires-Dist: {requirement}\n"
+        wf.writestr(f"{name}-1.0.dist-info/METADATA", metadata)
+        wf.writestr(f"{name}-1.0.dist-info/WHEEL", "Tag: py3-none-win_amd64\n")
+    return wheel
+
+
+@pytest.mark.skipif(
+    not sys.platform.startswith("linux"), reason="Relies on /proc and RLIMIT_DATA"
+)
+def test_consolidate_bounded_memory(tmpdir):
+    wheels = [
+        _make_big_wheel(str(tmpdir), "bigfirst"),
+        _make_big_wheel(str(tmpdir), "bigsecond", requires=["bigfirst"]),
+    ]
+    destdir = tmpdir.mkdir("dest")
+
+    env = dict(os.environ, MALLOC_ARENA_MAX="2")
+    subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            CONSOLIDATE_SCRIPT,
+            str(MEMORY_BUDGET),
+            str(destdir),
+            *wheels,
+        ],
+        check=True,
+        env=env,
+    )
+
+    results = sorted(os.listdir(destdir))
+    assert results == [os.path.basename(wheel) for wheel in wheels]
+    with zipfile.ZipFile(os.path.join(destdir, results[1])) as wf:
+        assert wf.getinfo("bigsecond/data.bin").file_size == MEMBER_SIZE
+        # The duplicated library was removed from the dependant wheel
+        assert "bigsecond.libs/libshared-bigsecond.so" not in wf.namelist()
@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import os
+import struct
+
+import pytest
+
+from consolidatewheels import macho
+
+
+def test_get_dependencies(tmpdir, make_macho):
+    lib = make_macho(
+        os.path.join(tmpdir, "libfoo.dylib"),
+        libid="@rpath/libfoo.dylib",
+        dependencies=["@loader_path/libbar.dylib", "/usr/lib/libSystem.B.dylib"],
+    )
+    assert macho.get_dependencies(lib) == [
+        "@loader_path/libbar.dylib",
+        "/usr/lib/libSystem.B.dylib",
+    ]
+
+    # Universal binaries report the dependencies only once.
+    fat = make_macho(
+        os.path.join(tmpdir, "libfat.dylib"),
+        dependencies=["@loader_path/libbar.dylib"],
+        fat=True,
+    )
+    assert macho.get_dependencies(fat) == ["@loader_path/libbar.dylib"]
+
+    # Files that are not Mach-O have no dependencies, like otool would report.
+    notmacho = os.path.join(tmpdir, "notmacho.so")
+    with open(notmacho, "wb") as f:
+        f.write(b"\x7fELF" + b"\0" * 60)
+    assert macho.get_dependencies(notmacho) == []
+
+
+def test_change_install_names(tmpdir, make_macho):
+    lib = make_macho(
+        os.path.join(tmpdir, "libfoo.dylib"),
+        libid="@rpath/libfoo.dylib",
+        dependencies=["@loader_path/libbar.dylib", "/usr/lib/libSystem.B.dylib"],
+        padding=256,
+    )
+    size = os.path.getsize(lib)
+    macho.change_install_names(
+        lib,
+        libid="/!0123456789abcdef/libfoo.dylib",
+        changes={"@loader_path/libbar.dylib": "/!0123456789abcdef/libbar.dylib"},
+    )
+    assert macho.get_dependencies(lib) == [
+        "/!0123456789abcdef/libbar.dylib",
+        "/usr/lib/libSystem.B.dylib",
+    ]
+    with open(lib, "rb") as f:
+        header = macho._read_header(f, 0)
+        content = f.read()
+    assert [
+        macho._dylib_name(data, "<")
+        for cmd, _, data in macho._iter_commands(header)
+        if cmd == macho.LC_ID_DYLIB
+    ] == ["/!0123456789abcdef/libfoo.dylib"]
+    # Only the headers changed, the content of the library is preserved.
+    assert os.path.getsize(lib) == size
+    assert content.endswith(b"CODE")
+
+    # Shorter names leave the rest of the old commands zeroed.
+    macho.change_install_names(lib, libid="@rpath/libfoo.dylib")
+    with open(lib, "rb") as f:
+        header = macho._read_header(f, 0)
+    assert header["available"] - header["size"] > len(header["commands"])
+
+
+def test_change_install_names_fat(tmpdir, make_macho):
+    lib = make_macho(
+        os.path.join(tmpdir, "libfat.dylib"),
+        dependencies=["@loader_path/libbar.dylib"],
+        padding=64,
+        fat=True,
+    )
+    macho.change_install_names(
+        lib, changes={"@loader_path/libbar.dylib": "/!ID/libbar.dylib"}
+    )
+    with open(lib, "rb") as f:
+        offsets = macho._read_slices(f)
+        for offset in offsets:
+            header = macho._read_header(f, offset)
+            names = [
+                macho._dylib_name(data, "<")
+                for cmd, _, data in macho._iter_commands(header)
+                if cmd == macho.LC_LOAD_DYLIB
+            ]
+            assert names == ["/!ID/libbar.dylib"]
+    assert offsets == [4096, 8192]
+
+
+def test_change_install_names_errors(tmpdir, make_macho):
+    # Without header padding longer names can't fit.
+    lib = make_macho(os.path.join(tmpdir, "libfoo.dylib"), libid="@rpath/libfoo.dylib")
+    with open(lib, "rb") as f:
+        original = f.read()
+    with pytest.raises(macho.MachOError, match="headerpad_max_install_names"):
+        macho.change_install_names(lib, libid="/!0123456789abcdef/libfoo.dylib")
+    with open(lib, "rb") as f:
+        assert f.read() == original
+
+    notmacho = os.path.join(tmpdir, "notmacho.so")
+    with open(notmacho, "wb") as f:
+        f.write(b"\0" * 4)
+    with pytest.raises(macho.MachOError, match="Not a Mach-O file"):
+        macho.change_install_names(notmacho, libid="libfoo.dylib")
+
+    corrupted = os.path.join(tmpdir, "corrupted.dylib")
+    with open(corrupted, "wb") as f:
+        f.write(original[:40])
+    with pytest.raises(macho.MachOError, match="Corrupted load commands"):
+        macho.get_dependencies(corrupted)
+
+
+def test_other_formats(tmpdir):
+    # 32bit big endian library with a segment without sections.
+    name = b"@loader_path/libbar.dylib\0\0\0"
+    commands = struct.pack(
+        ">II16sIIIIiiII", macho.LC_SEGMENT, 56, b"", 0, 0, 0, 0, 5, 5, 0, 0
+    )
+    commands += struct.pack(">IIIIII", macho.LC_LOAD_DYLIB, 24 + len(name), 24, 0, 0, 0)
+    commands += name
+    binary = struct.pack(">IiiIIII", macho.MH_MAGIC, 18, 0, 6, 2, len(commands), 0)
+    binary += commands
+
+    # Wrapped in a universal binary with 64bit offsets.
+    fat = struct.pack(">II", macho.FAT_MAGIC_64, 1)
+    fat += struct.pack(">iiQQII", 18, 0, 64, len(binary), 6, 0)
+    path = os.path.join(tmpdir, "libppc.dylib")
+    with open(path, "wb") as f:
+        f.write(fat.ljust(64, b"\0") + binary)
+
+    assert macho.get_dependencies(path) == ["@loader_path/libbar.dylib"]
+    macho.change_install_names(
+        path, changes={"@loader_path/libbar.dylib": "@loader_path/libb.dylib"}
+    )
+    assert macho.get_dependencies(path) == ["@loader_path/libb.dylib"]
+
+    # Universal binaries pointing to something that isn't Mach-O.
+    with open(path, "wb") as f:
+        f.write(fat.ljust(64 + len(binary), b"\0"))
+    with pytest.raises(macho.MachOError, match="Not a Mach-O file"):
+        macho.get_dependencies(path)
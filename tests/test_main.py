@@ -1,14 +1,51 @@
 from __future__ import annotations
 
 import argparse
+import logging
 import os
 import platform
+import shutil
+import subprocess
+import sys
+import threading
+import zipfile
 from subprocess import CalledProcessError
 from unittest import mock
 
+import pytest
+
 from consolidatewheels import __main__  # noqa
 from consolidatewheels import main
 
+HERE = os.path.dirname(__file__)
+LINUX_TAG = "manylinux1_x86_64.manylinux_2_5_x86_64"
+# How many times importing json the command line tool can take to import,
+# both measured by -X importtime in the same interpreter.
+IMPORT_TIME_BUDGET = 15
+CHECK_DISK_SPACE = main.check_disk_space
+# Modules only needed by some of the platform backends.
+LAZY_MODULES = {
+    "asyncio",
+    "consolidatewheels.analyze",
+    "consolidatewheels.consolidate_linux",
+    "consolidatewheels.consolidate_osx",
+    "consolidatewheels.consolidate_win",
+    "consolidatewheels.dedupe",
+    "consolidatewheels.watch",
+    "packaging",
+    "pefile",
+    "pkginfo",
+}
+
+
+@pytest.fixture(autouse=True)
+def disk_space():
+    """By default behave like there is enough free space."""
+    with mock.patch(
+        "consolidatewheels.main.check_disk_space", return_value=True
+    ) as check_disk_space:
+        yield check_disk_space
+
 
 def test_options():
     # No options provided ensure we error.
@@ -40,6 +77,133 @@ def test_options():
     assert opts.wheels == ["wheel1"]
     assert opts.dest == os.path.abspath(os.getcwd())
 
+    # Ensure the workdir defaults to the destination
+    assert opts.workdir == opts.dest
+    with mock.patch("sys.argv", ["consolidatewheels", "wheel1", "--workdir", "w"]):
+        opts = main.parse_options()
+    assert opts.workdir == os.path.abspath("w")
+
+    # The target is detected by default, signing can be customized or disabled.
+    assert opts.target == "auto"
+    assert opts.codesign is None
+    with mock.patch(
+        "sys.argv",
+        ["consolidatewheels", "w1", "--target", "macos", "--codesign", "my sign"],
+    ):
+        opts = main.parse_options()
+    assert opts.target == "macos"
+    assert opts.codesign == ["my", "sign"]
+    with mock.patch("sys.argv", ["consolidatewheels", "w1", "--codesign", "none"]):
+        opts = main.parse_options()
+    assert opts.codesign == []
+
+    # Libraries can't be moved to a new wheel when consolidating incrementally.
+    assert opts.libs_wheel is None
+    with mock.patch("sys.argv", ["consolidatewheels", "w1", "--libs-wheel", "family"]):
+        opts = main.parse_options()
+    assert opts.libs_wheel == "family"
+    assert opts.reproducible is False
+    with mock.patch("sys.argv", ["consolidatewheels", "w1", "--reproducible"]):
+        assert main.parse_options().reproducible is True
+    assert opts.strip_debug is False
+    with mock.patch("sys.argv", ["consolidatewheels", "w1", "--strip-debug"]):
+        assert main.parse_options().strip_debug is True
+    assert opts.cache_dir is None
+    assert opts.cache_max_size == 5 * 1024**3
+    with mock.patch(
+        "sys.argv", ["consolidatewheels", "w1", "--cache-max-size", "1G", "--cache-dir"]
+    ), mock.patch.dict(os.environ, {"XDG_CACHE_HOME": "/xdg"}):
+        opts = main.parse_options()
+    assert opts.cache_dir == os.path.join("/xdg", "consolidatewheels")
+    assert opts.cache_max_size == 1024**3
+    with mock.patch("sys.argv", ["consolidatewheels", "--cache-dir", "c", "w1"]):
+        assert main.parse_options().cache_dir == os.path.abspath("c")
+    with mock.patch(
+        "sys.argv",
+        ["consolidatewheels", "w1", "--libs-wheel", "family", "--against", "m.json"],
+    ), mock.patch("sys.exit", side_effect=SystemExit) as sys_exit:
+        with pytest.raises(SystemExit):
+            main.parse_options()
+    sys_exit.assert_called_with(2)
+
+
+def test_options_argsfile(tmpdir):
+    # Wheels can be listed in a file, to avoid command line length limits.
+    argsfile = tmpdir.join("wheels.txt")
+    argsfile.write("--reproducible\nwheel1\nwheel2\n")
+    with mock.patch("sys.argv", ["consolidatewheels", f"@{argsfile}", "wheel3"]):
+        opts = main.parse_options()
+    assert opts.wheels == ["wheel1", "wheel2", "wheel3"]
+    assert opts.reproducible is True
+
+
+def test_find_wheels(tmpdir):
+    for dirname in ("one", "two"):
+        for wheel in ("b-1.0-py3-none-any.whl", "a-1.0-py3-none-any.whl"):
+            tmpdir.join(dirname, wheel).write("", ensure=True)
+    tmpdir.join("one", "README.txt").write("")
+    tmpdir.join("[special]", "c-1.0-py3-none-any.whl").write("", ensure=True)
+
+    wheels = main.find_wheels(
+        [
+            str(tmpdir.join("one")),
+            "",
+            str(tmpdir.join("*", "b-*.whl")),
+            str(tmpdir.join("[special]")),
+            "d-1.0-py3-none-any.whl",
+        ]
+    )
+    # Wheels are discovered lazily.
+    assert not isinstance(wheels, list)
+    assert [os.path.relpath(wheel, tmpdir) for wheel in wheels] == [
+        os.path.join("one", "a-1.0-py3-none-any.whl"),
+        os.path.join("one", "b-1.0-py3-none-any.whl"),
+        os.path.join("one", "b-1.0-py3-none-any.whl"),
+        os.path.join("two", "b-1.0-py3-none-any.whl"),
+        os.path.join("[special]", "c-1.0-py3-none-any.whl"),
+        os.path.relpath("d-1.0-py3-none-any.whl", tmpdir),
+    ]
+
+    # Existing wheels are not mistaken for patterns.
+    literal = tmpdir.join("one", "pkg[cuda]-1.0-py3-none-any.whl")
+    literal.write("")
+    assert list(main.find_wheels([str(literal)])) == [str(literal)]
+
+    # Recursive patterns are supported
+    wheels = main.find_wheels([str(tmpdir.join("**", "a-*.whl"))])
+    assert len(list(wheels)) == 2
+
+    # Patterns that match nothing are most likely a mistake.
+    with pytest.raises(ValueError, match="No wheels match"):
+        list(main.find_wheels([str(tmpdir.join("*.whl"))]))
+
+
+def test_detect_target():
+    assert main.detect_target(["a-1.0-cp310-cp310-win_amd64.whl"]) == "windows"
+    assert (
+        main.detect_target(
+            ["a-1.0-py3-none-any.whl", "b-1.0-cp310-cp310-macosx_11_0_arm64.whl"]
+        )
+        == "macos"
+    )
+    assert main.detect_target(["a-1.0-py3-none-any.whl"]) is None
+    with pytest.raises(ValueError, match="multiple platforms: linux, windows"):
+        main.detect_target(
+            [
+                "a-1.0-cp310-cp310-win_amd64.whl",
+                "b-1.0-cp310-cp310-manylinux_2_17_x86_64.whl",
+            ]
+        )
+
+
+def test_default_codesign():
+    with mock.patch("platform.system", return_value="Darwin"):
+        assert main.default_codesign() == ["codesign", "--force", "-s", "-"]
+    with mock.patch("platform.system", return_value="Linux"), mock.patch(
+        "shutil.which", return_value="/usr/bin/rcodesign"
+    ):
+        assert main.default_codesign() == ["rcodesign", "sign"]
+
 
 def test_requirements_satisfied():
     # Ensure we detect when it's not a supported platform
@@ -91,24 +255,55 @@ def test_requirements_satisfied():
         verify_result = main.requirements_satisfied()
     assert verify_result is True
 
+    # Windows and macOS wheels can be consolidated from Linux.
+    with mock.patch("platform.system", return_value="linux"):
+        assert main.requirements_satisfied("windows") is True
+    with mock.patch("platform.system", return_value="linux"), mock.patch(
+        "shutil.which", side_effect=lambda tool: tool == "rcodesign" or None
+    ):
+        assert main.requirements_satisfied("macos", ["rcodesign", "sign"]) is True
+        assert main.requirements_satisfied("macos", ["codesign"]) is False
+        # Signing can be disabled
+        assert main.requirements_satisfied("macos", []) is True
 
-def test_main():
+
+def test_main(tmpdir):
     # Mostly just test that main runs consolidate at the end.
     default_options = argparse.Namespace()
     default_options.dest = "somedestdir"
-    default_options.wheels = ["one", "two"]
+    default_options.wheels = ["one-1.0-py3-none-any.whl", "two-1.0-py3-none-any.whl"]
+    default_options.against = None
+    default_options.workdir = str(tmpdir.join("workdir"))
+    default_options.target = "auto"
+    default_options.codesign = None
+    default_options.libs_wheel = None
+    default_options.reproducible = False
+    default_options.jobs = None
+    default_options.verify_inputs = False
+    default_options.cache_dir = None
+    default_options.strip_debug = False
 
     # Simulate Linux
     with mock.patch("platform.system", return_value="linux"), mock.patch(
         "consolidatewheels.main.requirements_satisfied", return_value=True
     ), mock.patch(
         "consolidatewheels.main.parse_options", return_value=default_options
+    ), mock.patch(
+        "consolidatewheels.manifest.update_manifest"
+    ), mock.patch(
+        "consolidatewheels.manifest.write_manifest"
     ), mock.patch(
         "consolidatewheels.consolidate_linux.consolidate"
     ) as consolidate_func:
         main.main()
     consolidate_func.assert_called_once_with(
-        default_options.wheels, default_options.dest
+        default_options.wheels,
+        default_options.dest,
+        against=None,
+        workdir=default_options.workdir,
+        reproducible=False,
+        cachedir=None,
+        strip=False,
     )
 
     # Simulate OSX
@@ -117,13 +312,28 @@ def test_main():
     ), mock.patch(
         "consolidatewheels.main.parse_options", return_value=default_options
     ), mock.patch(
-        "consolidatewheels.dedupe.dedupe", return_value=default_options.wheels
+        "consolidatewheels.manifest.update_manifest"
+    ), mock.patch(
+        "consolidatewheels.manifest.write_manifest"
+    ), mock.patch(
+        "consolidatewheels.dedupe.dedupe",
+        return_value={
+            "outputs": default_options.wheels,
+            "removed": [],
+            "bytes_saved": 0,
+        },
     ), mock.patch(
         "consolidatewheels.consolidate_osx.consolidate"
     ) as consolidate_func:
         main.main()
     consolidate_func.assert_called_once_with(
-        default_options.wheels, default_options.dest
+        default_options.wheels,
+        default_options.dest,
+        against=None,
+        workdir=default_options.workdir,
+        codesign=["codesign", "--force", "-s", "-"],
+        libs_wheel=None,
+        reproducible=False,
     )
 
     # Simulate Windows
@@ -132,18 +342,33 @@ def test_main():
     ), mock.patch(
         "consolidatewheels.main.parse_options", return_value=default_options
     ), mock.patch(
-        "consolidatewheels.dedupe.dedupe", return_value=default_options.wheels
+        "consolidatewheels.manifest.update_manifest"
+    ), mock.patch(
+        "consolidatewheels.manifest.write_manifest"
+    ), mock.patch(
+        "consolidatewheels.dedupe.dedupe",
+        return_value={
+            "outputs": default_options.wheels,
+            "removed": [],
+            "bytes_saved": 0,
+        },
     ), mock.patch(
         "consolidatewheels.consolidate_win.consolidate"
     ) as consolidate_func:
         main.main()
     consolidate_func.assert_called_once_with(
-        default_options.wheels, default_options.dest
+        default_options.wheels,
+        default_options.dest,
+        against=None,
+        workdir=default_options.workdir,
+        reproducible=False,
     )
 
     # Ensure we exit if we fail checking requirements
     with mock.patch(
         "consolidatewheels.main.requirements_satisfied", return_value=False
+    ), mock.patch(
+        "consolidatewheels.main.parse_options", return_value=default_options
     ), mock.patch(
         "consolidatewheels.consolidate_linux.consolidate"
     ) as consolidate_linux_func, mock.patch(
@@ -160,3 +385,792 @@ def test_main():
         "windows": consolidate_win_func,
     }[platform.system().lower()]
     consolidate_func.assert_not_called()
+
+
+def test_main_target(tmpdir):
+    options = argparse.Namespace()
+    options.dest = "somedestdir"
+    options.wheels = ["a-1.0-cp310-cp310-macosx_11_0_arm64.whl"]
+    options.against = None
+    options.workdir = str(tmpdir.join("workdir"))
+    options.target = "auto"
+    options.codesign = ["rcodesign", "sign"]
+    options.libs_wheel = None
+    options.reproducible = False
+    options.jobs = None
+    options.verify_inputs = False
+    options.cache_dir = None
+    options.strip_debug = False
+
+    # The backend is chosen by the wheels, not by the running system.
+    with mock.patch("platform.system", return_value="linux"), mock.patch(
+        "consolidatewheels.main.requirements_satisfied", return_value=True
+    ) as requirements_satisfied, mock.patch(
+        "consolidatewheels.main.parse_options", return_value=options
+    ), mock.patch(
+        "consolidatewheels.manifest.update_manifest"
+    ) as update_manifest, mock.patch(
+        "consolidatewheels.manifest.write_manifest"
+    ), mock.patch(
+        "consolidatewheels.dedupe.dedupe",
+        return_value={"outputs": options.wheels, "removed": [], "bytes_saved": 0},
+    ), mock.patch(
+        "consolidatewheels.consolidate_osx.consolidate"
+    ) as consolidate_func:
+        assert main.main() == 0
+    requirements_satisfied.assert_called_once_with("macos", ["rcodesign", "sign"])
+    consolidate_func.assert_called_once_with(
+        options.wheels,
+        options.dest,
+        against=None,
+        workdir=options.workdir,
+        codesign=["rcodesign", "sign"],
+        libs_wheel=None,
+        reproducible=False,
+    )
+    assert update_manifest.call_args[0][1] == "macos"
+
+    # Unsupported targets are refused.
+    with pytest.raises(ValueError, match="Unsupported target"):
+        main.consolidate_group("os2", options.wheels, options)
+
+
+def test_main_libs_wheel(tmpdir):
+    options = argparse.Namespace()
+    options.dest = "somedestdir"
+    options.wheels = ["a-1.0-cp310-cp310-manylinux_2_17_x86_64.whl"]
+    options.against = None
+    options.workdir = str(tmpdir.join("workdir"))
+    options.target = "auto"
+    options.codesign = None
+    options.libs_wheel = "family"
+    options.reproducible = False
+    options.jobs = None
+    options.verify_inputs = False
+    options.cache_dir = None
+    options.strip_debug = False
+    deduped = ["family_libs-1.0-py3-none-manylinux_2_17_x86_64.whl"] + options.wheels
+
+    # On Linux wheels are deduped too, to move the libraries into the new wheel.
+    with mock.patch(
+        "consolidatewheels.main.requirements_satisfied", return_value=True
+    ), mock.patch(
+        "consolidatewheels.main.parse_options", return_value=options
+    ), mock.patch(
+        "consolidatewheels.manifest.update_manifest"
+    ), mock.patch(
+        "consolidatewheels.manifest.write_manifest"
+    ), mock.patch(
+        "consolidatewheels.dedupe.dedupe",
+        return_value={"outputs": deduped, "removed": [], "bytes_saved": 0},
+    ) as dedupe_func, mock.patch(
+        "consolidatewheels.consolidate_linux.consolidate"
+    ) as consolidate_func:
+        assert main.main() == 0
+    assert dedupe_func.call_args[1]["mangled"] is True
+    assert dedupe_func.call_args[1]["libs_wheel"] == "family"
+    consolidate_func.assert_called_once_with(
+        deduped,
+        options.dest,
+        workdir=options.workdir,
+        libs_wheel="family",
+        reproducible=False,
+        strip=False,
+    )
+
+
+def test_main_groups(tmpdir, capsys):
+    options = argparse.Namespace()
+    options.dest = "somedestdir"
+    options.against = None
+    options.workdir = str(tmpdir.join("workdir"))
+    options.target = "auto"
+    options.codesign = None
+    options.libs_wheel = None
+    options.reproducible = False
+    options.jobs = None
+    options.verify_inputs = False
+    options.cache_dir = None
+    options.strip_debug = True
+    linux_wheels = [
+        "a-1.0-cp310-cp310-manylinux_2_17_x86_64.whl",
+        "b-1.0-cp310-cp310-manylinux_2_17_x86_64.whl",
+    ]
+    for wheel in linux_wheels + ["README.txt"]:
+        tmpdir.join(wheel).write("")
+    options.wheels = [
+        str(tmpdir),
+        "a-1.0-cp311-cp311-manylinux_2_17_x86_64.whl",
+        "a-1.0-cp310-cp310-win_amd64.whl",
+    ]
+
+    # Each group of wheels is consolidated on its own.
+    def consolidate_linux(
+        wheels, destdir, against, workdir, reproducible, cachedir, strip
+    ):
+        if "cp311" in wheels[0]:
+            raise RuntimeError("Unable to apply mangling")
+        return {"providers": {"libfoo.so": "a"}}
+
+    with mock.patch(
+        "consolidatewheels.main.requirements_satisfied", return_value=True
+    ), mock.patch(
+        "consolidatewheels.main.parse_options", return_value=options
+    ), mock.patch(
+        "consolidatewheels.manifest.update_manifest"
+    ) as update_manifest, mock.patch(
+        "consolidatewheels.manifest.write_manifest"
+    ) as write_manifest, mock.patch(
+        "consolidatewheels.dedupe.dedupe",
+        side_effect=lambda wheels, *a, **k: {
+            "outputs": wheels,
+            "removed": [],
+            "bytes_saved": 0,
+        },
+    ), mock.patch(
+        "consolidatewheels.consolidate_win.consolidate", return_value={"providers": {}}
+    ) as consolidate_win, mock.patch(
+        "consolidatewheels.consolidate_linux.consolidate",
+        side_effect=consolidate_linux,
+    ) as consolidate_func:
+        # The failure of a group doesn't prevent the others from completing.
+        assert main.main() == 1
+
+    assert sorted(call[0][0] for call in consolidate_func.call_args_list) == [
+        [os.path.join(tmpdir, wheel) for wheel in linux_wheels],
+        ["a-1.0-cp311-cp311-manylinux_2_17_x86_64.whl"],
+    ]
+    consolidate_win.assert_called_once_with(
+        ["a-1.0-cp310-cp310-win_amd64.whl"],
+        options.dest,
+        against=None,
+        workdir=options.workdir,
+        reproducible=False,
+    )
+    assert update_manifest.call_count == 2
+    assert sorted(write_manifest.call_args[0][1]) == [
+        "cp310-linux_x86_64",
+        "cp310-win_amd64",
+    ]
+    output = capsys.readouterr().out
+    assert "Consolidated 2 of 3 groups of wheels:" in output
+    assert "  cp310-linux_x86_64: 2 wheels, 1 shared libraries" in output
+    assert "  cp311-linux_x86_64: FAILED, Unable to apply mangling" in output
+    assert "Debug sections are only stripped from Linux wheels, not windows" in output
+
+    # Files that are not wheels are refused
+    options.wheels = ["README.txt"]
+    with mock.patch("consolidatewheels.main.parse_options", return_value=options):
+        assert main.main() == 1
+    assert "Error: Invalid wheel filename: README.txt" in capsys.readouterr().out
+
+
+def test_main_pass_through(tmpdir, capsys):
+    options = argparse.Namespace()
+    options.dest = str(tmpdir.join("dest"))
+    options.against = None
+    options.target = "auto"
+    options.codesign = None
+    options.jobs = None
+    options.verify_inputs = False
+    options.cache_dir = None
+    options.strip_debug = False
+    wheels = []
+    for name in ("a", "b"):
+        wheel = tmpdir.join(f"{name}-1.0-cp310-cp310-manylinux_2_17_x86_64.whl")
+        wheel.write(name)
+        wheels.append(str(wheel))
+    options.wheels = wheels
+
+    # Wheels that were already consolidated together are published as they are.
+    with mock.patch(
+        "consolidatewheels.main.requirements_satisfied", return_value=True
+    ), mock.patch(
+        "consolidatewheels.main.parse_options", return_value=options
+    ), mock.patch(
+        "consolidatewheels.manifest.consolidated_together", return_value=True
+    ), mock.patch(
+        "consolidatewheels.consolidate_linux.consolidate"
+    ) as consolidate_func:
+        assert main.main() == 0
+        consolidate_func.assert_not_called()
+        assert sorted(os.listdir(options.dest)) == [
+            os.path.basename(wheel) for wheel in wheels
+        ]
+        assert tmpdir.join("dest", os.path.basename(wheels[1])).read() == "b"
+        assert "already consolidated, passing them through" in capsys.readouterr().out
+
+        # Even when they are already in the destination
+        options.wheels = [os.path.join(options.dest, "*.whl")]
+        assert main.main() == 0
+        assert sorted(os.listdir(options.dest)) == [
+            os.path.basename(wheel) for wheel in wheels
+        ]
+
+        with mock.patch(
+            "consolidatewheels.workspace.clone_file",
+            side_effect=OSError("No space left on device"),
+        ):
+            options.wheels = wheels
+            options.dest = str(tmpdir.join("full"))
+            assert main.main() == 1
+    assert "Error: No space left on device" in capsys.readouterr().out
+
+
+def test_main_verify_inputs(tmpdir, capsys):
+    options = argparse.Namespace()
+    options.dest = str(tmpdir.join("dest"))
+    options.verify_inputs = True
+    wheel = tmpdir.join("a-1.0-cp310-cp310-manylinux_2_17_x86_64.whl")
+    wheel.write("truncated")
+    options.wheels = [str(wheel)]
+
+    # Corrupted wheels are reported before consolidating anything.
+    with mock.patch(
+        "consolidatewheels.main.parse_options", return_value=options
+    ), mock.patch(
+        "consolidatewheels.main.requirements_satisfied"
+    ) as requirements_satisfied:
+        assert main.main() == 1
+    requirements_satisfied.assert_not_called()
+    output = capsys.readouterr().out
+    assert "Verifying 1 wheels against their RECORD" in output
+    assert f"Error: Unable to read {wheel}" in output
+
+
+def test_main_cache(tmpdir, capsys):
+    options = argparse.Namespace()
+    options.dest = str(tmpdir.join("dest"))
+    options.wheels = ["a-1.0-cp310-cp310-manylinux_2_17_x86_64.whl"]
+    options.against = None
+    options.workdir = str(tmpdir)
+    options.target = "auto"
+    options.codesign = None
+    options.libs_wheel = None
+    options.reproducible = False
+    options.jobs = None
+    options.verify_inputs = False
+    options.cache_dir = str(tmpdir.join("cache"))
+    options.strip_debug = False
+    options.cache_max_size = 1024
+
+    # Wheels are unpacked from the cache, which is pruned at the end.
+    with mock.patch(
+        "consolidatewheels.main.requirements_satisfied", return_value=True
+    ), mock.patch(
+        "consolidatewheels.main.parse_options", return_value=options
+    ), mock.patch(
+        "consolidatewheels.manifest.update_manifest"
+    ), mock.patch(
+        "consolidatewheels.manifest.write_manifest"
+    ), mock.patch(
+        "consolidatewheels.consolidate_linux.consolidate"
+    ) as consolidate_func, mock.patch(
+        "consolidatewheels.cache.prune", return_value=(2, 4096)
+    ) as prune:
+        assert main.main() == 0
+    assert consolidate_func.call_args[1]["cachedir"] == options.cache_dir
+    prune.assert_called_once_with(options.cache_dir, 1024)
+    assert (
+        f"Evicted 2 wheels from the cache in {options.cache_dir}, 4.0 KB freed"
+        in capsys.readouterr().out
+    )
+
+
+def test_watch(tmpdir, capsys):
+    watched = tmpdir.mkdir("dist")
+    cachedir = str(tmpdir.join("cache"))
+    wheels = [
+        os.path.join(HERE, "files", f"{name}-0.0.0-cp310-cp310-{LINUX_TAG}.whl")
+        for name in ("libfirst", "libtwo")
+    ]
+    arrivals = list(wheels)
+
+    def sleep(interval):
+        if arrivals:
+            shutil.copy(arrivals.pop(0), str(watched))
+
+    # Wheels are verified and unpacked as they appear, then consolidated.
+    with mock.patch(
+        "sys.argv",
+        [
+            "consolidatewheels",
+            "watch",
+            str(watched),
+            "--expect",
+            "2",
+            "--cache-dir",
+            cachedir,
+            "--dest",
+            str(tmpdir.join("dest")),
+            "--verify-inputs",
+        ],
+    ), mock.patch("time.sleep", side_effect=sleep), mock.patch(
+        "consolidatewheels.main.requirements_satisfied", return_value=True
+    ), mock.patch(
+        "consolidatewheels.manifest.update_manifest"
+    ), mock.patch(
+        "consolidatewheels.manifest.write_manifest"
+    ), mock.patch(
+        "consolidatewheels.main.verify_wheels"
+    ) as verify_wheels, mock.patch(
+        "consolidatewheels.consolidate_linux.consolidate"
+    ) as consolidate_func:
+        assert main.main() == 0
+    watched_wheels = [
+        os.path.join(watched, os.path.basename(wheel)) for wheel in wheels
+    ]
+    assert verify_wheels.call_args_list == [
+        mock.call([wheel]) for wheel in watched_wheels
+    ]
+    assert consolidate_func.call_args[0][0] == watched_wheels
+    assert consolidate_func.call_args[1]["cachedir"] == cachedir
+    assert len(os.listdir(os.path.join(cachedir, "trees"))) == 2
+    output = capsys.readouterr().out
+    assert f"Found {watched_wheels[0]}" in output
+    assert "All 2 wheels arrived" in output
+
+    # Wheels that can't be prepared are reported without waiting for the others.
+    failing = tmpdir.mkdir("failing")
+    failed = threading.Event()
+
+    def prepare_wheel(wheel, opts):
+        failed.set()
+        raise RuntimeError(f"Unable to unpack {wheel}")
+
+    def sleep_until_failure(interval):
+        if not failing.listdir():
+            failing.join("first-0.0.0-py3-none-any.whl").write("")
+        elif failed.is_set() and len(failing.listdir()) == 1:
+            # Let the failure be recorded before the next wheel appears.
+            threading.Event().wait(0.1)
+            failing.join("second-0.0.0-py3-none-any.whl").write("")
+
+    with mock.patch(
+        "sys.argv",
+        ["consolidatewheels", "watch", str(failing), "--until", "DONE"],
+    ), mock.patch(
+        "consolidatewheels.main.prepare_wheel", side_effect=prepare_wheel
+    ), mock.patch(
+        "time.sleep", side_effect=sleep_until_failure
+    ), mock.patch(
+        "consolidatewheels.main.consolidate_wheels"
+    ) as consolidate_wheels:
+        assert main.main() == 1
+    consolidate_wheels.assert_not_called()
+    output = capsys.readouterr().out
+    assert "Found " + str(failing.join("second-0.0.0-py3-none-any.whl")) not in output
+    assert "Error: Unable to unpack" in output
+
+
+def test_watch_options(tmpdir):
+    with mock.patch.dict(os.environ, {"XDG_CACHE_HOME": str(tmpdir)}):
+        opts = main.parse_watch_options(["dist", "--until", "DONE"])
+    assert opts.directory == os.path.abspath("dist")
+    assert opts.until == "DONE"
+    assert opts.wheels == []
+    assert opts.cache_dir == str(tmpdir.join("consolidatewheels"))
+
+    with mock.patch("sys.exit", side_effect=SystemExit) as sys_exit:
+        with pytest.raises(SystemExit):
+            main.parse_watch_options(["dist"])
+    sys_exit.assert_called_with(2)
+
+
+def test_log_to_stdout(capsys):
+    logger = logging.getLogger("consolidatewheels.main")
+    logger.info("Hidden")
+    with main.log_to_stdout():
+        logger.info("Shown")
+    logger.info("Hidden again")
+    assert capsys.readouterr().out == "Shown\n"
+    assert not logging.getLogger("consolidatewheels").handlers
+
+
+def test_cache_prune(tmpdir, capsys):
+    cachedir = str(tmpdir.join("cache"))
+    with mock.patch(
+        "sys.argv", ["consolidatewheels", "cache", "prune", "--cache-dir", cachedir]
+    ), mock.patch("consolidatewheels.cache.prune", return_value=(1, 10)) as prune:
+        assert main.main() == 0
+    prune.assert_called_once_with(cachedir, 0)
+    assert "Evicted 1 wheels" in capsys.readouterr().out
+
+    with mock.patch(
+        "sys.argv", ["consolidatewheels", "cache", "prune", "--max-size", "1M"]
+    ), mock.patch.dict(os.environ, {"XDG_CACHE_HOME": str(tmpdir)}), mock.patch(
+        "consolidatewheels.cache.prune", return_value=(0, 0)
+    ) as prune:
+        assert main.main() == 0
+    prune.assert_called_once_with(str(tmpdir.join("consolidatewheels")), 1024**2)
+    assert capsys.readouterr().out == ""
+
+    with mock.patch(
+        "sys.argv", ["consolidatewheels", "cache", "prune", "--cache-dir", cachedir]
+    ), mock.patch(
+        "consolidatewheels.cache.prune", side_effect=PermissionError("Denied")
+    ):
+        assert main.main() == 1
+    assert "Error: Denied" in capsys.readouterr().out
+
+
+def _measures(seconds, mapped_bytes, libraries, error=None):
+    return {
+        "seconds": seconds,
+        "error": error,
+        "mapped_bytes": mapped_bytes,
+        "libraries": libraries,
+    }
+
+
+def test_analyze(tmpdir, capsys):
+    inputs = {
+        "packages": {
+            "one": _measures(0.01, 2048, {"libdbg.so": 1}),
+            "two": _measures(0.02, 2048, {"libdbg.so": 1}, "two: ImportError: no"),
+        },
+        "all": _measures(0.03, 4096, {"libdbg.so": 2}),
+    }
+    consolidated = {
+        "packages": {"one": _measures(0.01, 2048, {"libdbg.so": 1})},
+        "all": _measures(0.02, 2048, {"libdbg.so": 1}),
+    }
+    with mock.patch(
+        "sys.argv",
+        [
+            "consolidatewheels",
+            "analyze",
+            os.path.join(HERE, "files"),
+            "--consolidated",
+            "one-1.0-py3-none-any.whl",
+            "--workdir",
+            str(tmpdir),
+        ],
+    ), mock.patch(
+        "consolidatewheels.analyze.analyze_wheels",
+        side_effect=[inputs, consolidated],
+    ) as analyze_wheels:
+        assert main.main() == 0
+    assert analyze_wheels.call_args_list == [
+        mock.call(list(main.find_wheels([os.path.join(HERE, "files")])), str(tmpdir)),
+        mock.call(["one-1.0-py3-none-any.whl"], str(tmpdir)),
+    ]
+    out = capsys.readouterr().out
+    assert (
+        "  all: 0.030s to import, 4.0 KB of libraries mapped, 1 embedded libraries, "
+        "loaded multiple times: libdbg.so x2\n" in out
+    )
+    assert "    Import failed, two: ImportError: no\n" in out
+    assert "  2 -> 1 embedded libraries loaded\n" in out
+    assert "  4.0 KB -> 2.0 KB of libraries mapped\n" in out
+    assert "  0.030s -> 0.020s to import\n" in out
+
+    with mock.patch(
+        "sys.argv", ["consolidatewheels", "analyze", "one-1.0-py3-none-any.whl"]
+    ), mock.patch(
+        "consolidatewheels.analyze.analyze_wheels", return_value=consolidated
+    ) as analyze_wheels:
+        assert main.main() == 0
+    analyze_wheels.assert_called_once_with(["one-1.0-py3-none-any.whl"], None)
+    out = capsys.readouterr().out
+    assert "Inputs:\n" in out
+    assert "after consolidation" not in out
+
+    with mock.patch(
+        "sys.argv", ["consolidatewheels", "analyze", "one-1.0-py3-none-any.whl"]
+    ), mock.patch(
+        "consolidatewheels.analyze.analyze_wheels",
+        side_effect=RuntimeError("Wheels can only be analyzed on Linux"),
+    ):
+        assert main.main() == 1
+    assert "Error: Wheels can only be analyzed on Linux" in capsys.readouterr().out
+
+
+def test_main_disk_space(tmpdir, disk_space, capsys):
+    options = argparse.Namespace()
+    options.dest = "somedestdir"
+    options.wheels = ["one-1.0-py3-none-any.whl"]
+    options.against = None
+    options.workdir = str(tmpdir.join("workdir"))
+    options.target = "linux"
+    options.codesign = None
+    options.libs_wheel = None
+    options.reproducible = False
+    options.jobs = None
+    options.verify_inputs = False
+    options.cache_dir = None
+    options.strip_debug = False
+
+    # Nothing is consolidated when there isn't enough space.
+    disk_space.return_value = False
+    with mock.patch(
+        "consolidatewheels.main.requirements_satisfied", return_value=True
+    ), mock.patch(
+        "consolidatewheels.main.parse_options", return_value=options
+    ), mock.patch(
+        "consolidatewheels.consolidate_linux.consolidate"
+    ) as consolidate_func:
+        assert main.main() == 1
+    consolidate_func.assert_not_called()
+    disk_space.assert_called_once_with(
+        {"py3-any": options.wheels}, {"py3-any": "linux"}, options
+    )
+
+    assert "Error: Not enough free space" in capsys.readouterr().out
+
+    # Corrupt wheels are reported as such, not as a lack of space.
+    corrupt = tmpdir.join("one-1.0-py3-none-any.whl")
+    corrupt.write("not a zip file")
+    options.wheels = [str(corrupt)]
+    disk_space.side_effect = CHECK_DISK_SPACE
+    with mock.patch(
+        "consolidatewheels.main.requirements_satisfied", return_value=True
+    ), mock.patch(
+        "consolidatewheels.main.parse_options", return_value=options
+    ), mock.patch(
+        "consolidatewheels.consolidate_linux.consolidate"
+    ) as consolidate_func:
+        assert main.main() == 1
+    consolidate_func.assert_not_called()
+    output = capsys.readouterr().out
+    assert f"Error: Unable to read {corrupt}" in output
+    assert "Not enough free space" not in output
+
+
+def _make_wheel(path, content):
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as wf:
+        wf.writestr("member", content)
+    return str(path)
+
+
+def test_estimate_disk_usage(tmpdir):
+    options = argparse.Namespace(libs_wheel=None)
+    linux_wheel = _make_wheel(
+        tmpdir.join("a-1.0-py3-none-linux_x86_64.whl"), "a" * 1000
+    )
+    win_wheel = _make_wheel(tmpdir.join("a-1.0-py3-none-win_amd64.whl"), "b" * 3000)
+    compressed = os.path.getsize(linux_wheel)
+
+    # Linux wheels are only unpacked and packed again.
+    pending = {"linux": [linux_wheel]}
+    targets = {"linux": "linux", "win": "windows"}
+    assert main.estimate_disk_usage(pending, targets, options) == (
+        1000 + compressed,
+        compressed,
+    )
+
+    # Deduped wheels are packed twice, and concurrent groups add up.
+    pending["win"] = [win_wheel]
+    win_compressed = os.path.getsize(win_wheel)
+    assert main.estimate_disk_usage(pending, targets, options) == (
+        1000 + compressed + 3000 + 2 * win_compressed,
+        compressed + win_compressed,
+    )
+    options.libs_wheel = "family"
+    options.reproducible = False
+    options.jobs = None
+    options.verify_inputs = False
+    options.cache_dir = None
+    options.strip_debug = False
+    assert main.estimate_disk_usage({"linux": [linux_wheel]}, targets, options) == (
+        1000 + 2 * compressed,
+        compressed,
+    )
+
+    # Wheels that can't be read are reported.
+    with pytest.raises(ValueError, match="Unable to read"):
+        main.estimate_disk_usage({"linux": [str(tmpdir)]}, targets, options)
+
+
+def test_check_disk_space(tmpdir, caplog):
+    caplog.set_level(logging.INFO)
+    options = argparse.Namespace(
+        libs_wheel=None, workdir=str(tmpdir), dest=str(tmpdir.join("dest"))
+    )
+    wheel = _make_wheel(tmpdir.join("a-1.0-py3-none-linux_x86_64.whl"), "a" * 1000)
+    pending = {"linux": [wheel]}
+    targets = {"linux": "linux"}
+    free_space = {str(tmpdir): 10**9}
+
+    with mock.patch(
+        "consolidatewheels.workspace.free_space", side_effect=free_space.get
+    ):
+        assert CHECK_DISK_SPACE(pending, targets, options) is True
+        assert "Estimated disk usage: 1.1 KB" in caplog.text
+
+        # Space in the destination is not enough.
+        free_space[str(tmpdir)] = 1000
+        assert CHECK_DISK_SPACE(pending, targets, options) is False
+        assert "free space are required in " in caplog.text
+
+        # A different filesystem for the workdir is checked too.
+        with mock.patch(
+            "consolidatewheels.workspace.same_filesystem", return_value=False
+        ):
+            free_space.update({str(tmpdir): 10**9, options.dest: 100})
+            assert CHECK_DISK_SPACE(pending, targets, options) is False
+            output = caplog.text
+            compressed = main._format_size(os.path.getsize(wheel))
+            assert f"Error: about {compressed} of free space" in output
+            assert f"required in {options.dest}, only 100.0 B available" in output
+
+    # The temporary directory is used when the destination is full.
+    options.workdir = options.dest
+    free_space = {options.dest: 1000, "tmp": 10**9}
+    with mock.patch(
+        "consolidatewheels.workspace.free_space", side_effect=free_space.get
+    ), mock.patch("tempfile.gettempdir", return_value="tmp"), mock.patch(
+        "consolidatewheels.workspace.same_filesystem", return_value=True
+    ):
+        assert CHECK_DISK_SPACE(pending, targets, options) is True
+    assert options.workdir == "tmp"
+    assert "working inside tmp" in caplog.text
+
+    # Unreadable wheels are reported as they are.
+    with pytest.raises(ValueError, match="Unable to read missing.whl"):
+        CHECK_DISK_SPACE({"linux": ["missing.whl"]}, targets, options)
+
+
+def test_format_size():
+    assert main._format_size(10) == "10.0 B"
+    assert main._format_size(3 * 1024**3) == "3.0 GB"
+    assert main._format_size(5 * 1024**4) == "5.0 TB"
+
+
+def test_regroup_locks():
+    # Manifests of previous versions keyed groups by the exact platform tags.
+    old = {
+        "wheels": {
+            "a": {"input": "a-1.0-cp310-cp310-manylinux_2_17_x86_64.whl"},
+            "b": {"input": "b-1.0-cp310-cp310-manylinux_2_17_x86_64.whl"},
+        }
+    }
+    empty = {"wheels": {}}
+    assert main.regroup_locks(
+        {"cp310-manylinux_2_17_x86_64": old, "py3-any": empty}
+    ) == {"cp310-linux_x86_64": old, "py3-any": empty}
+
+
+def test_main_against(tmpdir):
+    options = argparse.Namespace()
+    options.dest = "somedestdir"
+    options.wheels = ["one-1.0-py3-none-any.whl", "two-1.0-py3-none-any.whl"]
+    options.against = "previous.lock.json"
+    options.workdir = str(tmpdir.join("workdir"))
+    options.target = "auto"
+    options.codesign = None
+    options.libs_wheel = None
+    options.reproducible = False
+    options.jobs = None
+    options.verify_inputs = False
+    options.cache_dir = None
+    options.strip_debug = False
+    lock = {"platform": "linux", "providers": {}, "wheels": {}}
+    previous_manifest = {"version": 2, "groups": {"py3-any": lock}}
+
+    # Only the changed wheels are consolidated against the manifest.
+    with mock.patch("platform.system", return_value="linux"), mock.patch(
+        "consolidatewheels.main.requirements_satisfied", return_value=True
+    ), mock.patch(
+        "consolidatewheels.main.parse_options", return_value=options
+    ), mock.patch(
+        "consolidatewheels.manifest.load_manifest", return_value=previous_manifest
+    ), mock.patch(
+        "consolidatewheels.manifest.changed_wheels",
+        return_value=["two-1.0-py3-none-any.whl"],
+    ), mock.patch(
+        "consolidatewheels.manifest.update_manifest"
+    ) as update_manifest, mock.patch(
+        "consolidatewheels.manifest.write_manifest"
+    ), mock.patch(
+        "consolidatewheels.consolidate_linux.consolidate"
+    ) as consolidate_func:
+        assert main.main() == 0
+    consolidate_func.assert_called_once_with(
+        ["two-1.0-py3-none-any.whl"],
+        options.dest,
+        against=lock,
+        workdir=options.workdir,
+        reproducible=False,
+        cachedir=None,
+        strip=False,
+    )
+    update_manifest.assert_called_once_with(
+        lock, "linux", ["two-1.0-py3-none-any.whl"], consolidate_func.return_value
+    )
+
+    # Nothing to do when no wheel changed.
+    with mock.patch("platform.system", return_value="linux"), mock.patch(
+        "consolidatewheels.main.requirements_satisfied", return_value=True
+    ), mock.patch(
+        "consolidatewheels.main.parse_options", return_value=options
+    ), mock.patch(
+        "consolidatewheels.manifest.load_manifest", return_value=previous_manifest
+    ), mock.patch(
+        "consolidatewheels.manifest.changed_wheels", return_value=[]
+    ), mock.patch(
+        "consolidatewheels.manifest.write_manifest"
+    ) as write_manifest, mock.patch(
+        "consolidatewheels.consolidate_linux.consolidate"
+    ) as consolidate_func:
+        assert main.main() == 0
+    consolidate_func.assert_not_called()
+    write_manifest.assert_not_called()
+
+    # The manifest path is made absolute
+    with mock.patch(
+        "sys.argv", ["consolidatewheels", "wheel1", "--against", "prev.lock.json"]
+    ):
+        opts = main.parse_options()
+    assert opts.against == os.path.abspath("prev.lock.json")
+
+
+def _imported_modules(module):
+    """Modules that are loaded once ``module`` is imported, in a fresh interpreter."""
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            f"import sys, {module}; print(chr(10).join(sys.modules))",
+        ],
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    return set(result.stdout.splitlines())
+
+
+def _import_times(*modules):
+    """Cumulative import time of each module, imported in a fresh interpreter."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {', '.join(modules)}"],
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_startup_imports():
+    # Platform backends and their dependencies are not imported at startup.
+    modules = _imported_modules("consolidatewheels.__main__")
+    assert "consolidatewheels.main" in modules
+    assert not LAZY_MODULES & modules
+
+    # Only the functions needing them load pkginfo and packaging.
+    modules = _imported_modules("consolidatewheels.consolidate_linux")
+    assert not {"packaging", "pkginfo"} & modules
+
+    # Importing the tool stays within a budget relative to importing json,
+    # the best of multiple runs to avoid failing on a busy machine.
+    ratios = []
+    for _ in range(3):
+        times = _import_times("json", "consolidatewheels.main")
+        ratios.append(times["consolidatewheels.main"] / times["json"])
+    assert min(ratios) < IMPORT_TIME_BUDGET
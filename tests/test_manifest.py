@@ -0,0 +1,215 @@
+from __future__ import annotations
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import shutil
+
+import pytest
+
+from consolidatewheels import manifest, wheelsfunc
+
+HERE = os.path.dirname(__file__)
+FIXTURE_FILES = {
+    "libtwo.whl": os.path.join(
+        HERE,
+        "files",
+        "libtwo-0.0.0-cp310-cp310-manylinux1_x86_64.manylinux_2_5_x86_64.whl",
+    ),
+    "libfirst.whl": os.path.join(
+        HERE,
+        "files",
+        "libfirst-0.0.0-cp310-cp310-manylinux1_x86_64.manylinux_2_5_x86_64.whl",
+    ),
+}
+
+
+def _sha256(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def test_file_sha256():
+    libtwo = FIXTURE_FILES["libtwo.whl"]
+    assert manifest.file_sha256(libtwo) == _sha256(libtwo)
+
+
+def test_wheel_distname():
+    assert manifest.wheel_distname(FIXTURE_FILES["libtwo.whl"]) == "libtwo"
+    assert manifest.wheel_distname("/tmp/work/libfirst-0.0.0") == "libfirst"
+
+
+def test_find_providers(tmpdir):
+    wheeldirs = wheelsfunc.unpackwheels(
+        [FIXTURE_FILES["libfirst.whl"], FIXTURE_FILES["libtwo.whl"]], workdir=tmpdir
+    )
+    providers = manifest.find_providers(wheeldirs)
+    # First wheel providing a library wins.
+    assert providers["libfoo.so"] == "libfirst"
+    assert providers["libbar.so"] == "libtwo"
+    assert providers["libfoo-3faccd3s.so"] == "libtwo"
+    # Load order files are not libraries.
+    assert not [name for name in providers if name.startswith(".load-order")]
+
+
+def test_update_manifest(tmpdir):
+    outputs = []
+    for wheel in FIXTURE_FILES.values():
+        outputs.append(shutil.copy(wheel, tmpdir.mkdir(os.path.basename(wheel))))
+
+    lock = manifest.update_manifest(
+        None,
+        "linux",
+        list(FIXTURE_FILES.values()),
+        {
+            "mangling_map": {"libfoo.so": "libfoo-3fac4b7b.so"},
+            "providers": {"libfoo-3fac4b7b.so": "libfirst"},
+            "outputs": outputs,
+        },
+    )
+    assert lock["platform"] == "linux"
+    assert lock["mangling_map"] == {"libfoo.so": "libfoo-3fac4b7b.so"}
+    assert lock["providers"] == {"libfoo-3fac4b7b.so": "libfirst"}
+    assert lock["wheels"]["libtwo"] == {
+        "input": os.path.basename(FIXTURE_FILES["libtwo.whl"]),
+        "input_sha256": _sha256(FIXTURE_FILES["libtwo.whl"]),
+        "output": os.path.basename(FIXTURE_FILES["libtwo.whl"]),
+        "output_sha256": _sha256(FIXTURE_FILES["libtwo.whl"]),
+    }
+
+    # Updating only some wheels preserves the others.
+    updated_lock = manifest.update_manifest(
+        lock,
+        "linux",
+        [FIXTURE_FILES["libtwo.whl"]],
+        {
+            "consolidated_id": "ASDFGH",
+            "providers": {"libbar.so": "libtwo"},
+            "outputs": [outputs[0]],
+        },
+    )
+    assert updated_lock["consolidated_id"] == "ASDFGH"
+    assert updated_lock["providers"] == {
+        "libfoo-3fac4b7b.so": "libfirst",
+        "libbar.so": "libtwo",
+    }
+    assert updated_lock["wheels"]["libfirst"] == lock["wheels"]["libfirst"]
+    # The previous manifest is left untouched
+    assert "consolidated_id" not in lock
+
+    # Outputs are matched to inputs whose name is spelled differently.
+    wheel = shutil.copy(
+        FIXTURE_FILES["libtwo.whl"],
+        tmpdir.join("Lib.Two-0.0.0-cp310-cp310-linux_x86_64.whl"),
+    )
+    output = shutil.copy(
+        wheel, tmpdir.join("lib_two-0.0.0-cp310-cp310-linux_x86_64.whl")
+    )
+    renamed_lock = manifest.update_manifest(
+        updated_lock,
+        "linux",
+        [wheel],
+        {"providers": {"libbar.so": "lib_two"}, "outputs": [output]},
+    )
+    assert renamed_lock["wheels"]["Lib.Two"]["output"] == os.path.basename(output)
+    assert renamed_lock["providers"] == {
+        "libfoo-3fac4b7b.so": "libfirst",
+        "libbar.so": "lib_two",
+    }
+
+
+def test_write_load_manifest(tmpdir):
+    groups = {"cp310-manylinux1_x86_64": {"wheels": {}, "providers": {}}}
+    path = manifest.write_manifest(str(tmpdir), groups)
+    assert path == os.path.join(tmpdir, manifest.MANIFEST_FILENAME)
+    assert manifest.load_manifest(path) == {
+        "version": manifest.MANIFEST_VERSION,
+        "groups": groups,
+    }
+
+    with open(path, "w") as f:
+        json.dump({"version": 999}, f)
+    with pytest.raises(ValueError) as err:
+        manifest.load_manifest(path)
+    assert str(err.value) == f"Unsupported manifest version in {path}"
+
+    # Manifests that can't be loaded are replaced.
+    manifest.write_manifest(str(tmpdir), groups)
+    assert manifest.load_manifest(path)["groups"] == groups
+
+
+def test_write_manifest_merge(tmpdir):
+    # Jobs consolidating each group into the same directory all get recorded.
+    groups = {f"cp3{idx}-linux_x86_64": {"wheels": {}} for idx in range(10)}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
+        paths = executor.map(
+            lambda group: manifest.write_manifest(str(tmpdir), {group: groups[group]}),
+            groups,
+        )
+    (path,) = set(paths)
+    assert manifest.load_manifest(path)["groups"] == groups
+
+    # Groups consolidated again are replaced.
+    updated = {"cp30-linux_x86_64": {"wheels": {"one": {}}}}
+    manifest.write_manifest(str(tmpdir), updated)
+    assert manifest.load_manifest(path)["groups"] == {**groups, **updated}
+
+
+def test_changed_wheels(tmpdir):
+    libtwo = FIXTURE_FILES["libtwo.whl"]
+    libfirst = FIXTURE_FILES["libfirst.whl"]
+    lock = {
+        "wheels": {
+            "libtwo": {"input_sha256": _sha256(libtwo), "output_sha256": "1234"},
+            "libfirst": {"input_sha256": "1234", "output_sha256": "5678"},
+        }
+    }
+    assert manifest.changed_wheels(lock, [libtwo, libfirst]) == [libfirst]
+
+    # Outputs of the previous consolidation are not changed either.
+    lock["wheels"]["libfirst"]["output_sha256"] = _sha256(libfirst)
+    assert manifest.changed_wheels(lock, [libtwo, libfirst]) == []
+
+    # New wheels are always changed.
+    del lock["wheels"]["libtwo"]
+    assert manifest.changed_wheels(lock, [libtwo, libfirst]) == [libtwo]
+
+
+def test_locked_providers():
+    lock = {"providers": {"libfoo.so": "libfirst", "libbar.so": "libtwo"}}
+    assert manifest.locked_providers(None, ["libtwo-0.0.0.whl"]) == {}
+    assert manifest.locked_providers(lock, [FIXTURE_FILES["libtwo.whl"]]) == {
+        "libfoo.so": "libfirst"
+    }
+
+
+def test_consolidated_together(tmpdir):
+    wheels = [FIXTURE_FILES["libfirst.whl"], FIXTURE_FILES["libtwo.whl"]]
+    wheeldirs = wheelsfunc.unpackwheels(wheels, workdir=str(tmpdir.mkdir("w")))
+    assert not manifest.consolidated_together(wheels)
+
+    manifest.write_markers(wheeldirs, {"mangling_map": {"libfoo.so": "libfoo-1.so"}})
+    with open(
+        os.path.join(wheeldirs[1], "libtwo-0.0.0.dist-info", manifest.MARKER_FILENAME)
+    ) as f:
+        marker = json.load(f)
+    assert marker["siblings"] == ["libfirst-0.0.0", "libtwo-0.0.0"]
+    consolidated = wheelsfunc.packwheels(wheeldirs, str(tmpdir.join("dest")))
+    assert manifest.consolidated_together(consolidated)
+
+    # Only when the wheels are the same that were consolidated together.
+    assert not manifest.consolidated_together(consolidated[:1])
+    assert not manifest.consolidated_together([consolidated[0], wheels[1]])
+    assert not manifest.consolidated_together([])
+
+    # And they were consolidated in the same way.
+    manifest.write_markers(wheeldirs[:1], {"mangling_map": {}})
+    manifest.write_markers(wheeldirs[1:], {"mangling_map": {}})
+    separately = wheelsfunc.packwheels(wheeldirs, str(tmpdir.join("separately")))
+    assert not manifest.consolidated_together(separately)
+
+    # Files that are not wheels were never consolidated.
+    notwheel = tmpdir.join("notwheel-1.0-py3-none-any.whl")
+    notwheel.write("")
+    assert not manifest.consolidated_together([str(notwheel)])
@@ -0,0 +1,79 @@
+from __future__ import annotations
+
+import sys
+import time
+
+import pytest
+
+from consolidatewheels import runner
+
+
+def test_run_tools():
+    # Ensure output is captured and results preserve commands order.
+    results = runner.run_tools(
+        [
+            [sys.executable, "-c", "import time; time.sleep(0.2); print('first')"],
+            [sys.executable, "-c", "import sys; sys.stderr.write('second')"],
+        ]
+    )
+    assert [r.returncode for r in results] == [0, 0]
+    assert results[0].stdout.strip() == b"first"
+    assert results[1].stderr == b"second"
+
+    # Nothing to run, nothing to do.
+    assert runner.run_tools([]) == []
+
+
+def test_run_tools_concurrency():
+    sleeper = [sys.executable, "-c", "import time; time.sleep(0.5)"]
+
+    start = time.monotonic()
+    runner.run_tools([sleeper] * 4, max_jobs=4)
+    concurrent_duration = time.monotonic() - start
+
+    start = time.monotonic()
+    runner.run_tools([sleeper] * 4, max_jobs=1)
+    serial_duration = time.monotonic() - start
+
+    assert concurrent_duration < serial_duration
+
+
+def test_run_tools_failure():
+    # The first failure cancels pending commands and is reported.
+    start = time.monotonic()
+    with pytest.raises(runner.ToolError) as err:
+        runner.run_tools(
+            [
+                [sys.executable, "-c", "import time; time.sleep(10)"],
+                [sys.executable, "-c", "import sys; sys.exit('broken tool')"],
+            ],
+            max_jobs=2,
+        )
+    assert time.monotonic() - start < 5
+    assert err.value.index == 1
+    assert err.value.result.returncode == 1
+    assert "broken tool" in str(err.value)
+
+    # Failures are only reported when checking results.
+    results = runner.run_tools(
+        [[sys.executable, "-c", "raise SystemExit(3)"]], check=False
+    )
+    assert results[0].returncode == 3
+
+    # Missing tools are reported as failures too.
+    with pytest.raises(runner.ToolError) as err:
+        runner.run_tools([["not-existing-tool-consolidatewheels"]])
+    assert err.value.result.returncode == 127
+
+    results = runner.run_tools([["not-existing-tool-consolidatewheels"]], check=False)
+    assert results[0].returncode == 127
+
+
+def test_run_tools_timeout():
+    sleeper = [sys.executable, "-c", "import time; time.sleep(10)"]
+    with pytest.raises(runner.ToolError) as err:
+        runner.run_tools([sleeper], timeout=0.5)
+    assert "timed out after 0.5s" in str(err.value)
+
+    results = runner.run_tools([sleeper], timeout=0.5, check=False)
+    assert results[0].returncode != 0
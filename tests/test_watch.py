@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+import os
+from unittest import mock
+
+import pytest
+
+from consolidatewheels import watch
+
+
+def _arrivals(directory, steps):
+    """Replace sleeping with the next change to the watched directory."""
+    steps = list(steps)
+
+    def sleep(interval):
+        if steps:
+            filename, content = steps.pop(0)
+            with open(os.path.join(directory, filename), "a") as f:
+                f.write(content)
+
+    return mock.patch("time.sleep", side_effect=sleep)
+
+
+def test_watch_wheels_expected(tmpdir):
+    directory = str(tmpdir)
+    on_wheel = mock.Mock()
+    steps = [
+        ("a-1.0-py3-none-any.whl", "partial"),
+        # Still being written, so it's not read yet.
+        ("a-1.0-py3-none-any.whl", "complete"),
+        ("README.txt", "not a wheel"),
+        ("b-1.0-py3-none-any.whl", "complete"),
+    ]
+    with _arrivals(directory, steps) as sleep:
+        wheels = watch.watch_wheels(directory, on_wheel, expected=2, interval=0.5)
+    assert wheels == [
+        os.path.join(directory, "a-1.0-py3-none-any.whl"),
+        os.path.join(directory, "b-1.0-py3-none-any.whl"),
+    ]
+    assert [call[0][0] for call in on_wheel.call_args_list] == wheels
+    sleep.assert_called_with(0.5)
+    # a is complete after the third poll, b after the fifth.
+    assert sleep.call_count == 5
+
+
+def test_watch_wheels_sentinel(tmpdir):
+    directory = str(tmpdir)
+    on_wheel = mock.Mock()
+    tmpdir.join("a-1.0-py3-none-any.whl").write("complete")
+    steps = [("b-1.0-py3-none-any.whl", "complete"), ("DONE", "")]
+    with _arrivals(directory, steps):
+        wheels = watch.watch_wheels(directory, on_wheel, sentinel="DONE")
+    assert [os.path.basename(wheel) for wheel in wheels] == [
+        "a-1.0-py3-none-any.whl",
+        "b-1.0-py3-none-any.whl",
+    ]
+
+    # Wheels still being written when the sentinel appears are waited for.
+    steps = [("c-1.0-py3-none-any.whl", "partial")] * 3
+    with _arrivals(directory, steps) as sleep:
+        wheels = watch.watch_wheels(directory, on_wheel, sentinel="DONE")
+    assert len(wheels) == 3
+    assert sleep.call_count == 4
+
+
+def test_watch_wheels_removed(tmpdir):
+    directory = str(tmpdir)
+    tmpdir.join("a-1.0-py3-none-any.whl").write("complete")
+    tmpdir.join("DONE").write("")
+
+    # Wheels removed while they were listed are ignored.
+    real_stat = os.stat
+
+    def stat(path, *args, **kwargs):
+        if path.endswith("a-1.0-py3-none-any.whl"):
+            raise FileNotFoundError(path)
+        return real_stat(path, *args, **kwargs)
+
+    with mock.patch("os.stat", side_effect=stat):
+        assert watch.watch_wheels(directory, mock.Mock(), sentinel="DONE") == []
+
+
+def test_watch_wheels_timeout(tmpdir):
+    with pytest.raises(ValueError, match="expected wheels or a sentinel"):
+        watch.watch_wheels(str(tmpdir), mock.Mock())
+
+    tmpdir.join("a-1.0-py3-none-any.whl").write("complete")
+    with mock.patch("time.sleep"), mock.patch(
+        "time.monotonic", side_effect=[0, 1, 2, 3]
+    ), pytest.raises(RuntimeError, match="Timed out waiting for wheels.*found 1"):
+        watch.watch_wheels(str(tmpdir), mock.Mock(), expected=2, timeout=2.5)
@@ -1,7 +1,17 @@
 from __future__ import annotations
 
+import base64
+import concurrent.futures
 import glob
+import hashlib
+import io
 import os
+import re
+import shutil
+import struct
+import tracemalloc
+import zipfile
+from unittest import mock
 
 import pytest
 
@@ -13,7 +23,12 @@ FIXTURE_FILES = {
         HERE,
         "files",
         "libtwo-0.0.0-cp310-cp310-manylinux1_x86_64.manylinux_2_5_x86_64.whl",
-    )
+    ),
+    "libfirst.whl": os.path.join(
+        HERE,
+        "files",
+        "libfirst-0.0.0-cp310-cp310-manylinux1_x86_64.manylinux_2_5_x86_64.whl",
+    ),
 }
 
 
@@ -33,6 +48,29 @@ def test_unpackwheels(tmpdir):
     assert str(err.value) == "workdir must be empty"
 
 
+def test_cache_wheel(tmpdir):
+    cachedir = os.path.join(tmpdir, "cache")
+    wheelsfunc.cache_wheel(FIXTURE_FILES["libtwo.whl"], cachedir)
+    (tree,) = os.listdir(os.path.join(cachedir, "trees"))
+
+    # Consolidating the wheel later links it from the cache.
+    workdir = tmpdir.mkdir("workdir")
+    with mock.patch("consolidatewheels.wheelsfunc._unpack_wheel") as unpack:
+        (wheeldir,) = wheelsfunc.unpackwheels(
+            [FIXTURE_FILES["libtwo.whl"]], str(workdir), cachedir=cachedir
+        )
+    unpack.assert_not_called()
+    assert os.path.samefile(
+        os.path.join(wheeldir, "libtwo.libs", "libfoo-3faccd3s.so"),
+        os.path.join(
+            cachedir, "trees", tree, "libtwo-0.0.0", "libtwo.libs", "libfoo-3faccd3s.so"
+        ),
+    )
+
+    with pytest.raises(RuntimeError, match="Unable to unpack notexisting.whl"):
+        wheelsfunc.cache_wheel("notexisting.whl", cachedir)
+
+
 def test_packwheels(tmpdir):
     wheeldir = wheelsfunc.unpackwheels([FIXTURE_FILES["libtwo.whl"]], workdir=tmpdir)
     wheeldir = wheeldir[0]
@@ -46,13 +84,418 @@ def test_packwheels(tmpdir):
     # Ensure we trap errors
     with pytest.raises(RuntimeError) as err:
         wheelsfunc.packwheels(["non-existing-dir"], destdir=destdir)
-    assert (
-        str(err.value)
-        == f"Unable to pack non-existing-dir into {os.path.join(destdir, 'tmp')}"
-    )
+    assert str(err.value) == "Unable to pack non-existing-dir"
+
+    # Ensure staging directories are cleaned up
+    assert os.listdir(destdir) == [os.path.basename(generated_wheel[0])]
 
     # Ensure that replacing an existing wheel works.
     existing_wheel = generated_wheel[0]
     assert os.path.exists(existing_wheel)
     result = wheelsfunc.packwheels([wheeldir], destdir=destdir)
     assert result and result[0] == existing_wheel
+
+
+def test_packwheels_reproducible(tmpdir, monkeypatch):
+    monkeypatch.delenv("SOURCE_DATE_EPOCH", raising=False)
+    results = []
+    for idx, (mtime, mode) in enumerate([(1000000000, 0o600), (1500000000, 0o664)]):
+        workdir = tmpdir.mkdir(f"run{idx}")
+        (wheeldir,) = wheelsfunc.unpackwheels([FIXTURE_FILES["libtwo.whl"]], workdir)
+        for root, _, filenames in os.walk(wheeldir):
+            for filename in filenames:
+                os.chmod(os.path.join(root, filename), mode)
+                os.utime(os.path.join(root, filename), (mtime, mtime))
+        (wheel,) = wheelsfunc.packwheels(
+            [wheeldir], os.path.join(workdir, "wheels"), reproducible=True
+        )
+        with open(wheel, "rb") as f:
+            results.append(f.read())
+
+    # Timestamps and permissions of the unpacked files don't matter.
+    assert results[0] == results[1]
+    with zipfile.ZipFile(io.BytesIO(results[0])) as wf:
+        assert {zinfo.date_time for zinfo in wf.infolist()} == {(1980, 1, 1, 0, 0, 0)}
+        assert {zinfo.external_attr >> 16 & 0o777 for zinfo in wf.infolist()} == {
+            0o644,
+            0o664,
+        }
+
+    # SOURCE_DATE_EPOCH is honoured.
+    monkeypatch.setenv("SOURCE_DATE_EPOCH", "1600000000")
+    (wheel,) = wheelsfunc.packwheels(
+        [wheeldir], os.path.join(tmpdir, "epoch"), reproducible=True
+    )
+    with zipfile.ZipFile(wheel) as wf:
+        assert wf.getinfo("libtwo/__init__.py").date_time == (2020, 9, 13, 12, 26, 40)
+
+
+def test_packwheels_concurrent(tmpdir):
+    wheeldirs = wheelsfunc.unpackwheels(
+        [FIXTURE_FILES["libtwo.whl"], FIXTURE_FILES["libfirst.whl"]],
+        workdir=tmpdir.mkdir("wheeldirs"),
+    )
+    destdir = os.path.join(tmpdir, "wheels")
+
+    # Multiple consolidations can write into the same destination.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [
+            executor.submit(wheelsfunc.packwheels, wheeldirs, destdir) for _ in range(8)
+        ]
+        results = {tuple(future.result()) for future in futures}
+    assert len(results) == 1
+    assert sorted(os.listdir(destdir)) == sorted(
+        os.path.basename(wheel) for wheel in results.pop()
+    )
+    for wheel in os.listdir(destdir):
+        with zipfile.ZipFile(os.path.join(destdir, wheel)) as wf:
+            assert wf.testzip() is None
+
+
+def test_unpack_and_scan(tmpdir):
+    wheels = [FIXTURE_FILES["libtwo.whl"], FIXTURE_FILES["libfirst.whl"]]
+    unpacked = wheelsfunc.unpack_and_scan(wheels, str(tmpdir), scan=os.listdir)
+    assert [wheeldir for wheeldir, _ in unpacked] == [
+        os.path.join(tmpdir, "libtwo-0.0.0"),
+        os.path.join(tmpdir, "libfirst-0.0.0"),
+    ]
+    # Each wheel is scanned once it's unpacked.
+    assert "libtwo" in unpacked[0][1]
+    assert "libfirst" in unpacked[1][1]
+
+
+def test_patch_and_pack(tmpdir):
+    wheeldirs = wheelsfunc.unpackwheels(
+        [FIXTURE_FILES["libtwo.whl"], FIXTURE_FILES["libfirst.whl"]],
+        workdir=tmpdir.mkdir("wheeldirs"),
+    )
+
+    def patch(wheeldir):
+        name = os.path.basename(wheeldir).split("-")[0]
+        with open(os.path.join(wheeldir, name, "patched.txt"), "w") as f:
+            f.write(name)
+        return name
+
+    # Wheels are packed once they are patched.
+    packed = wheelsfunc.patch_and_pack(
+        wheeldirs, os.path.join(tmpdir, "wheels"), patch=patch
+    )
+    assert [patched for _, patched in packed] == ["libtwo", "libfirst"]
+    for wheel, name in packed:
+        with zipfile.ZipFile(wheel) as wf:
+            assert wf.read(f"{name}/patched.txt") == name.encode("ascii")
+
+    # Errors in patching are reported as they are.
+    with pytest.raises(RuntimeError, match="Unable to patch"):
+        wheelsfunc.patch_and_pack(
+            wheeldirs,
+            os.path.join(tmpdir, "failed"),
+            patch=mock.Mock(side_effect=RuntimeError("Unable to patch")),
+        )
+
+
+def test_pipeline_depth(tmpdir):
+    wheels = []
+    for name in ("liba", "libb", "libc"):
+        wheel = os.path.join(tmpdir, f"{name}-1.0-py3-none-any.whl")
+        shutil.copy(FIXTURE_FILES["libtwo.whl"], wheel)
+        wheels.append(wheel)
+
+    # Once a wheel fails, no more wheels are started.
+    scan = mock.Mock(side_effect=[None, RuntimeError("Broken wheel"), None])
+    with mock.patch("consolidatewheels.wheelsfunc.PIPELINE_DEPTH", 1):
+        with pytest.raises(RuntimeError, match="Broken wheel"):
+            wheelsfunc.unpack_and_scan(wheels, str(tmpdir.mkdir("w")), scan=scan)
+    assert scan.call_count == 2
+
+    # Otherwise all the wheels are processed, in their order.
+    with mock.patch("consolidatewheels.wheelsfunc.PIPELINE_DEPTH", 2):
+        unpacked = wheelsfunc.unpack_and_scan(wheels, str(tmpdir.mkdir("all")))
+    assert [os.path.basename(wheeldir) for wheeldir, _ in unpacked] == [
+        "liba-1.0",
+        "libb-1.0",
+        "libc-1.0",
+    ]
+
+
+def _rewrite_wheel(source, target, members=None, record=None):
+    """Copy a wheel replacing or adding the content of some members or its RECORD.
+
+    Entries for directories, that are not listed in RECORD, are added too.
+    """
+    members = members or {}
+    with zipfile.ZipFile(source) as src, zipfile.ZipFile(target, "w") as dst:
+        dst.writestr("libtwo/", b"")
+        for zinfo in src.infolist():
+            content = members.get(zinfo.filename, src.read(zinfo))
+            if zinfo.filename.endswith(".dist-info/RECORD") and record is not None:
+                content = record(content.decode("utf-8")).encode("utf-8")
+            if content is not None:
+                dst.writestr(zinfo, content)
+        for name, content in members.items():
+            if name not in src.namelist() and content is not None:
+                dst.writestr(name, content)
+    return target
+
+
+def test_verify_wheels(tmpdir):
+    libtwo = FIXTURE_FILES["libtwo.whl"]
+    wheels = []
+    for name in ("liba", "libb", "libc"):
+        wheel = os.path.join(tmpdir, f"{name}-1.0-py3-none-any.whl")
+        shutil.copy(libtwo, wheel)
+        wheels.append(wheel)
+    with mock.patch("consolidatewheels.wheelsfunc.PIPELINE_DEPTH", 2):
+        wheelsfunc.verify_wheels(wheels + [FIXTURE_FILES["libfirst.whl"]])
+
+    def verify(wheel):
+        with pytest.raises(ValueError) as err:
+            wheelsfunc.verify_wheels([wheels[0], wheel])
+        return str(err.value)
+
+    tampered = _rewrite_wheel(
+        libtwo, tmpdir.join("tampered.whl"), {"libtwo/__init__.py": b"import os\n"}
+    )
+    assert "libtwo/__init__.py doesn't match its RECORD" in verify(tampered)
+    unlisted = _rewrite_wheel(
+        libtwo,
+        tmpdir.join("unlisted.whl"),
+        record=lambda r: "".join(
+            line for line in r.splitlines(True) if "__init__.py" not in line
+        ),
+    )
+    assert "libtwo/__init__.py is not listed in RECORD" in verify(unlisted)
+    missing = _rewrite_wheel(
+        libtwo, tmpdir.join("missing.whl"), {"libtwo/__init__.py": None}
+    )
+    assert "libtwo/__init__.py listed in RECORD but missing" in verify(missing)
+    unsupported = _rewrite_wheel(
+        libtwo,
+        tmpdir.join("unsupported.whl"),
+        record=lambda r: r.replace("sha256=", "sha0=", 1),
+    )
+    assert "unsupported hash" in verify(unsupported)
+    unhashed = _rewrite_wheel(
+        libtwo,
+        tmpdir.join("unhashed.whl"),
+        record=lambda r: re.sub(
+            r"libtwo/__init__.py,[^,]*,", "libtwo/__init__.py,,", r
+        ),
+    )
+    assert "libtwo/__init__.py has no hash in RECORD" in verify(unhashed)
+
+    # Signatures of RECORD are not listed in it, as the wheel spec allows.
+    signed = _rewrite_wheel(
+        libtwo,
+        tmpdir.join("signed.whl"),
+        {
+            "libtwo-0.0.0.dist-info/RECORD.jws": b"{}",
+            "libtwo-0.0.0.dist-info/RECORD.p7s": b"signature",
+        },
+    )
+    wheelsfunc.verify_wheels([str(signed)])
+
+    # Truncated and corrupted wheels are detected by zipfile itself.
+    with open(libtwo, "rb") as f:
+        content = f.read()
+    truncated = tmpdir.join("truncated.whl")
+    truncated.write_binary(content[: len(content) // 2])
+    assert "Unable to read" in verify(str(truncated))
+    with zipfile.ZipFile(libtwo) as wf:
+        zinfo = wf.getinfo("libtwo/__init__.py")
+    corrupted = bytearray(content)
+    # The first byte of the member, after its local header.
+    data_offset = zinfo.header_offset + 30 + len(zinfo.filename) + len(zinfo.extra)
+    corrupted[data_offset] ^= 0xFF
+    tmpdir.join("corrupted.whl").write_binary(bytes(corrupted))
+    assert "libtwo/__init__.py is corrupted" in verify(
+        str(tmpdir.join("corrupted.whl"))
+    )
+    norecord = _rewrite_wheel(
+        libtwo,
+        tmpdir.join("norecord.whl"),
+        {"libtwo-0.0.0.dist-info/RECORD": None},
+    )
+    assert "Expected one .dist-info/RECORD file" in verify(norecord)
+
+
+def _zip64_local_header(wheel, arcname):
+    with zipfile.ZipFile(wheel) as wf:
+        zinfo = wf.getinfo(arcname)
+    with open(wheel, "rb") as f:
+        f.seek(zinfo.header_offset)
+        header = f.read(30)
+        filename_len, extra_len = struct.unpack("<HH", header[26:30])
+        f.seek(filename_len, os.SEEK_CUR)
+        extra = f.read(extra_len)
+    return extra[:2] == b"\x01\x00"
+
+
+def test_packwheels_metadata(tmpdir):
+    wheeldir = wheelsfunc.unpackwheels([FIXTURE_FILES["libtwo.whl"]], workdir=tmpdir)
+    wheeldir = wheeldir[0]
+    destdir = os.path.join(tmpdir, "wheels")
+    dist_info = os.path.join(wheeldir, "libtwo-0.0.0.dist-info")
+
+    # RECORD is generated again and placed at the end with the metadata.
+    with open(os.path.join(wheeldir, "libtwo", "newfile.py"), "w") as f:
+        f.write("print('hello')\n")
+    wheel = wheelsfunc.packwheels([wheeldir], destdir=destdir)[0]
+    with zipfile.ZipFile(wheel) as wf:
+        names = wf.namelist()
+        record = wf.read("libtwo-0.0.0.dist-info/RECORD").decode("utf-8")
+    assert names[-1] == "libtwo-0.0.0.dist-info/RECORD"
+    assert all(n.startswith("libtwo-0.0.0.dist-info/") for n in names[-4:])
+    digest = hashlib.sha256(b"print('hello')\n").digest()
+    encoded_digest = base64.urlsafe_b64encode(digest).rstrip(b"=").decode("ascii")
+    assert f"libtwo/newfile.py,sha256={encoded_digest},15" in record.splitlines()
+    assert record.splitlines()[-1] == "libtwo-0.0.0.dist-info/RECORD,,"
+
+    # Build numbers are preserved in the wheel name
+    with open(os.path.join(dist_info, "WHEEL")) as f:
+        wheel_info = f.read()
+    with open(os.path.join(dist_info, "WHEEL"), "w") as f:
+        f.write("Build: 1\n" + wheel_info)
+    wheel = wheelsfunc.packwheels([wheeldir], destdir=destdir)[0]
+    assert os.path.basename(wheel).startswith("libtwo-0.0.0-1-cp310-cp310-")
+
+    # Wheels without tags can't be named
+    with open(os.path.join(dist_info, "WHEEL"), "w") as f:
+        f.write("Wheel-Version: 1.0\n")
+    with pytest.raises(RuntimeError):
+        wheelsfunc.packwheels([wheeldir], destdir=destdir)
+
+    # Only one dist-info directory is allowed
+    shutil.copytree(dist_info, os.path.join(wheeldir, "other-1.0.dist-info"))
+    with pytest.raises(RuntimeError):
+        wheelsfunc.packwheels([wheeldir], destdir=destdir)
+
+
+def test_unpackwheels_unsafe(tmpdir):
+    wheel = os.path.join(tmpdir, "evil-1.0-py3-none-any.whl")
+    with zipfile.ZipFile(wheel, "w") as wf:
+        wf.writestr("evil/", "")
+        wf.writestr("../outside.txt", "evil")
+    workdir = tmpdir.mkdir("workdir")
+    with pytest.raises(RuntimeError) as err:
+        wheelsfunc.unpackwheels([wheel], workdir=str(workdir))
+    assert str(err.value) == f"Unable to unpack {wheel}"
+    assert not os.path.exists(os.path.join(tmpdir, "outside.txt"))
+
+
+def test_packwheels_zip64(tmpdir):
+    wheeldir = wheelsfunc.unpackwheels([FIXTURE_FILES["libtwo.whl"]], workdir=tmpdir)
+    destdir = os.path.join(tmpdir, "wheels")
+
+    wheel = wheelsfunc.packwheels(wheeldir, destdir=destdir)[0]
+    assert not _zip64_local_header(wheel, "libtwo/__init__.py")
+
+    # Big members are written in Zip64 format and can be read back.
+    with mock.patch("consolidatewheels.wheelsfunc.ZIP64_THRESHOLD", 0):
+        wheel = wheelsfunc.packwheels(wheeldir, destdir=destdir)[0]
+    assert _zip64_local_header(wheel, "libtwo/__init__.py")
+
+    unpackdir = tmpdir.mkdir("unpacked")
+    wheeldir = wheelsfunc.unpackwheels([wheel], workdir=str(unpackdir))[0]
+    with open(os.path.join(wheeldir, "libtwo", "__init__.py")) as f:
+        assert f.read() == "from ._libtwo import hello"
+
+
+def test_bounded_memory(tmpdir):
+    # Unpacking and packing stream members instead of reading them.
+    member_size = 64 * 1024 * 1024
+    wheel = os.path.join(tmpdir, "big-1.0-py3-none-any.whl")
+    chunk = b"\0" * wheelsfunc.COPY_BUFSIZE
+    with zipfile.ZipFile(wheel, "w", compression=zipfile.ZIP_DEFLATED) as wf:
+        with wf.open("big/data.bin", "w") as f:
+            for _ in range(member_size // len(chunk)):
+                f.write(chunk)
+        wf.writestr("big-1.0.dist-info/WHEEL", "Tag: py3-none-any\n")
+    del chunk
+
+    tracemalloc.start()
+    try:
+        workdir = tmpdir.mkdir("workdir")
+        wheeldirs = wheelsfunc.unpackwheels([wheel], workdir=str(workdir))
+        wheelsfunc.packwheels(wheeldirs, destdir=os.path.join(tmpdir, "wheels"))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert os.path.getsize(os.path.join(wheeldirs[0], "big", "data.bin")) == (
+        member_size
+    )
+    assert peak < member_size // 4
+
+
+def test_wheel_platform():
+    assert wheelsfunc.wheel_platform("a-1.0-cp310-cp310-win_amd64.whl") == "windows"
+    assert wheelsfunc.wheel_platform("a-1.0-cp310-cp310-win32.whl") == "windows"
+    assert (
+        wheelsfunc.wheel_platform(
+            "a-1.0-cp310-cp310-macosx_10_9_x86_64.macosx_11_0_arm64.whl"
+        )
+        == "macos"
+    )
+    assert (
+        wheelsfunc.wheel_platform(os.path.basename(FIXTURE_FILES["libtwo.whl"]))
+        == "linux"
+    )
+    assert wheelsfunc.wheel_platform("a-1.0-cp310-cp310-musllinux_1_1_x86_64.whl") == (
+        "linux"
+    )
+    # Pure wheels and invalid names have no platform.
+    assert wheelsfunc.wheel_platform("a-1.0-py3-none-any.whl") is None
+    assert wheelsfunc.wheel_platform("notawheel.zip") is None
+
+
+def test_group_wheels(caplog):
+    wheels = [
+        "a-1.0-cp310-cp310-manylinux_2_17_x86_64.manylinux2014_x86_64.whl",
+        "a-1.0-cp310-cp310-musllinux_1_1_x86_64.whl",
+        "b-1.0-cp310-cp310-manylinux_2_28_x86_64.whl",
+        "/dist/a-1.0-cp311-cp311-manylinux_2_17_x86_64.whl",
+        "c-1.0-cp310-cp310-macosx_10_9_arm64.whl",
+        "d-1.0-cp310-cp310-macosx_11_0_arm64.whl",
+    ]
+    # Wheels needing different versions of the OS go together.
+    assert wheelsfunc.group_wheels(wheels) == {
+        "cp310-linux_x86_64": [wheels[0], wheels[2]],
+        "cp310-musllinux_x86_64": [wheels[1]],
+        "cp311-linux_x86_64": [wheels[3]],
+        "cp310-macosx_arm64": [wheels[4], wheels[5]],
+    }
+
+    # Stable ABI and pure wheels join the group they can be installed with.
+    wheels = [
+        "e-1.0-cp38-abi3-manylinux_2_17_x86_64.whl",
+        "a-1.0-cp310-cp310-manylinux_2_17_x86_64.whl",
+        "f-1.0-py3-none-any.whl",
+        "g-1.0-cp311-abi3-manylinux_2_17_x86_64.whl",
+        "h-1.0-py2-none-any.whl",
+        "i-1.0-pyx-none-any.whl",
+        "j-1.0-cp310-none-any.whl",
+    ]
+    assert wheelsfunc.group_wheels(wheels) == {
+        "cp310-linux_x86_64": wheels[:3] + [wheels[6]],
+        "cp311-linux_x86_64": [wheels[3]],
+        "py2-any": [wheels[4]],
+        "pyx-any": [wheels[5]],
+    }
+    assert not caplog.text
+
+    # Unless they could join more than one.
+    wheels.append("a-1.0-cp311-cp311-manylinux_2_17_x86_64.whl")
+    assert wheelsfunc.group_wheels(wheels) == {
+        "cp38-linux_x86_64": [wheels[0]],
+        "cp310-linux_x86_64": [wheels[1], wheels[6]],
+        "py3-any": [wheels[2]],
+        "cp311-linux_x86_64": [wheels[3], wheels[7]],
+        "py2-any": [wheels[4]],
+        "pyx-any": [wheels[5]],
+    }
+    assert (
+        "e-1.0-cp38-abi3-manylinux_2_17_x86_64.whl can be installed with the wheels "
+        "of cp310-linux_x86_64, cp311-linux_x86_64, it's consolidated on its own"
+    ) in caplog.text
+    with pytest.raises(ValueError, match="Invalid wheel filename"):
+        wheelsfunc.group_wheels(["notawheel.zip"])
@@ -0,0 +1,204 @@
+from __future__ import annotations
+
+import concurrent.futures
+import errno
+import os
+import threading
+from unittest import mock
+
+import pytest
+
+from consolidatewheels import workspace
+
+
+def test_make_workdir(tmpdir):
+    basedir = os.path.join(tmpdir, "notexisting")
+    with workspace.make_workdir(basedir, prefix="test-") as workdir:
+        assert os.path.dirname(workdir) == basedir
+        assert os.path.basename(workdir).startswith(".test-")
+        with open(os.path.join(workdir, "somefile"), "w") as f:
+            f.write("content")
+    assert os.listdir(basedir) == []
+
+    with workspace.make_workdir(None) as workdir:
+        assert os.path.isdir(workdir)
+    assert not os.path.exists(workdir)
+
+
+def test_same_filesystem(tmpdir):
+    assert workspace.same_filesystem(str(tmpdir), str(tmpdir.mkdir("sub")))
+
+
+def test_free_space(tmpdir):
+    notexisting = os.path.join(tmpdir, "not", "existing")
+    assert workspace.existing_parent(notexisting) == str(tmpdir)
+    assert workspace.free_space(notexisting) > 0
+
+
+def test_move_file(tmpdir):
+    src = os.path.join(tmpdir, "src")
+    dst = os.path.join(tmpdir, "dst")
+    with open(src, "w") as f:
+        f.write("new")
+    with open(dst, "w") as f:
+        f.write("old")
+
+    # Moving on the same filesystem is a rename that replaces the destination.
+    inode = os.stat(src).st_ino
+    workspace.move_file(src, dst)
+    assert not os.path.exists(src)
+    assert os.stat(dst).st_ino == inode
+    with open(dst) as f:
+        assert f.read() == "new"
+
+
+def test_move_file_cross_device(tmpdir):
+    src = os.path.join(tmpdir, "src")
+    dst = os.path.join(tmpdir, "dst")
+    with open(src, "w") as f:
+        f.write("content")
+
+    # Across filesystems the file is copied and then the source removed.
+    real_replace = os.replace
+
+    def cross_device_replace(source, destination):
+        if source == src:
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+        real_replace(source, destination)
+
+    with mock.patch("os.replace", side_effect=cross_device_replace):
+        workspace.move_file(src, dst)
+    assert not os.path.exists(src)
+    assert os.listdir(tmpdir) == ["dst"]
+    with open(dst) as f:
+        assert f.read() == "content"
+
+    # Failures in copying leave no partial file behind.
+    with open(src, "w") as f:
+        f.write("content")
+    with mock.patch("os.replace", side_effect=cross_device_replace), mock.patch(
+        "consolidatewheels.workspace.clone_file", side_effect=OSError("disk full")
+    ):
+        with pytest.raises(OSError):
+            workspace.move_file(src, os.path.join(tmpdir, "other"))
+    assert sorted(os.listdir(tmpdir)) == ["dst", "src"]
+
+    # Other errors are not hidden.
+    with pytest.raises(FileNotFoundError):
+        workspace.move_file(os.path.join(tmpdir, "missing"), dst)
+
+
+def test_write_atomic(tmpdir):
+    path = os.path.join(tmpdir, "file")
+    workspace.write_atomic(path, b"first")
+    os.chmod(path, 0o600)
+    workspace.write_atomic(path, b"second")
+    with open(path, "rb") as f:
+        assert f.read() == b"second"
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    assert os.listdir(tmpdir) == ["file"]
+
+    # On failure the original content is preserved and no temporary file is left.
+    with mock.patch("os.replace", side_effect=OSError("disk full")):
+        with pytest.raises(OSError):
+            workspace.write_atomic(path, b"third")
+    with open(path, "rb") as f:
+        assert f.read() == b"second"
+    assert os.listdir(tmpdir) == ["file"]
+
+
+def test_atomic_target(tmpdir):
+    path = os.path.join(tmpdir, "file")
+    with workspace.atomic_target(path) as first, workspace.atomic_target(
+        path
+    ) as second:
+        # Concurrent writers get their own temporary file.
+        assert first != second
+        assert os.path.dirname(first) == str(tmpdir)
+        with open(first, "w") as f:
+            f.write("first")
+        with open(second, "w") as f:
+            f.write("second")
+    with open(path) as f:
+        assert f.read() == "first"
+    assert os.listdir(tmpdir) == ["file"]
+
+
+def test_write_atomic_concurrent(tmpdir):
+    path = os.path.join(tmpdir, "file")
+    payloads = [str(idx).encode("ascii") * 100000 for idx in range(10)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
+        list(executor.map(lambda data: workspace.write_atomic(path, data), payloads))
+    with open(path, "rb") as f:
+        assert f.read() in payloads
+    assert os.listdir(tmpdir) == ["file"]
+
+
+def test_locked(tmpdir):
+    path = os.path.join(tmpdir, "file.lock")
+    acquired = threading.Event()
+
+    def lock():
+        with workspace.locked(path):
+            acquired.set()
+
+    with workspace.locked(path):
+        thread = threading.Thread(target=lock)
+        thread.start()
+        # The lock is only acquired once it's released.
+        assert not acquired.wait(0.2)
+    thread.join()
+    assert acquired.is_set()
+    assert os.listdir(tmpdir) == ["file.lock"]
+
+
+def test_clone_file(tmpdir):
+    src = os.path.join(tmpdir, "src")
+    with open(src, "wb") as f:
+        f.write(b"content" * 1024)
+    os.chmod(src, 0o755)
+
+    # Whatever the filesystem supports, the result is a copy.
+    dst = os.path.join(tmpdir, "dst")
+    workspace.clone_file(src, dst)
+    with open(dst, "rb") as f:
+        assert f.read() == b"content" * 1024
+    assert os.stat(dst).st_mode == os.stat(src).st_mode
+
+    # When reflinks are supported no data is copied.
+    with mock.patch("fcntl.ioctl") as ioctl, mock.patch(
+        "shutil.copyfileobj"
+    ) as copyfileobj:
+        workspace.clone_file(src, os.path.join(tmpdir, "reflinked"))
+    assert ioctl.call_args[0][1] == workspace.FICLONE
+    copyfileobj.assert_not_called()
+
+
+def test_link_tree(tmpdir):
+    src = os.path.join(tmpdir, "src")
+    os.makedirs(os.path.join(src, "pkg.libs"))
+    with open(os.path.join(src, "pkg.libs", "libfoo.so"), "wb") as f:
+        f.write(b"library")
+
+    # Files are hardlinked, so their content is shared.
+    dst = os.path.join(tmpdir, "dst")
+    workspace.link_tree(src, dst)
+    linked = os.path.join(dst, "pkg.libs", "libfoo.so")
+    assert os.path.samefile(linked, os.path.join(src, "pkg.libs", "libfoo.so"))
+
+    # Until they are detached, then modifying them doesn't affect the source.
+    workspace.detach_file(linked)
+    assert not os.path.samefile(linked, os.path.join(src, "pkg.libs", "libfoo.so"))
+    with open(linked, "r+b") as f:
+        f.write(b"patched")
+    with open(os.path.join(src, "pkg.libs", "libfoo.so"), "rb") as f:
+        assert f.read() == b"library"
+    workspace.detach_file(linked)
+    assert os.stat(linked).st_nlink == 1
+
+    # When they can't be linked, they are copied.
+    with mock.patch("os.link", side_effect=OSError(errno.EXDEV, "Cross-device")):
+        workspace.link_tree(src, os.path.join(tmpdir, "copied"))
+    with open(os.path.join(tmpdir, "copied", "pkg.libs", "libfoo.so"), "rb") as f:
+        assert f.read() == b"library"
+    assert os.stat(os.path.join(src, "pkg.libs", "libfoo.so")).st_nlink == 1